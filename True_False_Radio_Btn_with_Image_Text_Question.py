@@ -1,11 +1,18 @@
-import os
+import re
 import logging
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from PIL import Image
-import requests
-from io import BytesIO
-from openai import OpenAI
+from image_store import ImageStore
+from image_serving import send_image
+from image_utils import IMAGE_RESPONSE_FORMAT, fetch_image, image_source, render_image
+from llm_cache import discard_last_response
+from openai_client import client
+from rate_limit import RateLimitExceeded
+from structured_output import generate_structured, markdown_section, numbered_items
+from image_cache import cached_image
+from concurrency import generate_concurrently, image_executor
+from progress import report
+from quiz_registry import register_quiz_type, QUESTION_IMAGE_SIZE
 
 # Load environment variables
 load_dotenv()
@@ -14,34 +21,39 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Get OpenAI API key from environment variables
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    logger.error("OPENAI_API_KEY environment variable not set")
-    exit()
-
-# Initialize OpenAI client with API key
-client = OpenAI(api_key=openai_api_key)
-
 app = Flask(__name__)
 
-# In-memory storage for images
-image_store_true = {}
-
-def download_and_resize_image(image_url, target_size):
-    """Download an image from the given URL, resize it, and store it in-memory."""
+# Disk-backed image storage shared by all workers
+image_store_true = ImageStore("image_store_true")
+
+# Structured answer for one question: five statements, their three options and each statement's answer
+TRUE_FALSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "statements": {"type": "array", "items": {"type": "string", "minLength": 1}, "minItems": 5, "maxItems": 5},
+        "options": {
+            "type": "array",
+            "description": "True, False and Cannot Tell",
+            "items": {"type": "string", "minLength": 1},
+            "minItems": 3,
+            "maxItems": 3
+        },
+        "correct_answers": {
+            "type": "array",
+            "description": "The correct option of each statement, in statement order",
+            "items": {"type": "string", "enum": ["option1", "option2", "option3"]},
+            "minItems": 5,
+            "maxItems": 5
+        }
+    },
+    "required": ["statements", "options", "correct_answers"],
+    "additionalProperties": False
+}
+
+def download_and_resize_image(source, target_size):
+    """Fetch a generated image, resize it, and store it in the image store."""
     try:
-        logger.info(f"Downloading image from URL: {image_url}")
-        response = requests.get(image_url)
-        response.raise_for_status()
-        image = Image.open(BytesIO(response.content))
-        resized_image = image.resize(target_size, Image.LANCZOS)
-        output = BytesIO()
-        resized_image.save(output, format='PNG')
-        output.seek(0)
-        image_key = f"image_{len(image_store_true) + 1}.png"
-        image_store_true[image_key] = output
-        return image_key
+        return image_store_true.add(*render_image(fetch_image(source), target_size))
     except Exception as e:
         logger.error(f"Error resizing image: {e}")
         return None
@@ -55,13 +67,36 @@ def generate_image(prompt: str):
             model="dall-e-3",
             prompt=safe_prompt,
             n=1,
-            size="1024x1024"
+            size="1024x1024",
+            response_format=IMAGE_RESPONSE_FORMAT
         )
-        return response.data[0].url
+        return image_source(response.data[0])
+    except RateLimitExceeded:
+        # Fail the whole request with 429 instead of serving placeholder images
+        raise
     except Exception as e:
         logger.error(f"Error generating image: {e}")
         return None
 
+def parse_true_false_markdown(content):
+    """Parse the **Statements:**/**Options:**/**Correct Answers:** format."""
+    correct_answers = []
+    for line in numbered_items(markdown_section(content, "Correct Answers")):
+        match = re.search(r"option\d", line, re.IGNORECASE)
+        correct_answers.append(match.group(0).lower() if match else line)
+    return {
+        "statements": numbered_items(markdown_section(content, "Statements", "Options")),
+        "options": numbered_items(markdown_section(content, "Options", "Correct Answers")),
+        "correct_answers": correct_answers
+    }
+
+def format_true_false(question):
+    """Number the statements, options and answers as "1. ...", the shape this quiz type has always returned."""
+    return {
+        field: [f"{number}. {item}" for number, item in enumerate(question[field], 1)]
+        for field in ("statements", "options", "correct_answers")
+    }
+
 def generate_mcq_with_text_options(subject: str, tone: str):
     """Generate a multiple-choice question with text options based on the subject."""
     description_prompt = [
@@ -90,82 +125,83 @@ def generate_mcq_with_text_options(subject: str, tone: str):
     ]
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=description_prompt,
-            max_tokens=1000,
-            temperature=0.5
-        )
-        content = response.choices[0].message.content
-
-        # Ensure the response is split correctly
-        if "**Statements:**" in content and "**Options:**" in content and "**Correct Answers:**" in content:
-            statements_section = content.split("**Statements:**")[1].split("**Options:**")[0].strip()
-            options_section = content.split("**Options:**")[1].split("**Correct Answers:**")[0].strip()
-            correct_answers_section = content.split("**Correct Answers:**")[1].strip()
-
-            statements = [s.strip() for s in statements_section.split('\n')]
-            options = [o.strip() for o in options_section.split('\n')]
-            correct_answers = [a.split(": ")[0].strip() for a in correct_answers_section.split('\n')]
-
-            # Ensure the correct number of statements, options, and answers
-            if len(options) == 3 and len(statements) == 5 and len(correct_answers) == 5:
-                return {
-                    "statements": statements,
-                    "options": options,
-                    "correct_answers": correct_answers
-                }
-            else:
-                logger.error("Error: Mismatch in the number of statements, options, or correct answers")
-                return {"error": "Failed to generate MCQ"}
-        else:
-            logger.error("Error: Expected format not found in the response")
-            return {"error": "Failed to generate MCQ"}
+        return format_true_false(generate_structured(description_prompt, TRUE_FALSE_SCHEMA, parse_true_false_markdown))
     except Exception as e:
         logger.error(f"Error generating MCQ with text options: {e}")
+        discard_last_response()
         return {"error": "Failed to generate MCQ"}
 
 
-def generate_custom_content_true(number, subject, tone, max_retries=3):
-    """Generate custom content based on user-provided parameters."""
+def generate_question_image(image_prompt, max_retries=3):
+    """Generate, download and resize the question image, retrying the generation step."""
+    retries = 0
+    question_image_url = None
+    report(images_total=1)
+
     try:
-        if number < 1 or number > 10:
-            return {"error": "Number of questions must be between 1 and 10"}, 400
+        # Retry loop for image generation
+        while retries < max_retries:
+            question_image_url = generate_image(image_prompt)
+            if question_image_url and question_image_url != "placeholder_image_url":
+                break
+            retries += 1
+
+        if not question_image_url or question_image_url == "placeholder_image_url":
+            return "placeholder_image_url"
 
-        images_and_questions = []
-        for _ in range(number):
-            image_prompt = f"High-quality, detailed illustration representing the subject: {subject} in a {tone} tone"
-            retries = 0
-            question_image_url = None
+        return download_and_resize_image(question_image_url, QUESTION_IMAGE_SIZE) or "placeholder_image_url"
+    finally:
+        report(images_done=1)
 
-            # Retry loop for image generation
-            while retries < max_retries:
-                question_image_url = generate_image(image_prompt)
-                if question_image_url and question_image_url != "placeholder_image_url":
-                    break
-                retries += 1
 
-            if not question_image_url or question_image_url == "placeholder_image_url":
-                question_image_url = "placeholder_image_url"
+def generate_cached_question_image(image_prompt, max_retries=3):
+    """Return the question image for the prompt, reusing a cached rendering when allowed."""
+    return cached_image(
+        image_prompt, QUESTION_IMAGE_SIZE, lambda: generate_question_image(image_prompt, max_retries),
+        image_store_true
+    )
 
-            mcq_with_text = generate_mcq_with_text_options(subject, tone)
-            if "error" in mcq_with_text:
-                return {"error": "Failed to generate MCQ"}, 500
 
-            mcq_with_text["question_image_url"] = question_image_url
-            images_and_questions.append(mcq_with_text)
+def generate_question_with_image(subject, tone, max_retries=3):
+    """Generate one set of statements together with its question image."""
+    # The question image does not depend on the statements, so generate it alongside
+    image_prompt = f"High-quality, detailed illustration representing the subject: {subject} in a {tone} tone"
+    question_image = image_executor.submit(generate_cached_question_image, image_prompt, max_retries)
 
-        for item in images_and_questions:
-            question_image_url = item["question_image_url"]
-            question_image_key = download_and_resize_image(question_image_url, (750, 319)) if question_image_url != "placeholder_image_url" else "placeholder_image_url"
-            if question_image_key:
-                item["question_image_url"] = f"/image/{question_image_key}"
+    mcq_with_text = generate_mcq_with_text_options(subject, tone)
+    question_image_key = question_image.result()
+    if "error" in mcq_with_text:
+        return mcq_with_text
+
+    mcq_with_text["question_image_url"] = f"/image/{question_image_key}"
+    return mcq_with_text
+
+
+def generate_custom_content_true(number, subject, tone, max_retries=3):
+    """Generate custom content based on user-provided parameters."""
+    try:
+        if number < 1 or number > 10:
+            return {"error": "Number of questions must be between 1 and 10"}, 400
+
+        images_and_questions = generate_concurrently(generate_question_with_image, number, subject, tone, max_retries)
+        if any("error" in item for item in images_and_questions):
+            return {"error": "Failed to generate MCQ"}, 500
 
         return images_and_questions
     except Exception as e:
         logger.error(f"Error generating custom content: {e}")
         return {"error": "Internal server error"}, 500
 
+register_quiz_type(
+    700,
+    "True False Radio Button with Image & Text Question",
+    generate_custom_content_true,
+    max_questions=10,
+    image_store=image_store_true,
+    image_sizes={"question": QUESTION_IMAGE_SIZE},
+    schema=TRUE_FALSE_SCHEMA
+)
+
 
 @app.route('/custom', methods=['POST'])
 def custom_content():
@@ -215,12 +251,9 @@ def generate_content():
 
 @app.route('/image/<image_key>', methods=['GET'])
 def get_image(image_key):
-    """Serve an image from in-memory storage."""
+    """Serve an image from the image store."""
     if image_key in image_store_true:
-        return send_file(
-            BytesIO(image_store_true[image_key].getvalue()),
-            mimetype='image/png'
-        )
+        return send_image(image_store_true, image_key)
     else:
         logger.error(f"Image with key {image_key} not found")
         return jsonify({"error": "Image not found"}), 404
@@ -1,34 +1,33 @@
 import os
+import math
 import logging
+from itertools import chain
 from logging.handlers import RotatingFileHandler
-from flask import Flask, request, jsonify, send_file, url_for
-from io import BytesIO
+from flask import Flask, Response, request, jsonify, url_for, stream_with_context
 from dotenv import load_dotenv
-from PIL import Image
-import requests
-from openai import OpenAI
-from simple_mcq import generate_quiz
-from simple_checkox import generate_quizc
-from fill_in_the_blanks import generate_quiz1
-from image_to_image_mcq import generate_custom_content,image_store_imcq
-from images_txt import generate_custom_content1, image_store1
-from image_txt_checkbox import generate_custom_content11, image_store11
-from sequence import generate_sequence_quiz
-from image_checkbox import generate_custom_content_checkbox1,image_store_checkbox1
-from image_checkbox1 import generate_custom_content_checkbox, image_store_checkbox
-from True_False_Radio_Btn_with_Image_Text_Question import generate_custom_content_true, image_store_true
-from image_radio_button import generate_custom_content_radio , image_store_radio
-from sub1 import generate_custom_content_sub1,image_store_sub1
-from sub2 import generate_custom_content_sub2,image_store_sub2
-from sub3 import generate_custom_content_sub3,image_store_sub3
-from sub4 import generate_custom_content_sub4,image_store_sub4
-from appropriate import generate_custom_content_appro,image_store_appro
+from quiz_registry import QuizRegistry
+from jobs import job_manager
+from streaming import STREAM_MIMETYPES, stream_format, stream_questions, stream_generated
+from image_serving import send_image
+from rate_limit import RateLimitExceeded, Rejections, current_rejections, rate_limiter
+from circuit_breaker import image_breaker
+from question_pool import QuestionPool
+from question_bank import question_bank
 # Load environment variables
 load_dotenv()
 KEY = os.getenv("OPENAI_API_KEY")
+# The generator modules that use the key are only imported on first request, so check it at start-up
+if not KEY:
+    raise RuntimeError("OPENAI_API_KEY environment variable not set")
 
 app = Flask(__name__)
 
+# Generator modules are imported the first time their quiz type is requested
+registry = QuizRegistry()
+
+# Ready-made questions for the requests listed in QUESTION_POOL, refilled in the background from the first request
+question_pool = QuestionPool(registry)
+
 # Set up RotatingFileHandler
 log_file = '/root/brain/app.log'
 if not os.path.exists('/root/brain'):
@@ -56,140 +55,131 @@ def extract_quiz_details(quiz_data):
         print("Correct Answers:", correct_answers)
         print()
 
+# Quiz types whose questions are also printed to stdout
+PRINTED_QUIZ_TYPES = {100, 200, 501, 600, 601, 602, 700, 701}
+
+def parse_quiz_args():
+    """Read and validate the number, subject, tone and quiz_type query parameters."""
+    number = request.args.get('number', type=int)
+    if number is None:
+        raise ValueError("The 'number' parameter must be an integer")
+
+    subject = request.args.get('subject', type=str)
+    if subject is None:
+        raise ValueError("The 'subject' parameter must be a string")
+
+    tone = request.args.get('tone', type=str)
+    if tone is None:
+        raise ValueError("The 'tone' parameter must be a string")
+
+    quiz_type = request.args.get('quiz_type', type=int)
+    if quiz_type is None:
+        raise ValueError("The 'quiz_type' parameter must be an integer")
+
+    return number, subject, tone, quiz_type
+
+def generate_quiz_response(number, subject, tone, quiz_type):
+    """Generate a quiz of the given type and return the response list, serving pooled questions first."""
+    response = question_pool.generate(registry.get_quiz_type(quiz_type), number, subject, tone)
+    if quiz_type in PRINTED_QUIZ_TYPES and isinstance(response, list):
+        extract_quiz_details(response)
+    return response
+
+def stream_quiz_response(number, subject, tone, quiz_type, fmt):
+    """Stream the quiz one question at a time as NDJSON records or Server-Sent Events."""
+    quiz = registry.get_quiz_type(quiz_type)
+    if number < 1 or number > quiz.max_questions:
+        raise ValueError(f"Number of questions must be between 1 and {quiz.max_questions}")
+
+    if quiz.streamer:
+        # Batched types send each question as soon as its batch has been validated
+        pooled = question_pool.take(quiz_type, subject, tone, number)
+        questions = chain(pooled, quiz.stream(number - len(pooled), subject, tone))
+        records = stream_generated(questions, number, fmt)
+    else:
+        records = stream_questions(lambda: generate_quiz_response(1, subject, tone, quiz_type), number, fmt)
+    return Response(
+        stream_with_context(records),
+        mimetype=STREAM_MIMETYPES[fmt],
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.route('/generate_quiz', methods=['GET'])
 def generate_quiz_route():
     try:
-        number = request.args.get('number', type=int)
-        if number is None:
-            raise ValueError("The 'number' parameter must be an integer")
-        
-        subject = request.args.get('subject', type=str)
-        if subject is None:
-            raise ValueError("The 'subject' parameter must be a string")
+        number, subject, tone, quiz_type = parse_quiz_args()
 
-        tone = request.args.get('tone', type=str)
-        if tone is None:
-            raise ValueError("The 'tone' parameter must be a string")
+        fmt = stream_format(request.args.get('stream', type=str), request.headers.get('Accept', ''))
+        if fmt:
+            return stream_quiz_response(number, subject, tone, quiz_type, fmt)
 
-        quiz_type = request.args.get('quiz_type', type=int)
-        if quiz_type is None:
-            raise ValueError("The 'quiz_type' parameter must be an integer")
+        rejections = Rejections()
+        token = current_rejections.set(rejections)
+        try:
+            response = generate_quiz_response(number, subject, tone, quiz_type)
+        except RateLimitExceeded:
+            response = None
+        finally:
+            current_rejections.reset(token)
+        if rejections.retry_after is not None:
+            # Part of the quiz would have waited longer than RATE_LIMIT_MAX_WAIT for the model's rate limit
+            return jsonify({"error": "Too many requests, please try again later"}), 429, {
+                "Retry-After": str(math.ceil(rejections.retry_after))
+            }
+        return jsonify(response)
+    except Exception as e:
+        app.logger.error(str(e))
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/jobs', methods=['GET', 'POST'])
+def submit_job():
+    try:
+        number, subject, tone, quiz_type = parse_quiz_args()
+        registry.get_quiz_type(quiz_type)
+
+        job_id = job_manager.submit(
+            generate_quiz_response, number, subject, tone, quiz_type,
+            number=number, subject=subject, tone=tone, quiz_type=quiz_type
+        )
+        return jsonify({
+            "job_id": job_id,
+            "status_url": url_for('get_job', job_id=job_id),
+            "result_url": url_for('get_job_result', job_id=job_id)
+        }), 202
+    except Exception as e:
+        app.logger.error(str(e))
+        return jsonify({"error": str(e)}), 500
 
-        if quiz_type == 100:
-            response = generate_quiz(number, subject, tone)
-            extract_quiz_details(response)
-            # Extract and print details for quiz type 100
-        elif quiz_type == 200:
-            response = generate_quizc(number, subject, tone)
-            extract_quiz_details(response)  # Extract and print details for quiz type 200
-        elif quiz_type == 300:
-            response = generate_quiz1(number, subject, tone)
-        elif quiz_type == 400:
-            response = generate_sequence_quiz(number, subject, tone)
-        elif quiz_type == 500:
-            response = generate_custom_content1(number, subject, tone)
-        elif quiz_type == 501:
-            response = generate_custom_content11(number, subject, tone)
-            extract_quiz_details(response)
-        elif quiz_type == 600:
-            response = generate_custom_content(number, subject, tone)
-            extract_quiz_details(response)
-        elif quiz_type == 601:
-            response = generate_custom_content_checkbox(number, subject, tone)#image checkbox
-            extract_quiz_details(response)
-        elif quiz_type == 602:
-            response = generate_custom_content_checkbox1(number, subject, tone)
-            extract_quiz_details(response)
-        elif quiz_type == 700:
-            response = generate_custom_content_true(number, subject, tone)
-            extract_quiz_details(response)
-        elif quiz_type == 701:
-            response = generate_custom_content_radio(number, subject, tone)
-            extract_quiz_details(response)
-        elif quiz_type == 800:
-            response = generate_custom_content_sub1(number, subject, tone)#checkbox type
-        elif quiz_type == 801:
-            response = generate_custom_content_sub2(number, subject, tone)#radio type
-        elif quiz_type == 802:
-            response = generate_custom_content_sub3(number, subject, tone)#checkbox image
-        elif quiz_type == 803:
-            response = generate_custom_content_sub4(number, subject, tone)#radio type
-        elif quiz_type == 900:
-            response = generate_custom_content_appro(number, subject, tone)#radio type
-        else:
-            raise ValueError("Invalid quiz type, please enter a correct quiz_type")
-
-        return jsonify(response) 
-    except Exception as e: 
-        app.logger.error(str(e)) 
-        return jsonify({"error": str(e)}), 500 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    job.pop("result")
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    if job["status"] == "failed":
+        return jsonify({"error": job["error"]}), job.get("error_status") or 500
+    if job["status"] != "completed":
+        return jsonify({"status": job["status"], "progress": job["progress"]}), 202
+    return jsonify(job["result"])
+
+@app.route('/quiz_types', methods=['GET'])
+def list_quiz_types():
+    return jsonify([quiz.describe() for quiz in registry.all()])
 
 @app.route('/image/<image_key>', methods=['GET'])
 def get_image(image_key):
     try:
-        quiz_type = request.args.get('quiz_type', type=int)
-        if quiz_type == 500 and image_key in image_store1:
-            return send_file(
-                BytesIO(image_store1[image_key].getvalue()),
-                mimetype='image/png'
-            )
-        elif quiz_type == 501 and image_key in image_store11:
-            return send_file(
-                BytesIO(image_store11[image_key].getvalue()),
-                mimetype='image/png'
-            )
-        elif quiz_type == 600 and image_key in image_store_imcq:
-            return send_file(
-                BytesIO(image_store_imcq[image_key].getvalue()),
-                mimetype='image/png'
-            )
-        elif quiz_type == 601 and image_key in image_store_checkbox:
-            return send_file(
-                BytesIO(image_store_checkbox[image_key].getvalue()),
-                mimetype='image/png'
-            )
-        elif quiz_type == 602 and image_key in image_store_checkbox:
-            return send_file(
-                BytesIO(image_store_checkbox1[image_key].getvalue()),
-                mimetype='image/png'
-            )
-        elif quiz_type == 700 and image_key in image_store_true:
-            return send_file(
-                BytesIO(image_store_true[image_key].getvalue()),
-                mimetype='image/png'
-            )
-        elif quiz_type == 701 and image_key in image_store_radio:
-            return send_file(
-                BytesIO(image_store_radio[image_key].getvalue()),
-                mimetype='image/png'
-            )
-        elif quiz_type == 800 and image_key in image_store_sub1:
-            return send_file(
-                BytesIO(image_store_sub1[image_key].getvalue()),
-                mimetype='image/png'
-            )
-        elif quiz_type == 801 and image_key in image_store_sub2:
-            return send_file(
-                BytesIO(image_store_sub2[image_key].getvalue()),
-                mimetype='image/png'
-            )
-        elif quiz_type == 802 and image_key in image_store_sub3:
-            return send_file(
-                BytesIO(image_store_sub3[image_key].getvalue()),
-                mimetype='image/png'
-            )
-        elif quiz_type == 803 and image_key in image_store_sub4:
-            return send_file(
-                BytesIO(image_store_sub4[image_key].getvalue()),
-                mimetype='image/png'
-            )
-        elif quiz_type == 900 and image_key in image_store_appro:
-            return send_file(
-                BytesIO(image_store_appro[image_key].getvalue()),
-                mimetype='image/png'
-            )
-        else:
+        quiz = registry.get(request.args.get('quiz_type', type=int))
+        if quiz is None or quiz.image_store is None or image_key not in quiz.image_store:
             raise ValueError("Image with key not found")
+        return send_image(quiz.image_store, image_key)
 
     except Exception as e:
         app.logger.error(str(e))
@@ -198,61 +188,80 @@ def get_image(image_key):
 @app.route('/list_all_images', methods=['GET'])
 def list_all_images():
     try:
+        offset = request.args.get('offset', default=0, type=int)
+        limit = request.args.get('limit', type=int)
         images = {
-            'image_store': [
-                {"key": key, "url": url_for('get_image', image_key=key, quiz_type=600, _external=True)}
-                for key in image_store_imcq.keys()
-            ],
-            'image_store1': [
-                {"key": key, "url": url_for('get_image', image_key=key, quiz_type=500, _external=True)}
-                for key in image_store1.keys()
-            ],
-            'image_store11': [
-                {"key": key, "url": url_for('get_image', image_key=key, quiz_type=501, _external=True)}
-                for key in image_store11.keys()
-            ],
-            'image_store_checkbox': [
-                {"key": key, "url": url_for('get_image', image_key=key, quiz_type=601, _external=True)}
-                for key in image_store_checkbox.keys()
-            ],
-            'image_store_checkbox1': [
-                {"key": key, "url": url_for('get_image', image_key=key, quiz_type=602, _external=True)}
-                for key in image_store_checkbox1.keys()
-            ],
-            'image_store_true': [
-                {"key": key, "url": url_for('get_image', image_key=key, quiz_type=700, _external=True)}
-                for key in image_store_true.keys()
-            ],
-            'image_store_radio': [
-                {"key": key, "url": url_for('get_image', image_key=key, quiz_type=701, _external=True)}
-                for key in image_store_radio.keys()
-            ],
-          'image_store_sub1': [
-                {"key": key, "url": url_for('get_image', image_key=key, quiz_type=800, _external=True)}
-                for key in image_store_sub1.keys()
-            ],
-          'image_store_sub2': [
-                {"key": key, "url": url_for('get_image', image_key=key, quiz_type=801, _external=True)}
-                for key in image_store_sub2.keys()
-            ],
-          'image_store_sub3': [
-                {"key": key, "url": url_for('get_image', image_key=key, quiz_type=802, _external=True)}
-                for key in image_store_sub3.keys()
-            ],
-          'image_store_sub4': [
-                {"key": key, "url": url_for('get_image', image_key=key, quiz_type=803, _external=True)}
-                for key in image_store_sub4.keys()
-            ],
-          'image_store_appro': [
-                {"key": key, "url": url_for('get_image', image_key=key, quiz_type=900, _external=True)}
-                for key in image_store_appro.keys()
-            ],
+            quiz.list_name: [
+                {"key": key, "url": url_for('get_image', image_key=key, quiz_type=quiz.code, _external=True)}
+                for key in quiz.image_store.page(offset, limit)
+            ]
+            for quiz in registry.image_quiz_types()
         }
         return jsonify(images)
     except Exception as e:
         app.logger.error(str(e))
         return jsonify({"error": str(e)}), 500
 
+@app.route('/image_stats', methods=['GET'])
+def image_stats():
+    try:
+        stats = {quiz.image_store.namespace: quiz.image_store.stats() for quiz in registry.image_quiz_types()}
+        return jsonify(stats)
+    except Exception as e:
+        app.logger.error(str(e))
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/rate_limit_stats', methods=['GET'])
+def rate_limit_stats():
+    try:
+        return jsonify(rate_limiter.stats())
+    except Exception as e:
+        app.logger.error(str(e))
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/image_breaker', methods=['GET'])
+def image_breaker_status():
+    try:
+        return jsonify(image_breaker.stats())
+    except Exception as e:
+        app.logger.error(str(e))
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/question_pool', methods=['GET'])
+def question_pool_stats():
+    try:
+        return jsonify(question_pool.stats())
+    except Exception as e:
+        app.logger.error(str(e))
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/question_bank', methods=['GET'])
+def sample_question_bank():
+    try:
+        quiz_type = request.args.get('quiz_type', type=int)
+        if quiz_type is None:
+            raise ValueError("The 'quiz_type' parameter must be an integer")
+        if not registry.get_quiz_type(quiz_type).banked:
+            raise ValueError(f"Quiz type {quiz_type} has images and is not kept in the question bank")
+        number = request.args.get('number', default=1, type=int)
+        exclude = [digest for digest in request.args.get('exclude', default='', type=str).split(',') if digest]
+
+        questions = question_bank.sample(
+            quiz_type, number, request.args.get('subject', type=str), request.args.get('tone', type=str), exclude
+        )
+        return jsonify(questions)
+    except Exception as e:
+        app.logger.error(str(e))
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/question_bank/stats', methods=['GET'])
+def question_bank_stats():
+    try:
+        return jsonify(question_bank.stats())
+    except Exception as e:
+        app.logger.error(str(e))
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/delete_images', methods=['GET', 'POST'])
 def delete_images():
     try:
@@ -271,56 +280,10 @@ def delete_images():
         if start_index < 0 or end_index < start_index:
             raise ValueError("Invalid index range provided for deletion")
 
-        if quiz_type == 500:
-            keys = list(image_store1.keys())
-            for key in keys[start_index:end_index + 1]:
-                del image_store1[key]
-        elif quiz_type == 501:
-            keys = list(image_store11.keys())
-            for key in keys[start_index:end_index + 1]:
-                del image_store11[key]
-        elif quiz_type == 600:
-            keys = list(image_store_imcq.keys())
-            for key in keys[start_index:end_index + 1]:
-                del image_store_true[key]
-        elif quiz_type == 601:
-            keys = list(image_store_checkbox.keys())
-            for key in keys[start_index:end_index + 1]:
-                del image_store_checkbox[key]
-        elif quiz_type == 602:
-            keys = list(image_store_checkbox1.keys())
-            for key in keys[start_index:end_index + 1]:
-                del image_store_checkbox1[key]
-        elif quiz_type == 700:
-            keys = list(image_store_true.keys())
-            for key in keys[start_index:end_index + 1]:
-                del image_store_true[key]
-        elif quiz_type == 701:
-            keys = list(image_store_radio.keys())
-            for key in keys[start_index:end_index + 1]:
-                del image_store_radio[key]
-        elif quiz_type == 800:
-            keys = list(image_store_sub1.keys())
-            for key in keys[start_index:end_index + 1]:
-                del image_store_sub1[key]
-        elif quiz_type == 801:
-            keys = list(image_store_sub2.keys())
-            for key in keys[start_index:end_index + 1]:
-                del image_store_sub2[key]
-        elif quiz_type == 802:
-            keys = list(image_store_sub3.keys())
-            for key in keys[start_index:end_index + 1]:
-                del image_store_sub3[key]
-        elif quiz_type == 803:
-            keys = list(image_store_sub4.keys())
-            for key in keys[start_index:end_index + 1]:
-                del image_store_sub4[key]
-        elif quiz_type == 900:
-            keys = list(image_store_appro.keys())
-            for key in keys[start_index:end_index + 1]:
-                del image_store_sub4[key]
-        else:
+        quiz = registry.get(quiz_type)
+        if quiz is None or quiz.image_store is None:
             raise ValueError("Invalid quiz type for deletion")
+        quiz.image_store.delete_range(start_index, end_index)
         
         return jsonify({"message": "Images deleted successfully"}), 200
     except Exception as e:
@@ -1,12 +1,16 @@
-import os
 import logging
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from PIL import Image
-import requests
-from io import BytesIO
-from openai import OpenAI
+from image_store import ImageStore
+from image_serving import send_image
+from image_utils import IMAGE_RESPONSE_FORMAT, fetch_image, image_source, render_image
+from llm_cache import discard_last_response
+from openai_client import client
+from rate_limit import RateLimitExceeded
+from structured_output import generate_structured, markdown_section, numbered_items, answer_number
+from concurrency import generate_concurrently, generate_images_concurrently
 import random
+from quiz_registry import register_quiz_type, OPTION_IMAGE_SIZE
 
 # Load environment variables
 load_dotenv()
@@ -15,34 +19,28 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Get OpenAI API key from environment variables
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    logger.error("OPENAI_API_KEY environment variable not set")
-    exit()
-
-# Initialize OpenAI client with API key
-client = OpenAI(api_key=openai_api_key)
-
 app = Flask(__name__)
 
-# In-memory storage for images
-image_store_appro = {}
-
-def download_and_resize_image(image_url, target_size):
-    """Download an image from the given URL, resize it, and store it in-memory."""
+# Disk-backed image storage shared by all workers
+image_store_appro = ImageStore("image_store_appro")
+
+# Structured answer for one question: a situation, two responses and which of them is least and most appropriate
+APPROPRIATE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "question_text": {"type": "string", "minLength": 1},
+        "options": {"type": "array", "items": {"type": "string", "minLength": 1}, "minItems": 2, "maxItems": 2, "uniqueItems": True},
+        "least_appropriate": {"type": "integer", "description": "Number of the least appropriate option", "minimum": 1, "maximum": 2},
+        "most_appropriate": {"type": "integer", "description": "Number of the most appropriate option", "minimum": 1, "maximum": 2}
+    },
+    "required": ["question_text", "options", "least_appropriate", "most_appropriate"],
+    "additionalProperties": False
+}
+
+def download_and_resize_image(source, target_size):
+    """Fetch a generated image, resize it, and store it in the image store."""
     try:
-        logger.info(f"Downloading image from URL: {image_url}")
-        response = requests.get(image_url)
-        response.raise_for_status()
-        image = Image.open(BytesIO(response.content))
-        resized_image = image.resize(target_size, Image.LANCZOS)
-        output = BytesIO()
-        resized_image.save(output, format='PNG')
-        output.seek(0)
-        image_key = f"image_{len(image_store_appro) + 1}.png"
-        image_store_appro[image_key] = output
-        return image_key
+        return image_store_appro.add(*render_image(fetch_image(source), target_size))
     except Exception as e:
         logger.error(f"Error resizing image: {e}")
         return None
@@ -56,25 +54,40 @@ def generate_image(prompt: str):
             model="dall-e-3",
             prompt=safe_prompt,
             n=1,
-            size="1024x1024"
+            size="1024x1024",
+            response_format=IMAGE_RESPONSE_FORMAT
         )
-        return response.data[0].url
+        return image_source(response.data[0])
+    except RateLimitExceeded:
+        # Fail the whole request with 429 instead of serving placeholder images
+        raise
     except Exception as e:
         logger.error(f"Error generating image: {e}")
         return None
 
-def generate_image_options(prompts):
-    """Generate multiple images based on a list of prompts."""
+def generate_image_options(prompts, target_size=OPTION_IMAGE_SIZE):
+    """Generate, download and resize multiple images concurrently based on a list of prompts."""
+    image_keys = generate_images_concurrently(prompts, target_size, generate_image, download_and_resize_image)
     options = []
-    for prompt in prompts:
-        image_url = generate_image(prompt)
-        if image_url:
-            options.append(image_url)
+    for prompt, image_key in zip(prompts, image_keys):
+        if image_key:
+            options.append(image_key)
         else:
             logger.error(f"Failed to generate image for prompt: {prompt}")
             options.append("placeholder_image_url")
     return options
 
+def parse_appropriate_markdown(content):
+    """Parse the **Question Text:**/**Options:**/**Correct Answers:** format with its Least/Most Appropriate lines."""
+    options = numbered_items(markdown_section(content, "Options", "Correct Answers"))
+    correct_answers = {}
+    for line in markdown_section(content, "Correct Answers").split('\n'):
+        if 'Least Appropriate' in line:
+            correct_answers['least_appropriate'] = answer_number(line.split(': ')[1], options)
+        elif 'Most Appropriate' in line:
+            correct_answers['most_appropriate'] = answer_number(line.split(': ')[1], options)
+    return {"question_text": markdown_section(content, "Question Text", "Options"), "options": options, **correct_answers}
+
 def generate_mcq_with_image_options(subject: str, tone: str):
     """Generate a multiple-choice question with images as options based on the subject."""
     description_prompt = [
@@ -83,68 +96,40 @@ def generate_mcq_with_image_options(subject: str, tone: str):
     ]
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=description_prompt,
-            max_tokens=1000,
-            temperature=0.5
-        )
-        content = response.choices[0].message.content.strip()
-
-        # Extract question, options, and correct answers
-        question_text = content.split("**Question Text:**")[1].split("**Options:**")[0].strip()
-        options_section = content.split("**Options:**")[1].split("**Correct Answers:**")[0].strip()
-        correct_answers_text = content.split("**Correct Answers:**")[1].strip()
-
-        # Parse options
-        options = [option.split('. ')[1] for option in options_section.split('\n') if option.strip()]
-        correct_answers = {}
-        for line in correct_answers_text.split('\n'):
-            if 'Least Appropriate' in line:
-                correct_answers['least_appropriate'] = line.split(': ')[1].strip()
-            elif 'Most Appropriate' in line:
-                correct_answers['most_appropriate'] = line.split(': ')[1].strip()
-
-        if len(options) != 2:
-            logger.error(f"Invalid number of options: {len(options)}")
-            return {"error": "Invalid number of options"}, 500
-
-        # Generate images for each option
-        option_images = generate_image_options(options)
-        if "placeholder_image_url" in option_images:
-            return {"error": "Failed to generate some images"}, 500
+        mcq = generate_structured(description_prompt, APPROPRIATE_SCHEMA, parse_appropriate_markdown)
+        options = mcq["options"]
+        least_appropriate, most_appropriate = mcq["least_appropriate"], mcq["most_appropriate"]
 
-        # Generate image filenames
-        question_images = []
-        for image_url in option_images:
-            image_key = download_and_resize_image(image_url, (270, 140)) if image_url != "placeholder_image_url" else "placeholder_image_url"
-            if image_key:
-                question_images.append(image_key)
+        # Generate, download and resize the images for each option
+        question_images = generate_image_options(options, OPTION_IMAGE_SIZE)
+        if "placeholder_image_url" in question_images:
+            return {"error": "Failed to generate some images"}, 500
 
         return {
-            "question_text": question_text,
+            "question_text": mcq["question_text"],
             "options": [
                 {
-                    "least_appropriate": options[0] == correct_answers.get('least_appropriate', ''),
-                    "most_appropriate": options[0] == correct_answers.get('most_appropriate', ''),
+                    "least_appropriate": least_appropriate == 1,
+                    "most_appropriate": most_appropriate == 1,
                     "option_id": "A",
                     "text": options[0]
                 },
                 {
-                    "least_appropriate": options[1] == correct_answers.get('least_appropriate', ''),
-                    "most_appropriate": options[1] == correct_answers.get('most_appropriate', ''),
+                    "least_appropriate": least_appropriate == 2,
+                    "most_appropriate": most_appropriate == 2,
                     "option_id": "B",
                     "text": options[1]
                 }
             ],
             "question_images": question_images,
             "correct_answers": {
-                "least_appropriate": "B" if options[1] == correct_answers.get('least_appropriate', '') else "A",
-                "most_appropriate": "A" if options[0] == correct_answers.get('most_appropriate', '') else "B"
+                "least_appropriate": "AB"[least_appropriate - 1],
+                "most_appropriate": "AB"[most_appropriate - 1]
             }
         }
     except Exception as e:
         logger.error(f"Error generating MCQ with image options: {e}")
+        discard_last_response()
         return {"error": "Failed to generate MCQ"}, 500
 
 def generate_custom_content_appro(number, subject, tone):
@@ -153,20 +138,26 @@ def generate_custom_content_appro(number, subject, tone):
         if number < 1 or number > 100:
             return {"error": "Number of questions must be between 1 and 100"}, 400
 
-        images_and_questions = []
-        for _ in range(number):
-            mcq_with_images = generate_mcq_with_image_options(subject, tone)
-            if "error" in mcq_with_images:
-                return {"error": "Failed to generate MCQ"}, 500
-
-            # Add to results
-            images_and_questions.append(mcq_with_images)
+        images_and_questions = generate_concurrently(generate_mcq_with_image_options, number, subject, tone)
+        # generate_mcq_with_image_options reports some failures as (error, status) tuples
+        if any(isinstance(item, tuple) or "error" in item for item in images_and_questions):
+            return {"error": "Failed to generate MCQ"}, 500
 
         return images_and_questions
     except Exception as e:
         logger.error(f"Error generating custom content: {e}")
         return {"error": "Internal server error"}, 500
 
+register_quiz_type(
+    900,
+    "Appropriate Radio with Image & Text Question",
+    generate_custom_content_appro,
+    max_questions=100,
+    image_store=image_store_appro,
+    image_sizes={"option": OPTION_IMAGE_SIZE},
+    schema=APPROPRIATE_SCHEMA
+)
+
 @app.route('/custom', methods=['POST'])
 def custom_content():
     """Endpoint to generate custom content based on user-provided parameters."""
@@ -215,10 +206,9 @@ def generate_content():
 
 @app.route('/image/<filename>')
 def serve_image(filename):
-    """Serve an image from the in-memory storage."""
+    """Serve an image from the image store."""
     if filename in image_store_appro:
-        image_data = image_store_appro[filename]
-        return send_file(BytesIO(image_data), mimetype='image/png')
+        return send_image(image_store_appro, filename)
     return jsonify({"error": "Image not found"}), 404
 
 
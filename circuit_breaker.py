@@ -0,0 +1,155 @@
+import os
+import time
+import logging
+import threading
+from dotenv import load_dotenv
+from rate_limit import RateLimitExceeded
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Stop calling the image API while it keeps failing, instead of making every request wait on it
+IMAGE_BREAKER_ENABLED = os.getenv("IMAGE_BREAKER_ENABLED", "1") == "1"
+
+# Consecutive failed image generations that open the breaker
+IMAGE_BREAKER_FAILURES = int(os.getenv("IMAGE_BREAKER_FAILURES", "5"))
+
+# Seconds the breaker stays open before one probe request is let through
+IMAGE_BREAKER_RESET = float(os.getenv("IMAGE_BREAKER_RESET", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a backend whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Per-process circuit breaker.
+
+    After failure_threshold consecutive failures the breaker opens and calls fail
+    immediately with CircuitOpenError. Once reset_timeout seconds have passed, a
+    single probe call is let through (half-open). The breaker closes if the probe
+    succeeds and opens for another reset_timeout if it fails. API errors with a
+    status code in ignore_status (e.g. 400 for a rejected prompt) say nothing about
+    the backend's health and are not counted. Neither are exceptions of the types in
+    ignore_errors, raised before the backend was called at all.
+    """
+
+    def __init__(self, name, failure_threshold=IMAGE_BREAKER_FAILURES, reset_timeout=IMAGE_BREAKER_RESET,
+                 ignore_status=(), ignore_errors=()):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.ignore_status = ignore_status
+        self.ignore_errors = ignore_errors
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        """Return whether calls are currently being short-circuited (without claiming the probe)."""
+        with self._lock:
+            if self.state == OPEN:
+                return time.time() - self.opened_at < self.reset_timeout
+            return self.state == HALF_OPEN and self._probing
+
+    def _allow(self):
+        with self._lock:
+            if self.state == OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                logger.info(f"Circuit breaker {self.name} half-open, probing")
+            if self.state == CLOSED or (self.state == HALF_OPEN and not self._probing):
+                self._probing = self.state == HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def _record(self, success):
+        with self._lock:
+            self._probing = False
+            if success:
+                if self.state != CLOSED:
+                    logger.info(f"Circuit breaker {self.name} closed")
+                self.state = CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state == CLOSED:
+                    self.trips += 1
+                    logger.warning(f"Circuit breaker {self.name} opened after {self.failures} consecutive failures")
+                self.state = OPEN
+                self.opened_at = time.time()
+
+    def call(self, func, *args, **kwargs):
+        """Call func through the breaker, raising CircuitOpenError without calling it while open."""
+        if not self._allow():
+            raise CircuitOpenError(f"{self.name} is unavailable (circuit breaker open)")
+        try:
+            result = func(*args, **kwargs)
+        except self.ignore_errors:
+            with self._lock:
+                self._probing = False
+            raise
+        except Exception as e:
+            # An ignored status means the call got an answer, so the backend itself is up
+            self._record(getattr(e, "status_code", None) in self.ignore_status)
+            raise
+        self._record(True)
+        return result
+
+    def stats(self):
+        """Return the breaker's state and counters."""
+        with self._lock:
+            retry_in = self.reset_timeout - (time.time() - self.opened_at) if self.state == OPEN else 0
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "failure_threshold": self.failure_threshold,
+                "reset_timeout": self.reset_timeout,
+                "retry_in": round(max(0, retry_in), 1),
+                "trips": self.trips,
+                "rejected": self.rejected
+            }
+
+
+# Calls the local rate limiter turned away never reached the image API
+image_breaker = CircuitBreaker("image generation", ignore_status=(400,), ignore_errors=(RateLimitExceeded,))
+
+
+class CircuitBreakerImages:
+    """Drop-in replacement for client.images that generates images through the breaker."""
+
+    def __init__(self, images, breaker):
+        self._images = images
+        self._breaker = breaker
+
+    def generate(self, **request):
+        if not IMAGE_BREAKER_ENABLED:
+            return self._images.generate(**request)
+        return self._breaker.call(self._images.generate, **request)
+
+    def __getattr__(self, name):
+        return getattr(self._images, name)
+
+
+class CircuitBreakerOpenAI:
+    """Wrap an OpenAI client so image generation goes through the image circuit breaker."""
+
+    def __init__(self, client, breaker=image_breaker):
+        self._client = client
+        self.images = CircuitBreakerImages(client.images, breaker)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
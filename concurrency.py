@@ -0,0 +1,275 @@
+import os
+import time
+import random
+import logging
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from dotenv import load_dotenv
+from progress import report
+from circuit_breaker import image_breaker
+from rate_limit import RateLimitExceeded
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Maximum number of OpenAI calls a single worker process keeps in flight
+MAX_IN_FLIGHT_REQUESTS = int(os.getenv("MAX_IN_FLIGHT_REQUESTS", "8"))
+
+# Maximum number of image generations/downloads a single worker process keeps in flight
+MAX_IN_FLIGHT_IMAGES = int(os.getenv("MAX_IN_FLIGHT_IMAGES", "8"))
+
+# Retries of a failed part of a question (its text or one image) before the question is given up
+REPAIR_ATTEMPTS = int(os.getenv("REPAIR_ATTEMPTS", "3"))
+
+# Base and cap, in seconds, of the exponential backoff between those retries
+REPAIR_BACKOFF_BASE = float(os.getenv("REPAIR_BACKOFF_BASE", "0.5"))
+REPAIR_BACKOFF_MAX = float(os.getenv("REPAIR_BACKOFF_MAX", "8"))
+
+
+class BoundedExecutor:
+    """Thread pool shared by every request in the process with a fixed in-flight limit."""
+
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._local = threading.local()
+
+    def _run(self, func, item):
+        self._local.in_worker = True
+        try:
+            return func(item)
+        finally:
+            self._local.in_worker = False
+
+    def submit(self, func, *args):
+        """Schedule func(*args) on the pool and return a Future for its result."""
+        if getattr(self._local, "in_worker", False):
+            future = Future()
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        # Run in a copy of the caller's context so progress tracking follows the task
+        context = contextvars.copy_context()
+        return self._executor.submit(context.run, self._run, lambda _: func(*args), None)
+
+    def map(self, func, items):
+        """Call func on every item concurrently and return the results in input order."""
+        items = list(items)
+        # A task that fans out again on its own pool would wait on itself once the pool is full
+        if len(items) <= 1 or getattr(self._local, "in_worker", False):
+            return [func(item) for item in items]
+
+        futures = [self._executor.submit(contextvars.copy_context().run, self._run, func, item) for item in items]
+        return [future.result() for future in futures]
+
+
+def _copy_result(source, target):
+    """Complete target with the outcome of the finished Future source."""
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+class SingleFlight:
+    """Runs one call per key at a time; callers asking for a key that is already in flight share its result."""
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def submit(self, key, func, *args):
+        """Schedule func(*args) on the executor unless key is already in flight, returning the shared Future."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.shared += 1
+                return future
+            future = Future()
+            self._calls[key] = future
+        future.add_done_callback(lambda done: self._forget(key, done))
+        # Submitted outside the lock, as the executor runs the task inline when called from one of its workers
+        self.executor.submit(func, *args).add_done_callback(lambda done: _copy_result(done, future))
+        return future
+
+    def do(self, key, func, *args):
+        """Call func(*args) in this thread unless key is already in flight, in which case wait for that call."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._forget(key, future)
+
+
+question_executor = BoundedExecutor("question-worker", MAX_IN_FLIGHT_REQUESTS)
+image_executor = BoundedExecutor("image-worker", MAX_IN_FLIGHT_IMAGES)
+# Streamed responses generate one question per task here, so each task can still fan out on question_executor
+stream_executor = BoundedExecutor("stream-worker", MAX_IN_FLIGHT_REQUESTS)
+# Identical images requested while one is being generated share that generation instead of calling the API again
+image_flights = SingleFlight(image_executor)
+
+
+def generate_concurrently(func, number, *args):
+    """Call func(*args) number times in parallel and return the results in a stable order."""
+    logger.info(f"Generating {number} items with {func.__name__} ({question_executor.max_workers} in flight)")
+    report(questions_total=number)
+
+    def generate_one(_):
+        try:
+            return func(*args)
+        finally:
+            report(questions_done=1)
+
+    return question_executor.map(generate_one, range(number))
+
+
+def _store_image(prompt, target_size, generate_image, download_and_resize_image):
+    source = generate_image(prompt)
+    if not source:
+        return None
+    return download_and_resize_image(source, target_size)
+
+
+def generate_and_store_image(prompt, target_size, generate_image, download_and_resize_image):
+    """Generate one image and resize/store it as soon as it arrives."""
+    report(images_total=1)
+    try:
+        return _store_image(prompt, target_size, generate_image, download_and_resize_image)
+    finally:
+        report(images_done=1)
+
+
+def submit_image(prompt, target_size, generate_image, download_and_resize_image):
+    """Start generating and storing an image in the background and return a Future for its key.
+
+    A request for the same prompt and size in the same store while one is still
+    running gets that request's Future.
+    """
+    return image_flights.submit(
+        (prompt, target_size, download_and_resize_image),
+        generate_and_store_image, prompt, target_size, generate_image, download_and_resize_image
+    )
+
+
+def generate_images_concurrently(prompts, target_size, generate_image, download_and_resize_image):
+    """Generate and store one image per prompt in parallel, returning the image keys in prompt order.
+
+    Each image is resized and stored as soon as it arrives rather than after the
+    whole batch; failed images are returned as None.
+    """
+    return image_executor.map(
+        lambda prompt: generate_and_store_image(prompt, target_size, generate_image, download_and_resize_image),
+        prompts
+    )
+
+
+def backoff_delay(attempt):
+    """Return a full-jitter exponential backoff delay for retry number attempt (counting from 0)."""
+    return random.uniform(0, min(REPAIR_BACKOFF_MAX, REPAIR_BACKOFF_BASE * 2 ** attempt))
+
+
+def retry_with_backoff(func, *args, attempts=REPAIR_ATTEMPTS, breaker=None):
+    """Call func(*args) until it returns something other than None, retrying up to attempts times.
+
+    Exceptions count as failed attempts; returns None once the retries are used up,
+    or straight away while breaker (the circuit breaker of the backend func calls)
+    is open.
+    """
+    for attempt in range(attempts + 1):
+        if attempt:
+            if breaker is not None and breaker.is_open():
+                logger.warning(f"Not retrying {func.__name__} while {breaker.name} is unavailable")
+                return None
+            time.sleep(backoff_delay(attempt - 1))
+        try:
+            result = func(*args)
+        except RateLimitExceeded:
+            raise
+        except Exception as e:
+            logger.warning(f"{func.__name__} failed (attempt {attempt + 1} of {attempts + 1}): {e}")
+            continue
+        if result is not None:
+            return result
+    return None
+
+
+def generate_image_with_retry(prompt, target_size, generate_image, download_and_resize_image, attempts=REPAIR_ATTEMPTS):
+    """Generate and store one image, retrying with backoff unless the image circuit breaker opens.
+
+    Counts as a single image in the progress totals however many attempts it takes.
+    """
+    report(images_total=1)
+    try:
+        return retry_with_backoff(
+            _store_image, prompt, target_size, generate_image, download_and_resize_image,
+            attempts=attempts, breaker=image_breaker
+        )
+    finally:
+        report(images_done=1)
+
+
+def generate_images_with_repair(prompts, target_size, generate_image, download_and_resize_image, attempts=REPAIR_ATTEMPTS):
+    """Generate and store one image per prompt, re-requesting only the images that failed.
+
+    Failed images are retried together, with backoff, up to attempts times; the
+    images that did succeed are kept. Returns the image keys in prompt order, with
+    None for images that still failed. Each image counts once in the progress totals.
+    """
+    report(images_total=len(prompts))
+    stored = []
+
+    def store(prompt):
+        image_key = _store_image(prompt, target_size, generate_image, download_and_resize_image)
+        if image_key:
+            stored.append(image_key)
+            report(images_done=1)
+        return image_key
+
+    try:
+        image_keys = image_executor.map(store, prompts)
+        for attempt in range(attempts):
+            failed = [index for index, image_key in enumerate(image_keys) if not image_key]
+            if not failed:
+                break
+            if image_breaker.is_open():
+                logger.warning(f"Not retrying {len(failed)} of {len(prompts)} images while image generation is unavailable")
+                break
+            time.sleep(backoff_delay(attempt))
+            logger.info(f"Retrying {len(failed)} of {len(prompts)} images (retry {attempt + 1} of {attempts})")
+            retried = image_executor.map(store, [prompts[index] for index in failed])
+            for index, image_key in zip(failed, retried):
+                image_keys[index] = image_key
+        return image_keys
+    finally:
+        # Images that were given up on are done too
+        report(images_done=len(prompts) - len(stored))
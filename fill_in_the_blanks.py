@@ -1,8 +1,8 @@
-import os
 import logging
 from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from openai import OpenAI
+from structured_output import stream_batched, StructuredOutputError, markdown_section
+from quiz_registry import register_quiz_type
 
 # Load environment variables
 load_dotenv()
@@ -11,43 +11,38 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Get OpenAI API key from environment variables
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    logger.error("OPENAI_API_KEY environment variable not set")
-    exit()
-
-# Initialize OpenAI client with API key
-client = OpenAI(api_key=openai_api_key)
-
 app = Flask(__name__)
 
-def generate_fill_in_the_blank(subject: str, tone: str):
-    """Generate a fill-in-the-blank question with corresponding answers."""
-    description_prompt = [
+# Structured answer for one question
+FILL_IN_THE_BLANK_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "question": {"type": "string", "minLength": 1, "description": "Question with blanks represented by '_______'"},
+        "answer": {"type": "string", "minLength": 1, "description": "Comma-separated correct answers, in blank order"}
+    },
+    "required": ["question", "answer"],
+    "additionalProperties": False
+}
+
+def parse_fill_in_the_blank_markdown(content):
+    """Parse the **Question:**/**Answers:** format."""
+    return {
+        "question": markdown_section(content, "Question", "Answers"),
+        "answer": markdown_section(content, "Answers")
+    }
+
+def fill_in_the_blank_prompt(subject: str, tone: str):
+    """Build the prompt for a fill-in-the-blank question with corresponding answers."""
+    return [
         {"role": "system", "content": "You are an expert in generating educational content."},
         {"role": "user", "content": f"Generate a fill-in-the-blank question with corresponding answers based on the subject '{subject}'. The question should have multiple blanks and provide the correct answers as a comma-separated list. Use the following format:\n\n**Question:** [Question with blanks represented by '_______']\n\n**Answers:** [Comma-separated correct answers]\n\nEnsure that the question is clear and understandable."}
     ]
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=description_prompt,
-            max_tokens=1000,
-            temperature=0.5
-        )
-        content = response.choices[0].message.content
-
-        question_section = content.split("**Question:**")[1].split("**Answers:**")[0].strip()
-        answers_section = content.split("**Answers:**")[1].strip()
-
-        return {
-            "question": question_section,
-            "answer": answers_section
-        }
-    except Exception as e:
-        logger.error(f"Error generating fill-in-the-blank question: {e}")
-        return {"error": "Failed to generate fill-in-the-blank question"}
+def stream_quiz1(number, subject, tone):
+    """Yield the fill-in-the-blank questions one at a time, as soon as the batch each one arrived in has been validated."""
+    return stream_batched(
+        fill_in_the_blank_prompt(subject, tone), FILL_IN_THE_BLANK_SCHEMA, parse_fill_in_the_blank_markdown, number
+    )
 
 def generate_quiz1(number, subject, tone):
     """Generate custom content based on user-provided parameters."""
@@ -55,18 +50,24 @@ def generate_quiz1(number, subject, tone):
         if number < 1 or number > 10:  # Ensure number is within allowed range
             return {"error": "Number of questions must be between 1 and 10"}, 400
 
-        questions = []
-        for _ in range(number):
-            question = generate_fill_in_the_blank(subject, tone)
-            if "error" in question:
-                return {"error": "Failed to generate fill-in-the-blank question"}, 500
-            questions.append(question)
-
-        return questions
+        try:
+            return list(stream_quiz1(number, subject, tone))
+        except StructuredOutputError as e:
+            logger.error(f"Error generating fill-in-the-blank questions: {e}")
+            return {"error": "Failed to generate fill-in-the-blank question"}, 500
     except Exception as e:
         logger.error(f"Error generating custom content: {e}")
         return {"error": "Internal server error"}, 500
 
+register_quiz_type(
+    300,
+    "Fill In The Blank with drag and drop feature",
+    generate_quiz1,
+    max_questions=10,
+    schema=FILL_IN_THE_BLANK_SCHEMA,
+    stream=stream_quiz1
+)
+
 @app.route('/custom', methods=['POST'])
 def custom_content():
     """Endpoint to generate custom content based on user-provided parameters."""
@@ -0,0 +1,189 @@
+import os
+import glob
+import hashlib
+import logging
+import tempfile
+import threading
+from dotenv import load_dotenv
+from image_utils import render_image
+from concurrency import image_flights
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Cache configuration
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "quiz_image_cache"))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# Serve subject images from the cache instead of asking DALL-E for a new one
+IMAGE_CACHE_REUSE_SUBJECT_IMAGES = os.getenv("IMAGE_CACHE_REUSE_SUBJECT_IMAGES", "1") == "1"
+
+
+class ImageCache:
+    """On-disk cache of resized PNG bytes keyed by (prompt, target size), evicted LRU by total bytes.
+
+    Next to each PNG it remembers the key the rendering was last stored under in
+    each image store, together with when it was stored, so a hit can hand out that
+    key instead of storing the image again. Keys restart when an image store's index
+    is recreated, so a key is only handed out while the index still dates it the same.
+    """
+
+    def __init__(self, directory=IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, prompt, target_size):
+        digest = hashlib.sha256(f"{target_size[0]}x{target_size[1]}|{prompt}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.png")
+
+    def _key_path(self, prompt, target_size, image_store):
+        return f"{os.path.splitext(self._path(prompt, target_size))[0]}.{image_store.namespace}.key"
+
+    def get_key(self, prompt, target_size, image_store):
+        """Return the key prompt at target_size is still stored under in image_store, or None."""
+        try:
+            with open(self._key_path(prompt, target_size, image_store), encoding="utf-8") as f:
+                image_key, _, created_at = f.read().strip().partition(" ")
+            created_at = float(created_at)
+        except (OSError, ValueError):
+            return None
+        if image_store.created_at(image_key) != created_at:
+            return None
+
+        try:
+            # A hit counts as a use of the rendering, so LRU eviction keeps it
+            os.utime(self._path(prompt, target_size))
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        logger.info(f"Image cache hit for prompt: {prompt} (stored as {image_key})")
+        return image_key
+
+    def put_key(self, prompt, target_size, image_store, image_key):
+        """Remember that prompt at target_size is stored under image_key in image_store."""
+        created_at = image_store.created_at(image_key)
+        if created_at is None:
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(f"{image_key} {created_at!r}")
+            os.replace(tmp_path, self._key_path(prompt, target_size, image_store))
+        except OSError as e:
+            logger.error(f"Error writing image cache key: {e}")
+
+    def get(self, prompt, target_size):
+        """Return the cached PNG bytes for prompt at target_size, or None."""
+        path = self._path(prompt, target_size)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # The modification time doubles as the last-used time for LRU eviction
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        logger.info(f"Image cache hit for prompt: {prompt}")
+        return data
+
+    def put(self, prompt, target_size, data):
+        """Store PNG bytes for prompt at target_size and evict old entries beyond the byte budget."""
+        path = self._path(prompt, target_size)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Error writing image cache entry: {e}")
+            return
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            try:
+                entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".png")]
+                stats = sorted(((entry.stat(), entry.path) for entry in entries), key=lambda item: item[0].st_mtime)
+            except OSError as e:
+                logger.error(f"Error scanning image cache: {e}")
+                return
+
+            total = sum(stat.st_size for stat, _ in stats)
+            for stat, path in stats:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                for key_path in glob.glob(f"{os.path.splitext(path)[0]}.*.key"):
+                    try:
+                        os.remove(key_path)
+                    except OSError:
+                        pass
+                total -= stat.st_size
+                self.evictions += 1
+                logger.info(f"Evicted cached image {os.path.basename(path)}")
+
+    def stats(self):
+        """Return hit/miss/eviction counters."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+image_cache = ImageCache()
+
+
+def cached_image(prompt, target_size, generate, image_store):
+    """Return an image key for prompt, going through the image cache around generate().
+
+    generate() produces and stores a fresh image and returns its key. When subject
+    image reuse is enabled a cached rendering is served without calling it, and
+    concurrent calls for the same prompt share a single generation; otherwise the
+    cache is only used as a fallback when generation fails.
+    """
+    if IMAGE_CACHE_REUSE_SUBJECT_IMAGES:
+        return image_flights.do(
+            (prompt, target_size, image_store.namespace), _cached_image, prompt, target_size, generate, image_store
+        )
+    return _cached_image(prompt, target_size, generate, image_store)
+
+
+def _store_cached(prompt, target_size, image_store):
+    """Store the cached rendering of prompt in image_store and return its key, or None if nothing is cached."""
+    cached = image_cache.get(prompt, target_size)
+    if cached is None:
+        return None
+    image_key = image_store.add(*render_image(cached, target_size))
+    image_cache.put_key(prompt, target_size, image_store, image_key)
+    return image_key
+
+
+def _cached_image(prompt, target_size, generate, image_store):
+    if IMAGE_CACHE_REUSE_SUBJECT_IMAGES:
+        # The image and its variants are usually still stored; only re-render once they were evicted
+        image_key = image_cache.get_key(prompt, target_size, image_store) or _store_cached(prompt, target_size, image_store)
+        if image_key:
+            return image_key
+
+    image_key = generate()
+    if image_key and image_key != "placeholder_image_url":
+        image_cache.put(prompt, target_size, image_store.read(image_key))
+        image_cache.put_key(prompt, target_size, image_store, image_key)
+        return image_key
+
+    # Fall back to an earlier rendering of the same prompt
+    return _store_cached(prompt, target_size, image_store) or image_key
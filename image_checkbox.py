@@ -1,12 +1,19 @@
-import os
 import logging
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from PIL import Image
-import requests
-from io import BytesIO
-from openai import OpenAI
+from image_store import ImageStore
+from image_serving import send_image
+from image_utils import IMAGE_RESPONSE_FORMAT, fetch_image, image_source, render_image
+from llm_cache import discard_last_response
+from openai_client import client
+from rate_limit import RateLimitExceeded
+from structured_output import generate_structured, choice_schema, parse_checkbox_markdown
+from image_cache import cached_image
+from concurrency import (
+    generate_concurrently, generate_image_with_retry, generate_images_with_repair, retry_with_backoff, image_executor
+)
 import random
+from quiz_registry import register_quiz_type, QUESTION_IMAGE_SIZE, OPTION_IMAGE_SIZE
 
 # Load environment variables
 load_dotenv()
@@ -15,40 +22,24 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Get OpenAI API key from environment variables
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    logger.error("OPENAI_API_KEY environment variable not set")
-    exit()
-
-# Initialize OpenAI client with API key
-client = OpenAI(api_key=openai_api_key)
-
 app = Flask(__name__)
 
-# In-memory storage for images
-image_store_checkbox1 = {}
+# Disk-backed image storage shared by all workers
+image_store_checkbox1 = ImageStore("image_store_checkbox1")
 
-def download_and_resize_image(image_url, target_size):
-    """Download an image from the given URL, resize it, and store it in-memory."""
+# Structured answer for one question: four option descriptions and up to four correct option numbers
+CHECKBOX_SCHEMA = choice_schema(4, max_correct=4)
+
+def download_and_resize_image(source, target_size):
+    """Fetch a generated image, resize it, and store it in the image store."""
     try:
-        logger.info(f"Downloading image from URL: {image_url}")
-        response = requests.get(image_url)
-        response.raise_for_status()
-        image = Image.open(BytesIO(response.content))
-        resized_image = image.resize(target_size, Image.LANCZOS)
-        output = BytesIO()
-        resized_image.save(output, format='PNG')
-        output.seek(0)
-        image_key = f"image_{len(image_store_checkbox1) + 1}.png"
-        image_store_checkbox1[image_key] = output
-        return image_key
+        return image_store_checkbox1.add(*render_image(fetch_image(source), target_size))
     except Exception as e:
         logger.error(f"Error resizing image: {e}")
         return None
 
-def generate_image(prompt: str, retries: int = 3):
-    """Generate an image using the DALL-E model from OpenAI, with retry logic."""
+def generate_image(prompt: str):
+    """Generate an image using the DALL-E model from OpenAI."""
     try:
         logger.info(f"Generating image with prompt: {prompt}")
         safe_prompt = f"An illustration of {prompt} in a simple, neutral style"
@@ -56,16 +47,15 @@ def generate_image(prompt: str, retries: int = 3):
             model="dall-e-3",
             prompt=safe_prompt,
             n=1,
-            size="1024x1024"
+            size="1024x1024",
+            response_format=IMAGE_RESPONSE_FORMAT
         )
-        return response.data[0].url if response.data else None
+        return image_source(response.data[0]) if response.data else None
+    except RateLimitExceeded:
+        # Fail the whole request with 429 instead of serving placeholder images
+        raise
     except Exception as e:
         logger.error(f"Error generating image: {e}")
-        if retries > 0:
-            logger.info(f"Retrying image generation, {retries} retries left.")
-            # Modify prompt slightly for retry
-            modified_prompt = f"{prompt}, in a different style"
-            return generate_image(modified_prompt, retries - 1)
         return None
 
 def generate_mcq_with_image_options(subject: str, tone: str):
@@ -76,42 +66,27 @@ def generate_mcq_with_image_options(subject: str, tone: str):
     ]
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=description_prompt,
-            max_tokens=1000,
-            temperature=0.5
-        )
-        content = response.choices[0].message.content
+        # Only the question text is requested again if neither response matched the schema
+        mcq = retry_with_backoff(generate_structured, description_prompt, CHECKBOX_SCHEMA, parse_checkbox_markdown)
+        if mcq is None:
+            return {"error": "Failed to generate MCQ"}
+        question_section = mcq["question"]
+        option_prompts = mcq["options"]
 
-        question_section = content.split("**Question:**")[1].split("**Options:**")[0].strip()
-        options_section = content.split("**Options:**")[1].split("**Correct Answers:**")[0].strip()
-        correct_answers_section = content.split("**Correct Answers:**")[1].strip()
-
-        options = options_section.split('\n')
-        if len(options) != 4:
-            raise ValueError("Generated options do not contain exactly 4 items")
-
-        option_prompts = [option.split('. ', 1)[1].strip() for option in options]
-        
         # Extracting correct answer indices
-        correct_answer_indices = [int(index.strip()) - 1 for index in correct_answers_section.split(',')]
-        
-        # Ensure the number of correct answers is between 2 and 4
+        correct_answer_indices = [number - 1 for number in mcq["correct_answers"]]
+
+        # Ensure the number of correct answers is at least 2
         if len(correct_answer_indices) < 2:
             additional_indices = list(set(range(4)) - set(correct_answer_indices))
             correct_answer_indices += random.sample(additional_indices, 2 - len(correct_answer_indices))
-        elif len(correct_answer_indices) > 4:
-            correct_answer_indices = random.sample(correct_answer_indices, 4)
-        
+
         correct_answers = [option_prompts[i] for i in correct_answer_indices]
 
+        # Failed option images are retried on their own, keeping the question and the other images
         option_images = generate_image_options(option_prompts)
-
-        # If image generation failed, retry with a new question
-        if len(option_images) != 4 or "placeholder_image_url" in option_images:
-            logger.warning("Not all option images were generated successfully. Retrying with a new question.")
-            return generate_mcq_with_image_options(subject, tone)  # Retry with a new question
+        if "placeholder_image_url" in option_images:
+            return {"error": "Failed to generate MCQ"}
 
         options_and_images = list(zip(option_prompts, option_images))
         random.shuffle(options_and_images)
@@ -125,68 +100,78 @@ def generate_mcq_with_image_options(subject: str, tone: str):
         return {
             "question": question_section,
             "options": {
-                f"Option {i+1}": img for i, img in enumerate(shuffled_option_images)
+                f"Option {i+1}": f"/image/{img}" for i, img in enumerate(shuffled_option_images)
             },
             "correct_answers": shuffled_correct_answers
         }
     except Exception as e:
         logger.error(f"Error generating MCQ with image options: {e}")
+        discard_last_response()
         return {"error": "Failed to generate MCQ"}
 
-def generate_image_options(prompts):
-    """Generate multiple images based on a list of prompts."""
+def generate_image_options(prompts, target_size=OPTION_IMAGE_SIZE):
+    """Generate, download and resize multiple images concurrently, retrying only the ones that fail."""
+    image_keys = generate_images_with_repair(prompts, target_size, generate_image, download_and_resize_image)
     options = []
-    for prompt in prompts:
-        image_url = generate_image(prompt)
-        if image_url:
-            options.append(image_url)
+    for prompt, image_key in zip(prompts, image_keys):
+        if image_key:
+            options.append(image_key)
         else:
             logger.error(f"Failed to generate image for prompt: {prompt}")
             options.append("placeholder_image_url")
     return options
 
+def generate_question_image(image_prompt):
+    """Generate and store the question image, retrying with backoff if no image could be stored."""
+    question_image_key = generate_image_with_retry(image_prompt, QUESTION_IMAGE_SIZE, generate_image, download_and_resize_image)
+    return question_image_key or "placeholder_image_url"
+
+def generate_cached_question_image(image_prompt):
+    """Return the question image for the prompt, reusing a cached rendering when allowed."""
+    return cached_image(
+        image_prompt, QUESTION_IMAGE_SIZE, lambda: generate_question_image(image_prompt),
+        image_store_checkbox1
+    )
+
+def generate_question_with_image(subject, tone):
+    """Generate one checkbox question together with its question image."""
+    # The question image does not depend on the question text, so generate it alongside
+    image_prompt = f"High-quality, detailed illustration representing the subject: {subject} in a {tone} tone"
+    question_image = image_executor.submit(generate_cached_question_image, image_prompt)
+
+    mcq_with_images = generate_mcq_with_image_options(subject, tone)
+    question_image_key = question_image.result()
+    if "error" in mcq_with_images:
+        return mcq_with_images
+
+    mcq_with_images["question_image_url"] = f"/image/{question_image_key}"
+    return mcq_with_images
+
 def generate_custom_content_checkbox1(number, subject, tone):
     """Generate custom content based on user-provided parameters with retries."""
     try:
         if number < 1 or number > 10:  # Ensure number is within allowed range
             return {"error": "Number of questions must be between 1 and 10"}, 400
 
-        images_and_questions = []
-        for _ in range(number):
-            image_prompt = f"High-quality, detailed illustration representing the subject: {subject} in a {tone} tone"
-            question_image_url = generate_image(image_prompt)
-            
-            # Retry logic if placeholder image URL is set
-            if question_image_url == "placeholder_image_url":
-                question_image_url = generate_image(image_prompt + " illustration", retries=1)
-            
-            if not question_image_url:
-                question_image_url = "placeholder_image_url"
-
-            mcq_with_images = generate_mcq_with_image_options(subject, tone)
-            if "error" in mcq_with_images:
-                return {"error": "Failed to generate MCQ"}, 500
-
-            mcq_with_images["question_image_url"] = question_image_url
-            images_and_questions.append(mcq_with_images)
-
-        for item in images_and_questions:
-            question_image_url = item["question_image_url"]
-            question_image_key = download_and_resize_image(question_image_url, (750, 319)) if question_image_url != "placeholder_image_url" else "placeholder_image_url"
-            if question_image_key:
-                item["question_image_url"] = f"/image/{question_image_key}"
-
-            for option_key in item["options"]:
-                option_image_url = item["options"][option_key]
-                option_image_key = download_and_resize_image(option_image_url, (270, 140)) if option_image_url != "placeholder_image_url" else "placeholder_image_url"
-                if option_image_key:
-                    item["options"][option_key] = f"/image/{option_image_key}"
+        images_and_questions = generate_concurrently(generate_question_with_image, number, subject, tone)
+        if any("error" in item for item in images_and_questions):
+            return {"error": "Failed to generate MCQ"}, 500
 
         return images_and_questions
     except Exception as e:
         logger.error(f"Error generating custom content: {e}")
         return {"error": "Internal server error"}, 500
 
+register_quiz_type(
+    602,
+    "Image Checkbox with Image Question",
+    generate_custom_content_checkbox1,
+    max_questions=10,
+    image_store=image_store_checkbox1,
+    image_sizes={"question": QUESTION_IMAGE_SIZE, "option": OPTION_IMAGE_SIZE},
+    schema=CHECKBOX_SCHEMA
+)
+
 @app.route('/custom', methods=['POST'])
 def custom_content():
     """Endpoint to generate custom content based on user-provided parameters."""
@@ -223,45 +208,21 @@ def generate_content():
         if num_questions < 1 or num_questions > 10:
             return jsonify({"error": "Number of questions must be between 1 and 10"}), 400
 
-        images_and_questions = []
-        for _ in range(num_questions):
-            image_prompt = f"High-quality, detailed illustration representing the subject: {subject} in a {tone} tone"
-            question_image_url = generate_image(image_prompt)
-            if not question_image_url:
-                question_image_url = "placeholder_image_url"
-
-            mcq_with_images = generate_mcq_with_image_options(subject, tone)
-            if "error" in mcq_with_images:
-                return jsonify(mcq_with_images), 500
-
-            mcq_with_images["question_image_url"] = question_image_url
-            images_and_questions.append(mcq_with_images)
-
-        for item in images_and_questions:
-            question_image_url = item["question_image_url"]
-            question_image_key = download_and_resize_image(question_image_url, (750, 319)) if question_image_url != "placeholder_image_url" else "placeholder_image_url"
-            if question_image_key:
-                item["question_image_url"] = f"/image/{question_image_key}"
-
-            for option_key in item["options"]:
-                option_image_url = item["options"][option_key]
-                option_image_key = download_and_resize_image(option_image_url, (270, 140)) if option_image_url != "placeholder_image_url" else "placeholder_image_url"
-                if option_image_key:
-                    item["options"][option_key] = f"/image/{option_image_key}"
-
-        return jsonify(images_and_questions)
+        result = generate_custom_content_checkbox1(num_questions, subject, tone)
+
+        if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], dict) and 'error' in result[0]:
+            return jsonify(result[0]), result[1]
+
+        return jsonify(result)
     except Exception as e:
         logger.error(f"Error generating content: {e}")
         return jsonify({"error": "Internal server error"}), 500
 
 @app.route('/image/<image_key>', methods=['GET'])
 def get_image(image_key):
-    """Serve an image from in-memory storage."""
+    """Serve an image from the image store."""
     if image_key in image_store_checkbox1:
-        return send_file(
-            BytesIO(image_store_checkbox1[image_key].getvalue()),
-            mimetype='image/png'
-        )
+        return send_image(image_store_checkbox1, image_key)
     else:
         logger.error(f"Image with key {image_key} not found")
         return jsonify({"error": "Image not found"}), 404
\ No newline at end of file
@@ -1,11 +1,11 @@
-import os
 import logging
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from openai import OpenAI
-import requests
-from io import BytesIO
-from PIL import Image
+from openai_client import client
+from rate_limit import RateLimitExceeded
+from image_store import ImageStore
+from image_serving import send_image
+from image_utils import IMAGE_RESPONSE_FORMAT, fetch_image, image_source, render_image
 import random 
 
 # Load environment variables
@@ -17,51 +17,33 @@ app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Get OpenAI API key from environment variables
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    logger.error("OPENAI_API_KEY environment variable not set")
-
-# Initialize OpenAI client with API key
-client = OpenAI(api_key=openai_api_key)
-
-# In-memory storage for images
-image_store = {}
+# Disk-backed image storage shared by all workers
+image_store = ImageStore("image_store")
 
 def generate_image(prompt: str):
     """Generate an image using DALL-E 3 based on a given prompt."""
     try:
         logger.info(f"Generating image with prompt: {prompt}")
-        response = client.images.generate(model="dall-e-3", prompt=prompt, n=1, size="1024x1024")
-        image_url = response.data[0].url
-        logger.info(f"Generated image URL: {image_url}")
-        return image_url
+        response = client.images.generate(
+            model="dall-e-3", prompt=prompt, n=1, size="1024x1024", response_format=IMAGE_RESPONSE_FORMAT
+        )
+        logger.info(f"Generated image for prompt: {prompt}")
+        return image_source(response.data[0])
+    except RateLimitExceeded:
+        # Fail the whole request with 429 instead of serving placeholder images
+        raise
     except Exception as e:
         logger.error(f"Error generating image: {e}")
         return None
 
-def download_and_resize_image(image_url, target_size):
-    """Download and resize the image from the given URL."""
+def download_and_resize_image(source, target_size):
+    """Fetch and resize a generated image."""
     try:
-        logger.info(f"Downloading image from URL: {image_url}")
-        response = requests.get(image_url)
-        response.raise_for_status()
-        image = Image.open(BytesIO(response.content))
-
-        original_size = image.size
-        logger.info(f"Original image size: {original_size}")
-
-        resized_image = image.resize(target_size, Image.LANCZOS)
-        resized_size = resized_image.size
-        logger.info(f"Resized image size: {resized_size}")
-
-        output = BytesIO()
-        resized_image.save(output, format='PNG')
-        output.seek(0)
+        resized_image, variants = render_image(fetch_image(source), target_size)
+        logger.info(f"Resized image to {target_size}")
 
-        # Generate a unique key for storing the image in memory
-        image_key = f"image_{len(image_store) + 1}.png"
-        image_store[image_key] = output
+        # Generate a unique key for storing the image
+        image_key = image_store.add(resized_image, variants)
 
         return image_key
     except Exception as e:
@@ -108,10 +90,10 @@ def generate_content():
 
 @app.route('/image/<image_key>', methods=['GET'])
 def get_image(image_key):
-    """Serve images stored in memory."""
+    """Serve images from the image store."""
     if image_key in image_store:
         logger.info(f"Serving image with key: {image_key}")
-        return send_file(BytesIO(image_store[image_key].getvalue()), mimetype='image/png')
+        return send_image(image_store, image_key)
     else:
         logger.error(f"Image with key {image_key} not found")
         return jsonify({"error": "Image not found"}), 404
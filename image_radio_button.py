@@ -1,12 +1,16 @@
-import os
 import logging
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from PIL import Image
-import requests
-from io import BytesIO
-from openai import OpenAI
+from image_store import ImageStore
+from image_serving import send_image
+from image_utils import IMAGE_RESPONSE_FORMAT, fetch_image, image_source, render_image
+from llm_cache import discard_last_response
+from openai_client import client
+from rate_limit import RateLimitExceeded
+from structured_output import generate_structured, choice_schema, parse_choice_markdown
+from concurrency import generate_concurrently, generate_images_with_repair, retry_with_backoff
 import random
+from quiz_registry import register_quiz_type, OPTION_IMAGE_SIZE
 
 # Load environment variables
 load_dotenv()
@@ -15,34 +19,18 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Get OpenAI API key from environment variables
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    logger.error("OPENAI_API_KEY environment variable not set")
-    exit()
-
-# Initialize OpenAI client with API key
-client = OpenAI(api_key=openai_api_key)
-
 app = Flask(__name__)
 
-# In-memory storage for images
-image_store_radio = {}
+# Disk-backed image storage shared by all workers
+image_store_radio = ImageStore("image_store_radio")
+
+# Structured answer for one question: four option descriptions and exactly one correct option number
+MCQ_SCHEMA = choice_schema(4)
 
-def download_and_resize_image(image_url, target_size):
-    """Download an image from the given URL, resize it, and store it in-memory."""
+def download_and_resize_image(source, target_size):
+    """Fetch a generated image, resize it, and store it in the image store."""
     try:
-        logger.info(f"Downloading image from URL: {image_url}")
-        response = requests.get(image_url)
-        response.raise_for_status()
-        image = Image.open(BytesIO(response.content))
-        resized_image = image.resize(target_size, Image.LANCZOS)
-        output = BytesIO()
-        resized_image.save(output, format='PNG')
-        output.seek(0)
-        image_key = f"image_{len(image_store_radio) + 1}.png"
-        image_store_radio[image_key] = output
-        return image_key
+        return image_store_radio.add(*render_image(fetch_image(source), target_size))
     except Exception as e:
         logger.error(f"Error resizing image: {e}")
         return None
@@ -56,20 +44,24 @@ def generate_image(prompt: str):
             model="dall-e-3",
             prompt=safe_prompt,
             n=1,
-            size="1024x1024"
+            size="1024x1024",
+            response_format=IMAGE_RESPONSE_FORMAT
         )
-        return response.data[0].url
+        return image_source(response.data[0])
+    except RateLimitExceeded:
+        # Fail the whole request with 429 instead of serving placeholder images
+        raise
     except Exception as e:
         logger.error(f"Error generating image: {e}")
         return None
 
-def generate_image_options(prompts):
-    """Generate multiple images based on a list of prompts."""
+def generate_image_options(prompts, target_size=OPTION_IMAGE_SIZE):
+    """Generate, download and resize multiple images concurrently, retrying only the ones that fail."""
+    image_keys = generate_images_with_repair(prompts, target_size, generate_image, download_and_resize_image)
     options = []
-    for prompt in prompts:
-        image_url = generate_image(prompt)
-        if image_url:
-            options.append(image_url)
+    for prompt, image_key in zip(prompts, image_keys):
+        if image_key:
+            options.append(image_key)
         else:
             logger.error(f"Failed to generate image for prompt: {prompt}")
             options.append("placeholder_image_url")
@@ -83,57 +75,43 @@ def generate_mcq_with_image_options(subject: str, tone: str):
     ]
 
     try:
-        while True:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=description_prompt,
-                max_tokens=1000,
-                temperature=0.5
-            )
-            content = response.choices[0].message.content.strip()
-
-            # Extract question, options, and correct answer
-            question_section = content.split("**Question:**")[1].split("**Options:**")[0].strip()
-            options_section = content.split("**Options:**")[1].split("**Correct Answer:**")[0].strip()
-            correct_answer_text = content.split("**Correct Answer:**")[1].strip()  # Extract only the answer text
-
-            # Parse options
-            options = [option.split('. ')[1] for option in options_section.split('\n') if option.strip()]
-            if len(options) != 4:
-                continue  # Retry if the generated options do not contain exactly 4 items
-
-            logger.info(f"Generated options: {options}")
-            logger.info(f"Correct answer: {correct_answer_text}")
-
-            # Check if the correct answer is in the list of options
-            if correct_answer_text not in options:
-                continue  # Retry if the correct answer is not in the list of generated options
-
-            # Generate images for each option
-            option_images = generate_image_options(options)
-            if "placeholder_image_url" in option_images:
-                continue  # Retry if any placeholder images are present
-
-            # Shuffle options and images
-            correct_answer_index = options.index(correct_answer_text)
-            options_and_images = list(zip(options, option_images))
-            random.shuffle(options_and_images)
-            shuffled_options, shuffled_images = zip(*options_and_images)
-
-            correct_answer_shuffled_index = shuffled_options.index(correct_answer_text)
-
-            return {
-                "question": question_section,
-                "options": {
-                    "option1": shuffled_images[0],
-                    "option2": shuffled_images[1],
-                    "option3": shuffled_images[2],
-                    "option4": shuffled_images[3]
-                },
-                "correct_answer": f"option{correct_answer_shuffled_index + 1}"
-            }
+        # Only the question text is requested again if neither response matched the schema
+        mcq = retry_with_backoff(generate_structured, description_prompt, MCQ_SCHEMA, parse_choice_markdown)
+        if mcq is None:
+            return {"error": "Failed to generate MCQ"}
+        question_section = mcq["question"]
+        options = mcq["options"]
+        correct_answer_text = options[mcq["correct_answers"][0] - 1]
+
+        logger.info(f"Generated options: {options}")
+        logger.info(f"Correct answer: {correct_answer_text}")
+
+        # Generate images for each option, keeping the question if some of them have to be retried
+        option_images = generate_image_options(options)
+        if "placeholder_image_url" in option_images:
+            return {"error": "Failed to generate MCQ"}
+
+        # Shuffle options and images
+        correct_answer_index = options.index(correct_answer_text)
+        options_and_images = list(zip(options, option_images))
+        random.shuffle(options_and_images)
+        shuffled_options, shuffled_images = zip(*options_and_images)
+
+        correct_answer_shuffled_index = shuffled_options.index(correct_answer_text)
+
+        return {
+            "question": question_section,
+            "options": {
+                "option1": f"/image/{shuffled_images[0]}",
+                "option2": f"/image/{shuffled_images[1]}",
+                "option3": f"/image/{shuffled_images[2]}",
+                "option4": f"/image/{shuffled_images[3]}"
+            },
+            "correct_answer": f"option{correct_answer_shuffled_index + 1}"
+        }
     except Exception as e:
         logger.error(f"Error generating MCQ with image options: {e}")
+        discard_last_response()
         return {"error": "Failed to generate MCQ"}
 
 def generate_custom_content_radio(number, subject, tone):
@@ -142,26 +120,25 @@ def generate_custom_content_radio(number, subject, tone):
         if number < 1 or number > 100:
             return {"error": "Number of questions must be between 1 and 100"}, 400
 
-        images_and_questions = []
-        for _ in range(number):
-            mcq_with_images = generate_mcq_with_image_options(subject, tone)
-            if "error" in mcq_with_images:
-                return {"error": "Failed to generate MCQ"}, 500
-
-            # Resize option images
-            for option_key in mcq_with_images["options"]:
-                option_image_url = mcq_with_images["options"][option_key]
-                option_image_key = download_and_resize_image(option_image_url, (270, 140)) if option_image_url != "placeholder_image_url" else "placeholder_image_url"
-                if option_image_key:
-                    mcq_with_images["options"][option_key] = f"/image/{option_image_key}"
-
-            images_and_questions.append(mcq_with_images)
+        images_and_questions = generate_concurrently(generate_mcq_with_image_options, number, subject, tone)
+        if any("error" in item for item in images_and_questions):
+            return {"error": "Failed to generate MCQ"}, 500
 
         return images_and_questions
     except Exception as e:
         logger.error(f"Error generating custom content: {e}")
         return {"error": "Internal server error"}, 500
 
+register_quiz_type(
+    701,
+    "Image Radio Button",
+    generate_custom_content_radio,
+    max_questions=100,
+    image_store=image_store_radio,
+    image_sizes={"option": OPTION_IMAGE_SIZE},
+    schema=MCQ_SCHEMA
+)
+
 @app.route('/custom', methods=['POST'])
 def custom_content():
     """Endpoint to generate custom content based on user-provided parameters."""
@@ -210,11 +187,9 @@ def generate_content():
 
 @app.route('/image/<filename>')
 def serve_image(filename):
-    """Serve an image from the in-memory storage."""
+    """Serve an image from the image store."""
     if filename in image_store_radio:
-        image_data = BytesIO(image_store_radio[filename])
-        image_data.seek(0)
-        return send_file(image_data, mimetype='image/png')
+        return send_image(image_store_radio, filename)
     return jsonify({"error": "Image not found"}), 404
 
 
@@ -0,0 +1,87 @@
+import os
+import hashlib
+import logging
+import functools
+from flask import current_app, request, send_file
+from dotenv import load_dotenv
+from image_utils import FORMAT_MIMETYPES, image_formats
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds browsers and proxies may cache an image before revalidating it against its ETag
+IMAGE_CACHE_MAX_AGE = int(os.getenv("IMAGE_CACHE_MAX_AGE", str(60 * 60)))
+
+# Internal nginx location aliased to IMAGE_STORE_DIR; when set nginx sends the image files itself
+IMAGE_ACCEL_REDIRECT_PREFIX = os.getenv("IMAGE_ACCEL_REDIRECT_PREFIX", "")
+
+
+@functools.lru_cache(maxsize=4096)
+def _content_etag(path, mtime_ns, size):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:32]
+
+
+def content_etag(path):
+    """Return a strong ETag derived from the file's contents, hashing each file once per worker."""
+    stat = os.stat(path)
+    return _content_etag(path, stat.st_mtime_ns, stat.st_size)
+
+
+def accepted_formats(accept_mimetypes):
+    """Return the stored formats the client explicitly accepts, best first, ending with PNG.
+
+    Wildcards are not taken as support for newer formats, so clients that only
+    send */* keep getting PNG.
+    """
+    qualities = {value: quality for value, quality in accept_mimetypes}
+    formats = [fmt for fmt in image_formats if qualities.get(FORMAT_MIMETYPES[fmt], 0) > 0]
+    # Stable sort keeps the IMAGE_FORMATS order between equally weighted formats
+    formats.sort(key=lambda fmt: -qualities[FORMAT_MIMETYPES[fmt]])
+    return formats + ["png"]
+
+
+def send_image(store, image_key):
+    """Serve image_key from store in the size (?size=) and format (Accept) the request asks for.
+
+    Responses carry a content-hash ETag and a max-age after which clients
+    revalidate. Keys are not content-addressed (they can come back after the store
+    is wiped), so responses are never marked immutable. send_file answers
+    If-None-Match with 304 and Range requests with 206.
+    """
+    path, fmt = store.resolve(image_key, request.args.get('size'), accepted_formats(request.accept_mimetypes))
+    if IMAGE_ACCEL_REDIRECT_PREFIX:
+        response = accel_redirect(store, path, fmt)
+    else:
+        response = send_file(
+            path,
+            mimetype=FORMAT_MIMETYPES[fmt],
+            conditional=True,
+            etag=content_etag(path),
+            max_age=IMAGE_CACHE_MAX_AGE
+        )
+    response.vary.add('Accept')
+    return response
+
+
+def accel_redirect(store, path, fmt):
+    """Answer with an empty X-Accel-Redirect response so nginx streams the file with sendfile.
+
+    Conditional requests are still answered here with 304; nginx handles Range.
+    """
+    response = current_app.response_class(mimetype=FORMAT_MIMETYPES[fmt])
+    location = os.path.relpath(path, store.root).replace(os.sep, "/")
+    response.headers['X-Accel-Redirect'] = f"{IMAGE_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{location}"
+    response.set_etag(content_etag(path))
+    if IMAGE_CACHE_MAX_AGE > 0:
+        response.cache_control.public = True
+        response.cache_control.max_age = IMAGE_CACHE_MAX_AGE
+    response = response.make_conditional(request)
+    if response.status_code == 304:
+        # nginx would follow the redirect and send the body anyway
+        del response.headers['X-Accel-Redirect']
+    return response
@@ -0,0 +1,338 @@
+import os
+import time
+import logging
+import sqlite3
+import tempfile
+import threading
+from io import BytesIO
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Directory shared by every gunicorn worker; one sub-directory per image store plus the shared index. Keep it
+# somewhere persistent: keys are only unique while the index survives, and clients and jobs keep them.
+# nginx reads the images straight from here when IMAGE_ACCEL_REDIRECT_PREFIX is set
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "/var/cache/quiz_image_store")
+
+# mkstemp always creates 0600 files; images get the permissions the process umask grants (gunicorn -m 007
+# makes them readable by the www-data group, so nginx can send them)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+IMAGE_FILE_MODE = 0o666 & ~_UMASK
+
+# Per-store byte budget; least recently served images are evicted beyond it
+IMAGE_STORE_MAX_BYTES = int(os.getenv("IMAGE_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Seconds an image is kept after it was generated (0 keeps images until evicted by size)
+IMAGE_STORE_TTL = int(os.getenv("IMAGE_STORE_TTL", str(7 * 24 * 60 * 60)))
+
+# Seconds between eviction sweeps of a store
+IMAGE_STORE_SWEEP_INTERVAL = int(os.getenv("IMAGE_STORE_SWEEP_INTERVAL", "30"))
+
+# Serving an image only refreshes its last-served time once per this many seconds
+LAST_SERVED_RESOLUTION = 60
+
+
+class ImageStore:
+    """Dict-like PNG store backed by files on local disk, shared by all worker processes.
+
+    Values are returned as BytesIO objects like the old module dicts, and path()
+    lets routes hand the file straight to send_file so the server can use sendfile.
+    A SQLite index next to the files hands out keys from a never-reused sequence
+    (image_<seq>.png) and keeps them ordered, so ranges, prefixes and pages can be
+    read or deleted without listing the whole store. Variants of an image (other
+    sizes such as thumbnails, other encodings such as WebP) live next to it as
+    image_<seq>[@<size>].<format> and are counted, evicted and deleted with it.
+    """
+
+    def __init__(self, namespace, directory=IMAGE_STORE_DIR, max_bytes=IMAGE_STORE_MAX_BYTES,
+                 ttl=IMAGE_STORE_TTL, sweep_interval=IMAGE_STORE_SWEEP_INTERVAL):
+        self.namespace = namespace
+        self.root = directory
+        self.directory = os.path.join(directory, namespace)
+        self.db_path = os.path.join(directory, "index.db")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.evictions = 0
+        self._added_bytes = 0
+        self._last_sweep = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self._init_db()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def _init_db(self):
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT NOT NULL, key TEXT NOT NULL, "
+                "size INTEGER NOT NULL, created_at REAL NOT NULL, last_served REAL NOT NULL, "
+                "variants TEXT NOT NULL DEFAULT '', UNIQUE (namespace, key))"
+            )
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(images)")]
+            if "variants" not in columns:
+                connection.execute("ALTER TABLE images ADD COLUMN variants TEXT NOT NULL DEFAULT ''")
+            connection.execute("CREATE INDEX IF NOT EXISTS images_namespace_seq ON images (namespace, seq)")
+            connection.execute("CREATE INDEX IF NOT EXISTS images_last_served ON images (namespace, last_served)")
+
+    def _path(self, key):
+        if os.path.basename(key) != key or key.startswith("."):
+            raise KeyError(key)
+        return os.path.join(self.directory, key)
+
+    @staticmethod
+    def _variant_suffix(size, fmt):
+        return f"{'@' + size if size else ''}.{fmt}"
+
+    @staticmethod
+    def _variant_key(key, suffix):
+        return os.path.splitext(key)[0] + suffix
+
+    def _remove_files(self, rows):
+        """Remove the files of (key, variants) rows returned by a DELETE."""
+        for key, variants in rows:
+            names = [key] + [self._variant_key(key, suffix) for suffix in variants.split(",") if suffix]
+            for name in names:
+                try:
+                    os.remove(self._path(name))
+                except (FileNotFoundError, KeyError):
+                    pass
+
+    def resolve(self, key, size=None, formats=("png",)):
+        """Return (path, format) of the best stored variant of key and mark it as recently served.
+
+        The requested size is preferred over the format order in formats; unknown
+        sizes fall back to the image itself and PNG is always available.
+        """
+        path = self._path(key)
+        if not os.path.isfile(path):
+            raise KeyError(key)
+        fmt = "png"
+        candidates = [(candidate_size, candidate_fmt)
+                      for candidate_size in ([size, None] if size else [None])
+                      for candidate_fmt in [*formats, "png"]]
+        for candidate_size, candidate_fmt in candidates:
+            if (candidate_size, candidate_fmt) == (None, "png"):
+                break
+            try:
+                candidate = self._path(self._variant_key(key, self._variant_suffix(candidate_size, candidate_fmt)))
+            except KeyError:
+                continue
+            if os.path.isfile(candidate):
+                path, fmt = candidate, candidate_fmt
+                break
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE images SET last_served = ? WHERE namespace = ? AND key = ? AND last_served < ?",
+                (now, self.namespace, key, now - LAST_SERVED_RESOLUTION)
+            )
+        return path, fmt
+
+    def path(self, key, size=None):
+        """Return the PNG file path holding key (or one of its sizes) and mark it as recently served."""
+        return self.resolve(key, size)[0]
+
+    def _write_tmp(self, value):
+        # getbuffer() is a view of the BytesIO, so nothing is copied before the write
+        data = value.getbuffer() if isinstance(value, BytesIO) else value
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.fchmod(fd, IMAGE_FILE_MODE)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return tmp_path, data.nbytes if isinstance(data, memoryview) else len(data)
+
+    def _maybe_sweep(self, size):
+        """Sweep after enough time has passed or enough bytes were added since the last sweep."""
+        with self._lock:
+            self._added_bytes += size
+            due = (time.time() - self._last_sweep > self.sweep_interval
+                   or self._added_bytes > self.max_bytes // 10)
+            if not due:
+                return
+            self._added_bytes = 0
+            self._last_sweep = time.time()
+        self.sweep()
+
+    def sweep(self):
+        """Drop expired images, then the least recently served ones until the store fits its budget."""
+        with self._connect() as connection:
+            expired = []
+            if self.ttl:
+                expired = connection.execute(
+                    "DELETE FROM images WHERE namespace = ? AND created_at < ? RETURNING key, variants",
+                    (self.namespace, time.time() - self.ttl)
+                ).fetchall()
+            over_budget = connection.execute(
+                "DELETE FROM images WHERE seq IN ("
+                "SELECT seq FROM (SELECT seq, SUM(size) OVER (ORDER BY last_served DESC, seq DESC) AS running "
+                "FROM images WHERE namespace = ?) WHERE running > ?) RETURNING key, variants",
+                (self.namespace, self.max_bytes)
+            ).fetchall()
+
+        evicted = expired + over_budget
+        self._remove_files(evicted)
+        with self._lock:
+            self.evictions += len(evicted)
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} images from {self.namespace}")
+
+    def add(self, value, variants=None):
+        """Store PNG bytes (or a BytesIO) under a new image_<seq>.png key and return the key.
+
+        variants optionally maps (size name or None, format) to bytes stored alongside it.
+        """
+        variants = {self._variant_suffix(size, fmt): data for (size, fmt), data in (variants or {}).items()}
+        tmp_paths = {}
+        try:
+            tmp_path, size = self._write_tmp(value)
+            tmp_paths[None] = tmp_path
+            for suffix, data in variants.items():
+                tmp_paths[suffix], variant_size = self._write_tmp(data)
+                size += variant_size
+            now = time.time()
+            # The sequence is shared by every worker and never reuses a deleted number
+            with self._connect() as connection:
+                seq = connection.execute(
+                    "INSERT INTO images (namespace, key, size, created_at, last_served, variants) "
+                    "VALUES (?, '', ?, ?, ?, ?)",
+                    (self.namespace, size, now, now, ",".join(variants))
+                ).lastrowid
+                image_key = f"image_{seq}.png"
+                connection.execute("UPDATE images SET key = ? WHERE seq = ?", (image_key, seq))
+            # Variants first, so the image never appears without them
+            for suffix in variants:
+                os.replace(tmp_paths.pop(suffix), self._path(self._variant_key(image_key, suffix)))
+            os.replace(tmp_paths.pop(None), self._path(image_key))
+        except Exception:
+            for tmp_path in tmp_paths.values():
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            raise
+
+        self._maybe_sweep(size)
+        return image_key
+
+    def __setitem__(self, key, value):
+        path = self._path(key)
+        tmp_path, size = self._write_tmp(value)
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO images (namespace, key, size, created_at, last_served) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET size = excluded.size, "
+                "created_at = excluded.created_at, last_served = excluded.last_served, variants = ''",
+                (self.namespace, key, size, now, now)
+            )
+        os.replace(tmp_path, path)
+        self._maybe_sweep(size)
+
+    def read(self, key):
+        """Return the stored bytes of key."""
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def __getitem__(self, key):
+        return BytesIO(self.read(key))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def created_at(self, key):
+        """Return when key was stored according to the index, or None if it is not stored."""
+        if key not in self:
+            return None
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT created_at FROM images WHERE namespace = ? AND key = ?", (self.namespace, key)
+            ).fetchone()
+        return row[0] if row else None
+
+    def __contains__(self, key):
+        try:
+            return os.path.isfile(self._path(key))
+        except KeyError:
+            return False
+
+    def __delitem__(self, key):
+        with self._connect() as connection:
+            deleted = connection.execute(
+                "DELETE FROM images WHERE namespace = ? AND key = ? RETURNING key, variants", (self.namespace, key)
+            ).fetchall()
+        if not deleted:
+            raise KeyError(key)
+        self._remove_files(deleted)
+
+    def page(self, offset=0, limit=None):
+        """Return up to limit keys in insertion order, starting at position offset."""
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT key FROM images WHERE namespace = ? ORDER BY seq LIMIT ? OFFSET ?",
+                (self.namespace, -1 if limit is None else limit, offset)
+            ).fetchall()
+        return [key for key, in rows]
+
+    def keys(self):
+        """Return the stored keys in insertion order."""
+        return self.page()
+
+    def delete_range(self, start_index, end_index):
+        """Delete the images at insertion-order positions start_index..end_index (inclusive)."""
+        with self._connect() as connection:
+            deleted = connection.execute(
+                "DELETE FROM images WHERE seq IN ("
+                "SELECT seq FROM images WHERE namespace = ? ORDER BY seq LIMIT ? OFFSET ?) RETURNING key, variants",
+                (self.namespace, end_index - start_index + 1, start_index)
+            ).fetchall()
+        self._remove_files(deleted)
+        return len(deleted)
+
+    def delete_prefix(self, prefix):
+        """Delete every image whose key starts with prefix."""
+        with self._connect() as connection:
+            # A half-open key range lets SQLite use the (namespace, key) index
+            deleted = connection.execute(
+                "DELETE FROM images WHERE namespace = ? AND key >= ? AND key < ? RETURNING key, variants",
+                (self.namespace, prefix, prefix + "\U0010ffff")
+            ).fetchall()
+        self._remove_files(deleted)
+        return len(deleted)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        with self._connect() as connection:
+            return connection.execute(
+                "SELECT COUNT(*) FROM images WHERE namespace = ?", (self.namespace,)
+            ).fetchone()[0]
+
+    def stats(self):
+        """Return the current size, image count and this worker's eviction count."""
+        with self._connect() as connection:
+            count, size = connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images WHERE namespace = ?", (self.namespace,)
+            ).fetchone()
+        return {
+            "bytes": size,
+            "count": count,
+            "evictions": self.evictions,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl
+        }
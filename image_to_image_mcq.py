@@ -1,12 +1,17 @@
-import os
 import logging
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from PIL import Image
-import requests
-from io import BytesIO
-from openai import OpenAI
+from image_store import ImageStore
+from image_serving import send_image
+from image_utils import IMAGE_RESPONSE_FORMAT, fetch_image, image_source, render_image
+from llm_cache import discard_last_response
+from openai_client import client
+from rate_limit import RateLimitExceeded
+from structured_output import generate_structured, choice_schema, parse_choice_markdown
+from image_cache import cached_image
+from concurrency import generate_concurrently, generate_images_concurrently, generate_and_store_image, image_executor
 import random
+from quiz_registry import register_quiz_type, QUESTION_IMAGE_SIZE, OPTION_IMAGE_SIZE
 
 # Load environment variables
 load_dotenv()
@@ -15,34 +20,18 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Get OpenAI API key from environment variables
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    logger.error("OPENAI_API_KEY environment variable not set")
-    exit()
-
-# Initialize OpenAI client with API key
-client = OpenAI(api_key=openai_api_key)
-
 app = Flask(__name__)
 
-# In-memory storage for images
-image_store_imcq = {}
+# Disk-backed image storage shared by all workers
+image_store_imcq = ImageStore("image_store_imcq")
+
+# Structured answer for one question: four option descriptions and exactly one correct option number
+MCQ_SCHEMA = choice_schema(4)
 
-def download_and_resize_image(image_url, target_size):
-    """Download an image from the given URL, resize it, and store it in-memory."""
+def download_and_resize_image(source, target_size):
+    """Fetch a generated image, resize it, and store it in the image store."""
     try:
-        logger.info(f"Downloading image from URL: {image_url}")
-        response = requests.get(image_url)
-        response.raise_for_status()
-        image = Image.open(BytesIO(response.content))
-        resized_image = image.resize(target_size, Image.LANCZOS)
-        output = BytesIO()
-        resized_image.save(output, format='PNG')
-        output.seek(0)
-        image_key = f"image_{len(image_store_imcq) + 1}.png"
-        image_store_imcq[image_key] = output
-        return image_key
+        return image_store_imcq.add(*render_image(fetch_image(source), target_size))
     except Exception as e:
         logger.error(f"Error resizing image: {e}")
         return None
@@ -56,20 +45,24 @@ def generate_image(prompt: str):
             model="dall-e-3",
             prompt=safe_prompt,
             n=1,
-            size="1024x1024"
+            size="1024x1024",
+            response_format=IMAGE_RESPONSE_FORMAT
         )
-        return response.data[0].url
+        return image_source(response.data[0])
+    except RateLimitExceeded:
+        # Fail the whole request with 429 instead of serving placeholder images
+        raise
     except Exception as e:
         logger.error(f"Error generating image: {e}")
         return None
 
-def generate_image_options(prompts):
-    """Generate multiple images based on a list of prompts."""
+def generate_image_options(prompts, target_size=OPTION_IMAGE_SIZE):
+    """Generate, download and resize multiple images concurrently based on a list of prompts."""
+    image_keys = generate_images_concurrently(prompts, target_size, generate_image, download_and_resize_image)
     options = []
-    for prompt in prompts:
-        image_url = generate_image(prompt)
-        if image_url:
-            options.append(image_url)
+    for prompt, image_key in zip(prompts, image_keys):
+        if image_key:
+            options.append(image_key)
         else:
             logger.error(f"Failed to generate image for prompt: {prompt}")
             options.append("placeholder_image_url")
@@ -83,23 +76,9 @@ def generate_mcq_with_image_options(subject: str, tone: str):
     ]
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=description_prompt,
-            max_tokens=1000,
-            temperature=0.5
-        )
-        content = response.choices[0].message.content
-
-        question_section = content.split("**Question:**")[1].split("**Options:**")[0].strip()
-        options_section = content.split("**Options:**")[1].split("**Correct Answer:**")[0].strip()
-        correct_answer = content.split("**Correct Answer:**")[1].strip()
-
-        options = options_section.split('\n')
-        if len(options) != 4:
-            raise ValueError("Generated options do not contain exactly 4 items")
-
-        option_prompts = [option.split('. ')[1] for option in options]
+        mcq = generate_structured(description_prompt, MCQ_SCHEMA, parse_choice_markdown)
+        option_prompts = mcq["options"]
+        correct_answer = option_prompts[mcq["correct_answers"][0] - 1]
 
         option_images = generate_image_options(option_prompts)
 
@@ -107,60 +86,71 @@ def generate_mcq_with_image_options(subject: str, tone: str):
             logger.warning("Not all option images were generated successfully. Using placeholders.")
             option_images = ["placeholder_image_url" for _ in range(4)]
 
-        correct_answer_index = option_prompts.index(correct_answer)
-
         options_and_images = list(zip(option_prompts, option_images))
         random.shuffle(options_and_images)
         shuffled_option_prompts, shuffled_option_images = zip(*options_and_images)
 
         return {
-            "question": question_section,
+            "question": mcq["question"],
             "options": {
-                f"Option {i+1}": img for i, img in enumerate(shuffled_option_images)
+                f"Option {i+1}": f"/image/{img}" for i, img in enumerate(shuffled_option_images)
             },
             "correct_answer": f"Option {shuffled_option_prompts.index(correct_answer) + 1}"
         }
     except Exception as e:
         logger.error(f"Error generating MCQ with image options: {e}")
+        discard_last_response()
         return {"error": "Failed to generate MCQ"}
 
+def generate_question_image(image_prompt):
+    """Generate and store the question image, reusing a cached rendering of the same prompt when allowed."""
+    return cached_image(
+        image_prompt, QUESTION_IMAGE_SIZE,
+        lambda: generate_and_store_image(image_prompt, QUESTION_IMAGE_SIZE, generate_image, download_and_resize_image),
+        image_store_imcq
+    )
+
+def generate_question_with_image(subject, tone):
+    """Generate one question together with its question image."""
+    # The question image does not depend on the question text, so generate it alongside
+    image_prompt = f"High-quality, detailed illustration representing the subject: {subject} in a {tone} tone"
+    question_image = image_executor.submit(generate_question_image, image_prompt)
+
+    mcq_with_images = generate_mcq_with_image_options(subject, tone)
+    question_image_key = question_image.result()
+    if "error" in mcq_with_images:
+        return mcq_with_images
+
+    mcq_with_images["question_image_url"] = f"/image/{question_image_key or 'placeholder_image_url'}"
+    return mcq_with_images
+
 def generate_custom_content(number, subject, tone):
     """Generate custom content based on user-provided parameters."""
     try:
         if number < 1 or number > 100:
             return {"error": "Number of questions must be between 1 and 10"}, 400
 
-        images_and_questions = []
-        for _ in range(number):
-            image_prompt = f"High-quality, detailed illustration representing the subject: {subject} in a {tone} tone"
-            question_image_url = generate_image(image_prompt)
-            if not question_image_url:
-                question_image_url = "placeholder_image_url"
-
-            mcq_with_images = generate_mcq_with_image_options(subject, tone)
-            if "error" in mcq_with_images:
-                return {"error": "Failed to generate MCQ"}, 500
-
-            mcq_with_images["question_image_url"] = question_image_url
-            images_and_questions.append(mcq_with_images)
-
-        for item in images_and_questions:
-            question_image_url = item["question_image_url"]
-            question_image_key = download_and_resize_image(question_image_url, (750, 319)) if question_image_url != "placeholder_image_url" else "placeholder_image_url"
-            if question_image_key:
-                item["question_image_url"] = f"/image/{question_image_key}"
-
-            for option_key in item["options"]:
-                option_image_url = item["options"][option_key]
-                option_image_key = download_and_resize_image(option_image_url, (270, 140)) if option_image_url != "placeholder_image_url" else "placeholder_image_url"
-                if option_image_key:
-                    item["options"][option_key] = f"/image/{option_image_key}"
+        images_and_questions = generate_concurrently(generate_question_with_image, number, subject, tone)
+        if any("error" in item for item in images_and_questions):
+            return {"error": "Failed to generate MCQ"}, 500
 
         return images_and_questions
     except Exception as e:
         logger.error(f"Error generating custom content: {e}")
         return {"error": "Internal server error"}, 500
 
+# Listed as image_store by /list_all_images, as it always has been
+register_quiz_type(
+    600,
+    "Image Radio Button with Image Question",
+    generate_custom_content,
+    max_questions=100,
+    image_store=image_store_imcq,
+    image_sizes={"question": QUESTION_IMAGE_SIZE, "option": OPTION_IMAGE_SIZE},
+    list_name="image_store",
+    schema=MCQ_SCHEMA
+)
+
 @app.route('/custom', methods=['POST'])
 def custom_content():
     """Endpoint to generate custom content based on user-provided parameters."""
@@ -197,45 +187,21 @@ def generate_content():
         if num_questions < 1 or num_questions > 10:
             return jsonify({"error": "Number of questions must be between 1 and 10"}), 400
 
-        images_and_questions = []
-        for _ in range(num_questions):
-            image_prompt = f"High-quality, detailed illustration representing the subject: {subject} in a {tone} tone"
-            question_image_url = generate_image(image_prompt)
-            if not question_image_url:
-                question_image_url = "placeholder_image_url"
-
-            mcq_with_images = generate_mcq_with_image_options(subject, tone)
-            if "error" in mcq_with_images:
-                return jsonify(mcq_with_images), 500
-
-            mcq_with_images["question_image_url"] = question_image_url
-            images_and_questions.append(mcq_with_images)
-
-        for item in images_and_questions:
-            question_image_url = item["question_image_url"]
-            question_image_key = download_and_resize_image(question_image_url, (750, 319)) if question_image_url != "placeholder_image_url" else "placeholder_image_url"
-            if question_image_key:
-                item["question_image_url"] = f"/image/{question_image_key}"
-
-            for option_key in item["options"]:
-                option_image_url = item["options"][option_key]
-                option_image_key = download_and_resize_image(option_image_url, (270, 140)) if option_image_url != "placeholder_image_url" else "placeholder_image_url"
-                if option_image_key:
-                    item["options"][option_key] = f"/image/{option_image_key}"
-
-        return jsonify(images_and_questions)
+        result = generate_custom_content(num_questions, subject, tone)
+
+        if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], dict) and 'error' in result[0]:
+            return jsonify(result[0]), result[1]
+
+        return jsonify(result)
     except Exception as e:
         logger.error(f"Error generating content: {e}")
         return jsonify({"error": "Internal server error"}), 500
 
 @app.route('/image/<image_key>', methods=['GET'])
 def get_image(image_key):
-    """Serve an image from in-memory storage."""
+    """Serve an image from the image store."""
     if image_key in image_store_imcq:
-        return send_file(
-            BytesIO(image_store_imcq[image_key].getvalue()),
-            mimetype='image/png'
-        )
+        return send_image(image_store_imcq, image_key)
     else:
         logger.error(f"Image with key {image_key} not found")
         return jsonify({"error": "Image not found"}), 404
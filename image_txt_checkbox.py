@@ -1,11 +1,15 @@
-import os
 import logging
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from PIL import Image
-import requests
-from io import BytesIO
-from openai import OpenAI
+from image_store import ImageStore
+from image_serving import send_image
+from image_utils import IMAGE_RESPONSE_FORMAT, fetch_image, image_source, render_image
+from openai_client import client
+from rate_limit import RateLimitExceeded
+from structured_output import stream_batched, StructuredOutputError, choice_schema, markdown_section
+from image_cache import cached_image
+from concurrency import generate_and_store_image, image_executor
+from quiz_registry import register_quiz_type, QUESTION_IMAGE_SIZE
 
 # Load environment variables
 load_dotenv()
@@ -14,34 +18,18 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Get OpenAI API key from environment variables
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    logger.error("OPENAI_API_KEY environment variable not set")
-    exit()
-
-# Initialize OpenAI client with API key
-client = OpenAI(api_key=openai_api_key)
-
 app = Flask(__name__)
 
-# In-memory storage for images
-image_store11 = {}
+# Disk-backed image storage shared by all workers
+image_store11 = ImageStore("image_store11")
+
+# Structured answer for one question: four options and any number of correct option numbers
+CHECKBOX_SCHEMA = choice_schema(4, max_correct=4)
 
-def download_and_resize_image(image_url, target_size):
-    """Download an image from the given URL, resize it, and store it in-memory."""
+def download_and_resize_image(source, target_size):
+    """Fetch a generated image, resize it, and store it in the image store."""
     try:
-        logger.info(f"Downloading image from URL: {image_url}")
-        response = requests.get(image_url)
-        response.raise_for_status()
-        image = Image.open(BytesIO(response.content))
-        resized_image = image.resize(target_size, Image.LANCZOS)
-        output = BytesIO()
-        resized_image.save(output, format='PNG')
-        output.seek(0)
-        image_key = f"image_{len(image_store11) + 1}.png"
-        image_store11[image_key] = output
-        return image_key
+        return image_store11.add(*render_image(fetch_image(source), target_size))
     except Exception as e:
         logger.error(f"Error resizing image: {e}")
         return None
@@ -55,51 +43,60 @@ def generate_image(prompt: str):
             model="dall-e-3",
             prompt=safe_prompt,
             n=1,
-            size="1024x1024"
+            size="1024x1024",
+            response_format=IMAGE_RESPONSE_FORMAT
         )
-        return response.data[0].url
+        return image_source(response.data[0])
+    except RateLimitExceeded:
+        # Fail the whole request with 429 instead of serving placeholder images
+        raise
     except Exception as e:
         logger.error(f"Error generating image: {e}")
         return None
 
-def generate_mcq_with_checkboxes(subject: str, tone: str):
-    """Generate a multiple-choice question with checkboxes based on the subject."""
-    description_prompt = [
+def parse_checkbox_markdown(content):
+    """Parse the "- [ ] option" checkbox format, whose correct answers are given as "Option N"."""
+    options = markdown_section(content, "Options", "Correct Answers").split('\n')
+    correct_answers_section = markdown_section(content, "Correct Answers").split('\n')[0]
+    return {
+        "question": markdown_section(content, "Question", "Options"),
+        "options": [option.split('] ')[1] for option in options],
+        "correct_answers": [index + 1 for index in range(len(options)) if f"Option {index + 1}" in correct_answers_section]
+    }
+
+def mcq_prompt(subject: str, tone: str):
+    """Build the prompt for a multiple-choice question with checkboxes based on the subject."""
+    return [
         {"role": "system", "content": "You are an expert in generating educational content."},
         {"role": "user", "content": f"Generate a clear and understandable checkbox  question with exactly four checkbox options based on the subject '{subject}'. Each option should be related to the concept in the subject and in a '{tone}' tone. Ensure the correct answers are provided. Use the following format:\n\n**Question:** [Question based on the subject]\n\n**Options:**\n- [ ] [Option 1]\n- [ ] [Option 2]\n- [ ] [Option 3]\n- [ ] [Option 4]\n\n**Correct Answers:** [Correct Option Numbers, e.g., Option 1, Option 3, Option 1]\n\nEnsure that all four options are provided."}
     ]
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=description_prompt,
-            max_tokens=1000,
-            temperature=0.5
-        )
-        content = response.choices[0].message.content
-
-        question_section = content.split("**Question:**")[1].split("**Options:**")[0].strip()
-        options_section = content.split("**Options:**")[1].split("**Correct Answers:**")[0].strip()
-        correct_answers_section = content.split("**Correct Answers:**")[1].strip().split('\n')[0]
-
-        options = options_section.split('\n')
-        correct_answers_indices = [f"Option {index + 1}" for index, option in enumerate(options) if f"Option {index + 1}" in correct_answers_section]
-
-        if len(options) != 4:
-            raise ValueError("Generated options do not contain exactly 4 items")
-
-        option_prompts = [option.split('] ')[1] for option in options]
-
-        return {
-            "question": question_section,
-            "options": {
-                f"Option {i+1}": option for i, option in enumerate(option_prompts)
-            },
-            "correct_answers": correct_answers_indices
-        }
-    except Exception as e:
-        logger.error(f"Error generating MCQ with checkboxes: {e}")
-        return {"error": "Failed to generate MCQ"}
+def format_mcq(mcq):
+    """Return a structured checkbox question in the response format."""
+    return {
+        "question": mcq["question"],
+        "options": {
+            f"Option {i+1}": option for i, option in enumerate(mcq["options"])
+        },
+        "correct_answers": [f"Option {number}" for number in mcq["correct_answers"]]
+    }
+
+def generate_question_image(image_prompt):
+    """Generate and store the question image, reusing a cached rendering of the same prompt when allowed."""
+    return cached_image(
+        image_prompt, QUESTION_IMAGE_SIZE,
+        lambda: generate_and_store_image(image_prompt, QUESTION_IMAGE_SIZE, generate_image, download_and_resize_image),
+        image_store11
+    )
+
+def stream_custom_content11(number, subject, tone):
+    """Yield the questions one at a time, as soon as the batch each one arrived in has been validated."""
+    # The question images do not depend on the question text, so generate them alongside
+    image_prompt = f"High-quality, detailed illustration representing the subject: {subject} in a {tone} tone"
+    question_images = [image_executor.submit(generate_question_image, image_prompt) for _ in range(number)]
+
+    for mcq, question_image in zip(stream_batched(mcq_prompt(subject, tone), CHECKBOX_SCHEMA, parse_checkbox_markdown, number), question_images):
+        yield {**format_mcq(mcq), "question_image_url": f"/image/{question_image.result() or 'placeholder_image_url'}"}
 
 def generate_custom_content11(number, subject, tone):
     """Generate custom content based on user-provided parameters."""
@@ -107,31 +104,26 @@ def generate_custom_content11(number, subject, tone):
         if number < 1 or number > 100:
             return {"error": "Number of questions must be between 1 and 100"}, 400
 
-        images_and_questions = []
-        for _ in range(number):
-            image_prompt = f"High-quality, detailed illustration representing the subject: {subject} in a {tone} tone"
-            question_image_url = generate_image(image_prompt)
-            if not question_image_url:
-                question_image_url = "placeholder_image_url"
-
-            mcq_with_checkboxes = generate_mcq_with_checkboxes(subject, tone)
-            if "error" in mcq_with_checkboxes:
-                return {"error": "Failed to generate MCQ"}, 500
-
-            mcq_with_checkboxes["question_image_url"] = question_image_url
-            images_and_questions.append(mcq_with_checkboxes)
-
-        for item in images_and_questions:
-            question_image_url = item["question_image_url"]
-            question_image_key = download_and_resize_image(question_image_url, (750, 319)) if question_image_url != "placeholder_image_url" else "placeholder_image_url"
-            if question_image_key:
-                item["question_image_url"] = f"/image/{question_image_key}"
-
-        return images_and_questions
+        try:
+            return list(stream_custom_content11(number, subject, tone))
+        except StructuredOutputError as e:
+            logger.error(f"Error generating MCQ: {e}")
+            return {"error": "Failed to generate MCQ"}, 500
     except Exception as e:
         logger.error(f"Error generating custom content: {e}")
         return {"error": "Internal server error"}, 500
 
+register_quiz_type(
+    501,
+    "Simple Checkbox with Image Question",
+    generate_custom_content11,
+    max_questions=100,
+    image_store=image_store11,
+    image_sizes={"question": QUESTION_IMAGE_SIZE},
+    schema=CHECKBOX_SCHEMA,
+    stream=stream_custom_content11
+)
+
 @app.route('/custom', methods=['POST'])
 def custom_content():
     """Endpoint to generate custom content based on user-provided parameters."""
@@ -180,13 +172,9 @@ def generate_content():
 
 @app.route('/image/<image_key>', methods=['GET'])
 def get_image(image_key):
-    """Serve an image from in-memory storage."""
+    """Serve an image from the image store."""
     if image_key in image_store11:
-        return send_file(
-            BytesIO(image_store11[image_key].getvalue()),
-            mimetype='image/png'
-            
-        )
+        return send_image(image_store11, image_key)
     else:
         logger.error(f"Image with key {image_key} not found")
         return jsonify({"error": "Image not found"}), 404
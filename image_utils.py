@@ -0,0 +1,243 @@
+import os
+import base64
+import logging
+import threading
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import requests
+from PIL import Image, features
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# "b64_json" returns image bytes inside the generation response; "url" needs a second download
+IMAGE_RESPONSE_FORMAT = os.getenv("IMAGE_RESPONSE_FORMAT", "b64_json")
+
+# Keep-alive connections kept open per host for image downloads
+IMAGE_HTTP_POOL_SIZE = int(os.getenv("IMAGE_HTTP_POOL_SIZE", "16"))
+
+# Seconds to wait for a connection and between bytes of an image download
+IMAGE_HTTP_CONNECT_TIMEOUT = float(os.getenv("IMAGE_HTTP_CONNECT_TIMEOUT", "5"))
+IMAGE_HTTP_READ_TIMEOUT = float(os.getenv("IMAGE_HTTP_READ_TIMEOUT", "30"))
+
+# Downloads larger than this are abandoned instead of being buffered
+IMAGE_MAX_DOWNLOAD_BYTES = int(os.getenv("IMAGE_MAX_DOWNLOAD_BYTES", str(20 * 1024 * 1024)))
+
+# Processes per worker that resize and encode images (0 does the work on the calling thread); every gunicorn
+# worker gets its own, so keep this small
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", str(min(2, os.cpu_count() or 1))))
+
+# Extra renderings stored next to every image as name:scale pairs relative to its target size
+IMAGE_DERIVATIVES = os.getenv("IMAGE_DERIVATIVES", "thumb:0.5")
+
+# Shrink by whole factors with Image.reduce() until within this multiple of the target, then filter
+IMAGE_REDUCING_GAP = float(os.getenv("IMAGE_REDUCING_GAP", "2.0"))
+
+# Compact encodings stored next to every PNG, in order of preference (webp, avif, jpeg)
+IMAGE_FORMATS = os.getenv("IMAGE_FORMATS", "webp")
+
+# Quality used for the lossy encodings
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+
+# Content type of every format an image can be stored in
+FORMAT_MIMETYPES = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "avif": "image/avif",
+    "jpeg": "image/jpeg"
+}
+
+
+def _parse_derivatives(spec):
+    derivatives = {}
+    for item in spec.split(","):
+        if item.strip():
+            name, scale = item.split(":")
+            derivatives[name.strip()] = float(scale)
+    return derivatives
+
+
+# Derivative name -> scale applied to the target size
+derivative_scales = _parse_derivatives(IMAGE_DERIVATIVES)
+
+
+def _parse_formats(spec):
+    formats = []
+    for fmt in spec.split(","):
+        fmt = fmt.strip().lower().replace("jpg", "jpeg")
+        if not fmt or fmt == "png" or fmt in formats:
+            continue
+        if fmt not in FORMAT_MIMETYPES:
+            logger.warning(f"Ignoring unknown image format {fmt}")
+        elif fmt in ("webp", "avif") and not features.check(fmt):
+            logger.warning(f"Pillow was built without {fmt} support; not storing {fmt} images")
+        else:
+            formats.append(fmt)
+    return formats
+
+
+# Extra formats every image is encoded in besides PNG
+image_formats = _parse_formats(IMAGE_FORMATS)
+
+
+def _create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=IMAGE_HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Shared by every image module; the adapter's connection pool is safe to use from many threads
+http_session = _create_session()
+
+
+def image_source(image):
+    """Return the decoded bytes of a generated image, or its URL when the API only sent a URL."""
+    if getattr(image, "b64_json", None):
+        return base64.b64decode(image.b64_json)
+    return image.url
+
+
+def fetch_image(source):
+    """Return the raw bytes for an image_source() result, downloading it if it is a URL."""
+    if isinstance(source, (bytes, bytearray)):
+        return source
+    logger.info(f"Downloading image from URL: {source}")
+    with http_session.get(
+        source, stream=True, timeout=(IMAGE_HTTP_CONNECT_TIMEOUT, IMAGE_HTTP_READ_TIMEOUT)
+    ) as response:
+        response.raise_for_status()
+        content = bytearray()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            content.extend(chunk)
+            if len(content) > IMAGE_MAX_DOWNLOAD_BYTES:
+                raise ValueError(f"Image download exceeds {IMAGE_MAX_DOWNLOAD_BYTES} bytes")
+    return bytes(content)
+
+
+def _encode(image, fmt):
+    output = BytesIO()
+    if fmt == "png":
+        image.save(output, format="PNG")
+    elif fmt == "jpeg":
+        image.convert("RGB").save(output, format="JPEG", quality=IMAGE_QUALITY, progressive=True, optimize=True)
+    else:
+        image.save(output, format=fmt.upper(), quality=IMAGE_QUALITY)
+    return output.getvalue()
+
+
+def _resize_and_encode(data, target_sizes, formats=("png",)):
+    """Decode image bytes once and return a dict of format -> encoded bytes for each target size."""
+    image = Image.open(BytesIO(data))
+    # JPEG sources are decoded straight at a reduced scale; a no-op for PNG
+    largest = max(target_sizes, key=lambda size: size[0] * size[1])
+    image.draft("RGB", tuple(largest))
+    image.load()
+    outputs = []
+    for target_size in target_sizes:
+        # reducing_gap box-reduces by a whole factor before the Lanczos pass
+        resized = image.resize(tuple(target_size), Image.LANCZOS, reducing_gap=IMAGE_REDUCING_GAP)
+        outputs.append({fmt: _encode(resized, fmt) for fmt in formats})
+    return outputs
+
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def _get_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # Forking a process that already runs request threads is unsafe, so start clean interpreters
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            context = multiprocessing.get_context(method)
+            if method == "forkserver":
+                # The fork server imports only this module (and PIL), never the app, and forks every
+                # resize process from that state
+                context.set_forkserver_preload([__name__])
+            _process_pool = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS, mp_context=context)
+        return _process_pool
+
+
+def _discard_process_pool(broken):
+    """Shut down the pool broken (e.g. after one of its processes was OOM-killed) so the next call starts a new one."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is broken:
+            _process_pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def resize_images(data, target_sizes, formats=("png",)):
+    """Resize and encode image bytes to every target size off the request thread.
+
+    Returns one dict of format -> encoded bytes per target size. The work runs on
+    a process pool so CPU-bound resizing and encoding from concurrent requests is
+    not serialised by the GIL.
+    """
+    if IMAGE_PROCESS_WORKERS <= 0:
+        return _resize_and_encode(data, target_sizes, formats)
+    # One retry on a fresh pool, then give up on processes for this call
+    for _ in range(2):
+        pool = _get_process_pool()
+        try:
+            return pool.submit(_resize_and_encode, data, list(target_sizes), list(formats)).result()
+        except BrokenProcessPool as e:
+            logger.error(f"Image process pool broke, starting a new one: {e}")
+            _discard_process_pool(pool)
+    logger.error("Image process pool broke again, resizing on the calling thread")
+    return _resize_and_encode(data, target_sizes, formats)
+
+
+def resize_image(data, target_size):
+    """Resize and PNG-encode image bytes to a single target size."""
+    return resize_images(data, [target_size])[0]["png"]
+
+
+def derivative_sizes(target_size, source_size=None):
+    """Return the size of every configured derivative of an image rendered at target_size.
+
+    Upscaling adds bytes but no detail, so derivatives larger than target_size are
+    shrunk to fit within source_size, and left out if that leaves nothing larger
+    than target_size.
+    """
+    width, height = target_size
+    sizes = {}
+    for name, scale in derivative_scales.items():
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        if scale > 1 and source_size:
+            fit = min(1.0, source_size[0] / size[0], source_size[1] / size[1])
+            size = (max(1, round(size[0] * fit)), max(1, round(size[1] * fit)))
+            if size[0] <= width and size[1] <= height:
+                continue
+        sizes[name] = size
+    return sizes
+
+
+def render_image(data, target_size):
+    """Resize image bytes to target_size and every derivative size from a single decode.
+
+    Returns the PNG bytes at target_size and a dict of (derivative name or None,
+    format) -> bytes holding every other size and encoding, ready to be passed
+    to ImageStore.add().
+    """
+    # Only the header is read here; the pixels are decoded once, in resize_images
+    source_size = Image.open(BytesIO(data)).size
+    sizes = {None: target_size, **derivative_sizes(target_size, source_size)}
+    outputs = resize_images(data, list(sizes.values()), ["png", *image_formats])
+    variants = {
+        (name, fmt): encoded
+        for name, encodings in zip(sizes, outputs)
+        for fmt, encoded in encodings.items()
+    }
+    return variants.pop((None, "png")), variants
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import uuid
+import logging
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from progress import Progress, current_progress
+from rate_limit import Rejections, current_rejections
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Number of quiz generations a single worker process runs in the background at once
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+
+# Seconds a finished job and its result are kept for polling
+JOB_TTL = int(os.getenv("JOB_TTL", str(60 * 60)))
+
+# SQLite file shared by the gunicorn workers so any of them can answer status requests for any job
+# (set it to an empty value to keep jobs in the memory of the worker that runs them)
+JOBS_DB = os.getenv("JOBS_DB", os.path.join(tempfile.gettempdir(), "quiz_jobs.db"))
+
+
+def generation_error(result):
+    """Return (message, status) if result is a generator's error response, otherwise None."""
+    if isinstance(result, tuple) and result and isinstance(result[0], dict) and "error" in result[0]:
+        return result[0]["error"], result[1] if len(result) > 1 else 500
+    if isinstance(result, dict) and "error" in result:
+        return result["error"], 500
+    return None
+
+
+class JobManager:
+    """Runs quiz generations on a background pool and tracks their status, progress and result."""
+
+    def __init__(self, max_workers=JOB_WORKERS, ttl=JOB_TTL, db_path=JOBS_DB):
+        self.ttl = ttl
+        self.db_path = db_path
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job-worker")
+        if self.db_path:
+            self._init_db()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def _init_db(self):
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, job TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def _save(self, job):
+        """Mirror a job record to the shared SQLite file."""
+        if not self.db_path:
+            return
+        try:
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO jobs (id, job, updated_at) VALUES (?, ?, ?)",
+                    (job["id"], json.dumps(job), time.time())
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Error saving job {job['id']}: {e}")
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(fields)
+            snapshot = dict(job)
+        self._save(snapshot)
+
+    def _expire(self):
+        now = time.time()
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job["finished_at"] and now - job["finished_at"] > self.ttl
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+        if self.db_path:
+            with self._connect() as connection:
+                connection.execute("DELETE FROM jobs WHERE updated_at < ?", (now - self.ttl,))
+
+    def submit(self, func, *args, **params):
+        """Queue func(*args) and return the new job id; params are echoed back in the job record."""
+        self._expire()
+        job_id = uuid.uuid4().hex
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "params": params,
+            "progress": Progress().snapshot(),
+            "result": None,
+            "error": None,
+            "error_status": None,
+            "created_at": time.time(),
+            "finished_at": None
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+        self._save(dict(job))
+        self._executor.submit(self._run, job_id, func, args)
+        logger.info(f"Queued job {job_id} for {func.__name__}")
+        return job_id
+
+    def _run(self, job_id, func, args):
+        progress = Progress(on_change=lambda snapshot: self._update(job_id, progress=snapshot))
+        current_progress.set(progress)
+        rejections = Rejections()
+        current_rejections.set(rejections)
+        self._update(job_id, status="running")
+        try:
+            result = func(*args)
+            # Generators report most failures as ({"error": ...}, status) instead of raising
+            error = generation_error(result)
+            if rejections.retry_after is not None:
+                # Part of the quiz was turned away by the model's rate limit, so the job can be resubmitted later
+                error = ("Too many requests, please try again later", 429)
+            if error:
+                logger.error(f"Job {job_id} failed: {error[0]}")
+                self._update(job_id, status="failed", error=error[0], error_status=error[1], finished_at=time.time())
+            else:
+                self._update(job_id, status="completed", result=result, finished_at=time.time())
+                logger.info(f"Job {job_id} completed")
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            if rejections.retry_after is not None:
+                self._update(job_id, status="failed", error="Too many requests, please try again later",
+                             error_status=429, finished_at=time.time())
+            else:
+                self._update(job_id, status="failed", error=str(e), finished_at=time.time())
+        finally:
+            current_progress.set(None)
+            current_rejections.set(None)
+
+    def get(self, job_id):
+        """Return a copy of the job record, or None if it is unknown or expired."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        if self.db_path:
+            with self._connect() as connection:
+                row = connection.execute("SELECT job FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row:
+                return json.loads(row[0])
+        return None
+
+
+job_manager = JobManager()
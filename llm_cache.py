@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from types import SimpleNamespace
+from dotenv import load_dotenv
+from openai.types.chat import ChatCompletion
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Cache configuration
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(24 * 60 * 60)))
+LLM_CACHE_VARIANTS = int(os.getenv("LLM_CACHE_VARIANTS", "20"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB", "")
+LLM_CACHE_DB_MAX_BYTES = int(os.getenv("LLM_CACHE_DB_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+def request_key(request):
+    """Hash the full chat completion request into a cache key."""
+    payload = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """Two-tier (in-process LRU + optional shared SQLite) cache of chat completion responses.
+
+    Each key keeps up to `variants` different responses. Until a key has collected
+    that many, lookups are reported as misses so a fresh response gets generated;
+    afterwards the stored variants are served in rotation.
+    """
+
+    def __init__(self, ttl=LLM_CACHE_TTL, variants=LLM_CACHE_VARIANTS, max_bytes=LLM_CACHE_MAX_BYTES,
+                 db_path=LLM_CACHE_DB, db_max_bytes=LLM_CACHE_DB_MAX_BYTES):
+        self.ttl = ttl
+        self.variants = max(1, variants)
+        self.max_bytes = max_bytes
+        self.db_path = db_path
+        self.db_max_bytes = db_max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if self.db_path:
+            self._init_db()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def _init_db(self):
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT NOT NULL, variant TEXT NOT NULL, response BLOB NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (key, variant))"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used)")
+
+    def _load(self, key):
+        """Read every stored variant of key from the SQLite tier."""
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT variant, response, created_at FROM llm_cache WHERE key = ? ORDER BY created_at", (key,)
+            ).fetchall()
+        return [(variant, bytes(response), created_at) for variant, response, created_at in rows]
+
+    def _set_entry(self, key, variants, next_index=0):
+        old = self._entries.pop(key, None)
+        if old:
+            self._bytes -= sum(len(response) for _, response, _ in old["variants"])
+        if not variants:
+            return None
+        entry = {"variants": variants, "next": next_index}
+        self._entries[key] = entry
+        self._bytes += sum(len(response) for _, response, _ in variants)
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self._bytes -= sum(len(response) for _, response, _ in evicted["variants"])
+            self.evictions += 1
+            logger.info(f"Evicted LLM cache entry {evicted_key[:12]} from memory")
+        return entry
+
+    def _fresh_variants(self, key):
+        """Return the unexpired variants of key, consulting the SQLite tier if memory is short."""
+        now = time.time()
+        entry = self._entries.get(key)
+        variants = entry["variants"] if entry else []
+        next_index = entry["next"] if entry else 0
+        if len(variants) < self.variants and self.db_path:
+            variants = self._load(key)
+        fresh = [variant for variant in variants if now - variant[2] < self.ttl]
+        if entry is None or fresh != entry["variants"]:
+            entry = self._set_entry(key, fresh, next_index)
+        return entry
+
+    def get(self, key):
+        """Return a cached response for key, or None if a new variant should be generated."""
+        self._local.last = None
+        with self._lock:
+            entry = self._fresh_variants(key)
+            if not entry or len(entry["variants"]) < self.variants:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            variant, response, _ = entry["variants"][entry["next"] % len(entry["variants"])]
+            entry["next"] += 1
+            self.hits += 1
+            self._local.last = (key, variant)
+
+        if self.db_path:
+            with self._connect() as connection:
+                connection.execute(
+                    "UPDATE llm_cache SET last_used = ? WHERE key = ? AND variant = ?", (time.time(), key, variant)
+                )
+        return response
+
+    def put(self, key, response):
+        """Store a freshly generated response as another variant of key."""
+        variant = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._local.last = (key, variant)
+            entry = self._entries.get(key)
+            variants = list(entry["variants"]) if entry else []
+            if len(variants) >= self.variants:
+                return
+            variants.append((variant, response, now))
+            self._set_entry(key, variants, entry["next"] if entry else 0)
+
+        if self.db_path:
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT OR IGNORE INTO llm_cache (key, variant, response, size, created_at, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, variant, response, len(response), now, now)
+                )
+                connection.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,))
+                total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+                if total > self.db_max_bytes:
+                    # Drop least recently used rows until the table fits its byte budget again
+                    connection.execute(
+                        "DELETE FROM llm_cache WHERE rowid IN ("
+                        "SELECT rowid FROM (SELECT rowid, SUM(size) OVER (ORDER BY last_used DESC) AS running "
+                        "FROM llm_cache) WHERE running > ?)",
+                        (self.db_max_bytes,)
+                    )
+
+    def discard_last(self):
+        """Remove the response most recently served to this thread, e.g. because it failed to parse."""
+        last = getattr(self._local, "last", None)
+        if not last:
+            return
+        self._local.last = None
+        key, variant = last
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                remaining = [item for item in entry["variants"] if item[0] != variant]
+                self._set_entry(key, remaining, entry["next"])
+        if self.db_path:
+            with self._connect() as connection:
+                connection.execute("DELETE FROM llm_cache WHERE key = ? AND variant = ?", (key, variant))
+        logger.info(f"Discarded cached LLM response {variant[:12]}")
+
+    def stats(self):
+        """Return hit/miss counters and current memory usage."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "variants_per_key": self.variants
+            }
+
+
+llm_cache = LLMCache()
+
+
+class CachedChatCompletions:
+    """Drop-in replacement for client.chat.completions that consults the LLM cache first."""
+
+    def __init__(self, completions, cache):
+        self._completions = completions
+        self._cache = cache
+
+    def create(self, **request):
+        if not LLM_CACHE_ENABLED or request.get("stream"):
+            return self._completions.create(**request)
+
+        key = request_key(request)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return ChatCompletion.model_validate_json(cached)
+
+        response = self._completions.create(**request)
+        # Truncated or filtered responses are never worth replaying
+        if response.choices and response.choices[0].finish_reason == "stop":
+            self._cache.put(key, response.model_dump_json().encode("utf-8"))
+        return response
+
+
+class CachedOpenAI:
+    """Wrap an OpenAI client so chat completions go through the LLM cache."""
+
+    def __init__(self, client, cache=llm_cache):
+        self._client = client
+        self.chat = SimpleNamespace(completions=CachedChatCompletions(client.chat.completions, cache))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def discard_last_response():
+    """Drop the cached response this thread was last given, so it is never served again."""
+    llm_cache.discard_last()
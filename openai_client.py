@@ -0,0 +1,37 @@
+import os
+import logging
+import httpx
+from dotenv import load_dotenv
+from openai import DefaultHttpxClient, OpenAI
+from llm_cache import CachedOpenAI
+from rate_limit import RateLimitedOpenAI
+from circuit_breaker import CircuitBreakerOpenAI
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Get OpenAI API key from environment variables
+openai_api_key = os.getenv("OPENAI_API_KEY")
+if not openai_api_key:
+    # Generator modules are imported on first use, so this must fail the request, not end the worker
+    raise RuntimeError("OPENAI_API_KEY environment variable not set")
+
+# Connections to the OpenAI API kept by a worker process, shared by every generator module
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "64"))
+
+# Chat model used for question generation
+OPENAI_CHAT_MODEL = os.getenv("OPENAI_CHAT_MODEL", "gpt-4")
+
+# Single OpenAI client (and connection pool) used by every generator module in the process;
+# cache hits are answered before the rate limiter, so they never use up the shared budget, and
+# image calls rejected by an open circuit breaker do not queue for it either
+client = CachedOpenAI(CircuitBreakerOpenAI(RateLimitedOpenAI(OpenAI(
+    api_key=openai_api_key,
+    http_client=DefaultHttpxClient(
+        limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS)
+    )
+))))
@@ -0,0 +1,55 @@
+import logging
+import threading
+import contextvars
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Progress of the generation running in the current context, if anyone is tracking it
+current_progress = contextvars.ContextVar("current_progress", default=None)
+
+
+class Progress:
+    """Thread-safe question and image counters for one quiz generation."""
+
+    def __init__(self, on_change=None):
+        self.questions_done = 0
+        self.questions_total = 0
+        self.images_done = 0
+        self.images_total = 0
+        self._on_change = on_change
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        """Increment the named counters and notify the listener."""
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+            snapshot = self._snapshot()
+        if self._on_change:
+            self._on_change(snapshot)
+
+    def _snapshot(self):
+        return {
+            "questions_done": self.questions_done,
+            "questions_total": self.questions_total,
+            "images_done": self.images_done,
+            "images_total": self.images_total
+        }
+
+    def snapshot(self):
+        """Return the current counters as a dict."""
+        with self._lock:
+            return self._snapshot()
+
+
+def report(**counts):
+    """Add to the progress counters of the generation running in this context, if tracked."""
+    progress = current_progress.get()
+    if progress is not None:
+        progress.add(**counts)
@@ -0,0 +1,138 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import tempfile
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Keep every successfully generated question in the question bank
+QUESTION_BANK_ENABLED = os.getenv("QUESTION_BANK_ENABLED", "1") == "1"
+
+# SQLite file holding the question bank, shared by every worker process and kept across restarts
+QUESTION_BANK_DB = os.getenv("QUESTION_BANK_DB", os.path.join(tempfile.gettempdir(), "quiz_question_bank.db"))
+
+# Most questions returned by a single sample
+QUESTION_BANK_MAX_SAMPLE = 100
+
+
+def normalize(text):
+    """Normalise a subject or tone so that spelling variants of the same request are stored together."""
+    return re.sub(r"\s+", " ", text.strip().strip('"').strip()).casefold()
+
+
+def content_hash(question):
+    """Hash a question's content, independent of key order."""
+    return hashlib.sha256(json.dumps(question, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class QuestionBank:
+    """Persistent store of generated questions, indexed by quiz type, subject, tone, creation time and content hash.
+
+    Every worker writes to the same SQLite file in WAL mode, so reads never wait
+    for writers. A question is stored once per quiz type however often it is
+    generated.
+    """
+
+    def __init__(self, db_path=QUESTION_BANK_DB):
+        self.db_path = db_path
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._init_db()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _init_db(self):
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS questions ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, quiz_type INTEGER NOT NULL, subject TEXT NOT NULL, "
+                "tone TEXT NOT NULL, content_hash TEXT NOT NULL, question TEXT NOT NULL, created_at REAL NOT NULL, "
+                "UNIQUE (quiz_type, content_hash))"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS questions_request ON questions (quiz_type, subject, tone, created_at)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS questions_subject ON questions (subject, created_at)")
+            connection.execute("CREATE INDEX IF NOT EXISTS questions_created_at ON questions (created_at)")
+            connection.execute("CREATE INDEX IF NOT EXISTS questions_content_hash ON questions (content_hash)")
+
+    def add(self, quiz_type, subject, tone, questions):
+        """Store generated questions and return how many of them were new."""
+        now = time.time()
+        rows = [
+            (int(quiz_type), normalize(subject), normalize(tone), content_hash(question),
+             json.dumps(question, ensure_ascii=False), now)
+            for question in questions
+        ]
+        with self._connect() as connection:
+            before = connection.total_changes
+            connection.executemany(
+                "INSERT OR IGNORE INTO questions (quiz_type, subject, tone, content_hash, question, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            return connection.total_changes - before
+
+    def sample(self, quiz_type, number, subject=None, tone=None, exclude=()):
+        """Return up to number distinct random questions of a quiz type, optionally for one subject and tone.
+
+        Questions whose content hash is in exclude (e.g. ones a client was already
+        given) are skipped. Each result is {"hash": ..., "question": ...}.
+        """
+        conditions, params = ["quiz_type = ?"], [int(quiz_type)]
+        if subject is not None:
+            conditions.append("subject = ?")
+            params.append(normalize(subject))
+        if tone is not None:
+            conditions.append("tone = ?")
+            params.append(normalize(tone))
+        exclude = list(exclude)
+        if exclude:
+            conditions.append(f"content_hash NOT IN ({', '.join('?' * len(exclude))})")
+            params.extend(exclude)
+        params.append(max(0, min(number, QUESTION_BANK_MAX_SAMPLE)))
+
+        with self._connect() as connection:
+            rows = connection.execute(
+                f"SELECT content_hash, question FROM questions WHERE {' AND '.join(conditions)} "
+                "ORDER BY RANDOM() LIMIT ?",
+                params
+            ).fetchall()
+        return [{"hash": digest, "question": json.loads(question)} for digest, question in rows]
+
+    def stats(self):
+        """Return the number of stored questions per quiz type and in total."""
+        with self._connect() as connection:
+            counts = dict(connection.execute("SELECT quiz_type, COUNT(*) FROM questions GROUP BY quiz_type").fetchall())
+        return {"questions": sum(counts.values()), "by_quiz_type": counts}
+
+
+question_bank = QuestionBank()
+
+
+def record_questions(quiz_type, subject, tone, response):
+    """Store a generator's response in the question bank if it is a list of successfully generated questions."""
+    if not QUESTION_BANK_ENABLED or not isinstance(response, list) or not response:
+        return
+    if any(not isinstance(question, dict) or "error" in question for question in response):
+        return
+    try:
+        question_bank.add(quiz_type, subject, tone, response)
+    except sqlite3.Error as e:
+        # The bank is a by-product; never fail a quiz because it could not be written
+        logger.error(f"Error storing questions in the question bank: {e}")
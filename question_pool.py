@@ -0,0 +1,188 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from progress import report
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Requests kept warm, as "quiz_type:subject:tone" entries separated by semicolons, e.g. "100:Physics:neutral;500:Biology:fun"
+QUESTION_POOL = os.getenv("QUESTION_POOL", "")
+
+# Ready-made questions kept for each entry
+QUESTION_POOL_SIZE = int(os.getenv("QUESTION_POOL_SIZE", "20"))
+
+# A background refill starts once an entry has fewer questions than this
+QUESTION_POOL_LOW_WATERMARK = int(os.getenv("QUESTION_POOL_LOW_WATERMARK", "10"))
+
+# Seconds a pooled question may wait before it is dropped as stale
+QUESTION_POOL_MAX_AGE = int(os.getenv("QUESTION_POOL_MAX_AGE", str(60 * 60)))
+
+# Refills a single worker process runs at once
+QUESTION_POOL_WORKERS = int(os.getenv("QUESTION_POOL_WORKERS", "1"))
+
+
+def pool_key(quiz_type, subject, tone):
+    """Normalise a request into the key its pool is stored under."""
+    return int(quiz_type), subject.strip().casefold(), tone.strip().casefold()
+
+
+def parse_pool_entries(spec):
+    """Parse QUESTION_POOL into a list of (quiz_type, subject, tone) tuples."""
+    entries = []
+    for item in filter(None, (part.strip() for part in spec.split(";"))):
+        quiz_type, subject, tone = (value.strip() for value in item.split(":", 2))
+        entries.append((int(quiz_type), subject, tone))
+    return entries
+
+
+class QuestionPool:
+    """Ready-made questions for the configured (quiz_type, subject, tone) requests, refilled in the background.
+
+    Requests for a configured triple take their questions from the pool and only
+    generate the shortfall live. Whenever an entry drops below the low watermark it
+    is topped up to size by a background refill through the same generator that
+    serves live requests. Each worker process keeps its own pool and only starts
+    filling it when it serves its first request, so nothing is generated at import
+    (in the gunicorn --preload master or a multiprocessing child).
+    """
+
+    def __init__(self, registry, entries=None, size=QUESTION_POOL_SIZE, low_watermark=QUESTION_POOL_LOW_WATERMARK,
+                 max_age=QUESTION_POOL_MAX_AGE, max_workers=QUESTION_POOL_WORKERS):
+        self.registry = registry
+        self.size = size
+        self.low_watermark = min(low_watermark, size)
+        self.max_age = max_age
+        self.max_workers = max_workers
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._pools = {}
+        self._refilling = set()
+        self._executor = None
+        for quiz_type, subject, tone in parse_pool_entries(QUESTION_POOL) if entries is None else entries:
+            key = pool_key(quiz_type, subject, tone)
+            self._entries[key] = (quiz_type, subject, tone)
+            self._pools[key] = deque()
+
+    def start(self):
+        """Start filling every configured entry in the background; later calls do nothing."""
+        with self._lock:
+            if self._executor is not None or not self._entries:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="pool-refill")
+        for key in self._entries:
+            self._schedule_refill(key)
+
+    def _drop_expired(self, pool):
+        cutoff = time.time() - self.max_age
+        while pool and pool[0][0] < cutoff:
+            pool.popleft()
+            self.expired += 1
+
+    def take(self, quiz_type, subject, tone, number):
+        """Remove and return up to number pooled questions for the request (an empty list if it is not pooled)."""
+        self.start()
+        key = pool_key(quiz_type, subject, tone)
+        if key not in self._pools:
+            return []
+        with self._lock:
+            pool = self._pools[key]
+            self._drop_expired(pool)
+            questions = [pool.popleft()[1] for _ in range(min(number, len(pool)))]
+            if len(questions) == number:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self._schedule_refill(key)
+        if questions:
+            report(questions_total=len(questions), questions_done=len(questions))
+        return questions
+
+    def give_back(self, quiz_type, subject, tone, questions):
+        """Return questions taken with take() that could not be served after all."""
+        key = pool_key(quiz_type, subject, tone)
+        if key not in self._pools or not questions:
+            return
+        now = time.time()
+        with self._lock:
+            self._pools[key].extendleft((now, question) for question in reversed(questions))
+
+    def generate(self, quiz, number, subject, tone):
+        """Return a quiz of the QuizType quiz, serving pooled questions first and generating only the shortfall.
+
+        Out-of-range numbers never touch the pool; the generator answers them with its
+        usual error.
+        """
+        if not 1 <= number <= quiz.max_questions:
+            return quiz.generate(number, subject, tone)
+        pooled = self.take(quiz.code, subject, tone, number)
+        if len(pooled) == number:
+            return pooled
+
+        response = quiz.generate(number - len(pooled), subject, tone)
+        if not isinstance(response, list):
+            self.give_back(quiz.code, subject, tone, pooled)
+            return response
+        return pooled + response
+
+    def _schedule_refill(self, key):
+        with self._lock:
+            if key in self._refilling or len(self._pools[key]) >= self.low_watermark:
+                return
+            self._refilling.add(key)
+        self._executor.submit(self._refill, key)
+
+    def _refill(self, key):
+        """Generate questions for an entry until it holds size of them or generation fails."""
+        quiz_type, subject, tone = self._entries[key]
+        try:
+            quiz = self.registry.get_quiz_type(quiz_type)
+            while True:
+                with self._lock:
+                    self._drop_expired(self._pools[key])
+                    missing = self.size - len(self._pools[key])
+                if missing <= 0:
+                    break
+                count = min(missing, quiz.max_questions)
+                logger.info(f"Refilling question pool {quiz_type}/{subject}/{tone} with {count} questions")
+                response = quiz.generate(count, subject, tone)
+                # Generators report failures as error dicts or (error, status) tuples
+                if not isinstance(response, list) or any("error" in question for question in response):
+                    logger.error(f"Failed to refill question pool {quiz_type}/{subject}/{tone}: {response}")
+                    break
+                now = time.time()
+                with self._lock:
+                    self._pools[key].extend((now, question) for question in response)
+        except Exception as e:
+            logger.error(f"Error refilling question pool {quiz_type}/{subject}/{tone}: {e}")
+        finally:
+            with self._lock:
+                self._refilling.discard(key)
+
+    def stats(self):
+        """Return pooled question counts per entry and hit/miss counters."""
+        with self._lock:
+            return {
+                "entries": {
+                    f"{quiz_type}:{subject}:{tone}": len(self._pools[key])
+                    for key, (quiz_type, subject, tone) in self._entries.items()
+                },
+                "size": self.size,
+                "low_watermark": self.low_watermark,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "refilling": len(self._refilling),
+                "started": self._executor is not None
+            }
@@ -0,0 +1,146 @@
+import os
+import logging
+import importlib
+from dotenv import load_dotenv
+from question_bank import record_questions
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Import every generator module when the app starts instead of on first use (for gunicorn --preload)
+QUIZ_TYPES_PRELOAD = os.getenv("QUIZ_TYPES_PRELOAD", "0") == "1"
+
+# Size of the image shown with a question and of each image option, in pixels
+QUESTION_IMAGE_SIZE = (750, 319)
+OPTION_IMAGE_SIZE = (270, 140)
+
+
+class QuizType:
+    """A registered quiz type: its generator, request limit, image store, image sizes and question schema."""
+
+    def __init__(self, code, name, generate, max_questions, image_store=None, image_sizes=None, list_name=None,
+                 schema=None, stream=None):
+        self.code = code
+        self.name = name
+        self.generator = generate
+        self.max_questions = max_questions
+        self.image_store = image_store
+        self.image_sizes = image_sizes or {}
+        # Key the store is listed under by /list_all_images
+        self.list_name = list_name or (image_store.namespace if image_store is not None else None)
+        # JSON Schema the model's structured answer for one question must match
+        self.schema = schema
+        # Generator function yielding the questions one at a time, for types that produce them in batches
+        self.streamer = stream
+
+    @property
+    def banked(self):
+        """Whether the type's questions are kept in the question bank.
+
+        Questions with images refer to image store keys that are later evicted or
+        deleted, so only text-only types are banked.
+        """
+        return self.image_store is None
+
+    def generate(self, number, subject, tone):
+        """Run the generator and keep its questions in the question bank."""
+        response = self.generator(number, subject, tone)
+        if self.banked:
+            record_questions(self.code, subject, tone, response)
+        return response
+
+    def stream(self, number, subject, tone):
+        """Yield the questions from the type's streamer as they are generated, keeping each in the question bank."""
+        for question in self.streamer(number, subject, tone):
+            if self.banked:
+                record_questions(self.code, subject, tone, [question])
+            yield question
+
+    def describe(self):
+        """Return the public description of the quiz type."""
+        return {
+            "quiz_type": self.code,
+            "name": self.name,
+            "max_questions": self.max_questions,
+            "has_images": self.image_store is not None,
+            "banked": self.banked,
+            "image_sizes": {role: list(size) for role, size in self.image_sizes.items()},
+            "schema": self.schema
+        }
+
+
+# Quiz type code -> QuizType, filled in by each generator module as it is imported
+quiz_types = {}
+
+# Module that registers each quiz type
+QUIZ_TYPE_MODULES = {
+    100: "simple_mcq",
+    200: "simple_checkox",
+    300: "fill_in_the_blanks",
+    400: "sequence",
+    500: "images_txt",
+    501: "image_txt_checkbox",
+    600: "image_to_image_mcq",
+    601: "image_checkbox1",
+    602: "image_checkbox",
+    700: "True_False_Radio_Btn_with_Image_Text_Question",
+    701: "image_radio_button",
+    800: "sub1",
+    801: "sub2",
+    802: "sub3",
+    803: "sub4",
+    900: "appropriate"
+}
+
+
+def register_quiz_type(code, name, generate, max_questions, image_store=None, image_sizes=None, list_name=None,
+                       schema=None, stream=None):
+    """Register the generator module for a quiz type code and return the new QuizType."""
+    if code in quiz_types:
+        raise ValueError(f"Quiz type {code} is already registered")
+    quiz_type = QuizType(code, name, generate, max_questions, image_store, image_sizes, list_name, schema, stream)
+    quiz_types[code] = quiz_type
+    return quiz_type
+
+
+class QuizRegistry:
+    """The quiz types one app serves, importing each generator module the first time its type is used.
+
+    Importing a generator module pulls in its prompts, image store and model
+    client, so deferring it keeps worker start-up fast.
+    """
+
+    def __init__(self, codes=None, preload=QUIZ_TYPES_PRELOAD):
+        # Code -> module name, ordered by code
+        self.modules = {code: QUIZ_TYPE_MODULES[code] for code in sorted(QUIZ_TYPE_MODULES if codes is None else codes)}
+        if preload:
+            self.all()
+
+    def get(self, code):
+        """Return the quiz type for code, loading its module if needed, or None if this app does not serve it."""
+        module = self.modules.get(code)
+        if module is None:
+            return None
+        if code not in quiz_types:
+            # The import system makes concurrent first imports of a module wait for the first one
+            importlib.import_module(module)
+        return quiz_types[code]
+
+    def get_quiz_type(self, code):
+        """Return the quiz type for code, raising ValueError for types this app does not serve."""
+        quiz_type = self.get(code)
+        if quiz_type is None:
+            raise ValueError("Invalid quiz type, please enter a correct quiz_type")
+        return quiz_type
+
+    def all(self):
+        """Return every quiz type this app serves, ordered by code; this loads all of their modules."""
+        return [self.get(code) for code in self.modules]
+
+    def image_quiz_types(self):
+        """Return the quiz types this app serves that store images, ordered by code."""
+        return [quiz_type for quiz_type in self.all() if quiz_type.image_store is not None]
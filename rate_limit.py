@@ -0,0 +1,240 @@
+import os
+import time
+import logging
+import sqlite3
+import tempfile
+import threading
+import contextvars
+from types import SimpleNamespace
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Throttle OpenAI calls to the configured per-model limits before sending them
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+
+# SQLite file holding the buckets, shared by every worker process on the host
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", os.path.join(tempfile.gettempdir(), "quiz_rate_limit.db"))
+
+# Default requests and tokens per minute for each chat model
+RATE_LIMIT_CHAT_RPM = int(os.getenv("RATE_LIMIT_CHAT_RPM", "500"))
+RATE_LIMIT_CHAT_TPM = int(os.getenv("RATE_LIMIT_CHAT_TPM", "10000"))
+
+# Default images per minute for each image model
+RATE_LIMIT_IMAGE_RPM = int(os.getenv("RATE_LIMIT_IMAGE_RPM", "5"))
+
+# Longest a call waits for its rate limit before it is rejected instead (0 waits as long as it takes)
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "30"))
+
+# Per-model overrides as "model=rpm/tpm" pairs separated by commas, e.g. "gpt-4o=5000/800000,dall-e-3=15"
+RATE_LIMITS = os.getenv("RATE_LIMITS", "")
+
+# Rough number of characters per token used to estimate the size of a prompt
+CHARS_PER_TOKEN = 4
+
+
+class RateLimitExceeded(RuntimeError):
+    """Raised instead of waiting longer than the maximum wait for a rate limit; nothing is reserved."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Rejections:
+    """Rate-limit rejections of one request, collected from every thread the request fans out to."""
+
+    def __init__(self):
+        self.retry_after = None
+        self._lock = threading.Lock()
+
+    def add(self, retry_after):
+        with self._lock:
+            self.retry_after = max(self.retry_after or 0, retry_after)
+
+
+# Rejections of the request running in the current context, if anyone is tracking them
+current_rejections = contextvars.ContextVar("current_rejections", default=None)
+
+
+def parse_limits(spec):
+    """Parse RATE_LIMITS into {model: (rpm, tpm)}, with tpm None when only rpm is given."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        model, _, values = item.partition("=")
+        rpm, _, tpm = values.partition("/")
+        limits[model.strip()] = (int(rpm), int(tpm) if tpm else None)
+    return limits
+
+
+class RateLimiter:
+    """Token buckets kept in SQLite so every worker process draws from the same budget.
+
+    Each bucket refills continuously at capacity per minute. acquire() reserves
+    its cost straight away, letting the bucket go negative, and then sleeps until
+    the reservation is covered. Callers are therefore queued in the order they
+    arrive, up to max_wait; a caller that would wait longer is rejected without
+    reserving anything.
+    """
+
+    def __init__(self, db_path=RATE_LIMIT_DB):
+        self.db_path = db_path
+        self.waits = 0
+        self.waited = 0.0
+        self.rejected = 0
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def reserve(self, costs, max_wait=0):
+        """Take costs ({bucket name: (cost, capacity per minute)}) and return the seconds to wait for them.
+
+        Raises RateLimitExceeded, leaving the buckets untouched, if that wait would be
+        longer than max_wait (0 for no limit).
+        """
+        now = time.time()
+        wait = 0.0
+        balances = {}
+        connection = self._connect()
+        try:
+            # Take the write lock up front so two workers never read the same balance
+            connection.execute("BEGIN IMMEDIATE")
+            for name, (cost, capacity) in costs.items():
+                row = connection.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+                tokens, updated = row if row else (capacity, now)
+                rate = capacity / 60
+                balances[name] = min(capacity, tokens + (now - updated) * rate) - min(cost, capacity)
+                if balances[name] < 0:
+                    wait = max(wait, -balances[name] / rate)
+            if max_wait and wait > max_wait:
+                connection.execute("ROLLBACK")
+                raise RateLimitExceeded(f"Rate limit reached for {', '.join(costs)}, retry in {wait:.0f}s", wait)
+            connection.executemany("INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                                   [(name, tokens, now) for name, tokens in balances.items()])
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+        return wait
+
+    def acquire(self, costs, max_wait=RATE_LIMIT_MAX_WAIT):
+        """Block until costs can be taken from their buckets, or raise RateLimitExceeded if that takes over max_wait."""
+        try:
+            wait = self.reserve(costs, max_wait)
+        except RateLimitExceeded as e:
+            self.rejected += 1
+            rejections = current_rejections.get()
+            if rejections is not None:
+                rejections.add(e.retry_after)
+            raise
+        if wait > 0:
+            self.waits += 1
+            self.waited += wait
+            logger.info(f"Rate limit reached for {', '.join(costs)}, waiting {wait:.1f}s")
+            time.sleep(wait)
+
+    def refund(self, name, tokens):
+        """Give back tokens a call reserved but did not use; negative tokens charge usage above the reservation."""
+        if not tokens:
+            return
+        connection = self._connect()
+        try:
+            connection.execute("UPDATE buckets SET tokens = tokens + ? WHERE name = ?", (tokens, name))
+        finally:
+            connection.close()
+
+    def stats(self):
+        """Return the current balance of every bucket and this process's waiting totals."""
+        connection = self._connect()
+        try:
+            buckets = dict(connection.execute("SELECT name, tokens FROM buckets").fetchall())
+        finally:
+            connection.close()
+        return {
+            "buckets": buckets,
+            "waits": self.waits,
+            "seconds_waited": round(self.waited, 3),
+            "rejected": self.rejected,
+            "max_wait": RATE_LIMIT_MAX_WAIT
+        }
+
+
+rate_limiter = RateLimiter()
+model_limits = parse_limits(RATE_LIMITS)
+
+
+def chat_limits(model):
+    """Return the (rpm, tpm) limits for a chat model."""
+    rpm, tpm = model_limits.get(model, (RATE_LIMIT_CHAT_RPM, RATE_LIMIT_CHAT_TPM))
+    return rpm, RATE_LIMIT_CHAT_TPM if tpm is None else tpm
+
+
+def estimate_tokens(request):
+    """Estimate the tokens a chat request counts against the limit: its prompt plus the completion it may use."""
+    prompt = sum(len(str(message.get("content") or "")) for message in request.get("messages", []))
+    return prompt // CHARS_PER_TOKEN + request.get("max_tokens", 1000)
+
+
+class RateLimitedChatCompletions:
+    """Drop-in replacement for client.chat.completions that waits for the model's rate limit."""
+
+    def __init__(self, completions, limiter):
+        self._completions = completions
+        self._limiter = limiter
+
+    def create(self, **request):
+        if not RATE_LIMIT_ENABLED:
+            return self._completions.create(**request)
+
+        model = request.get("model", "")
+        rpm, tpm = chat_limits(model)
+        estimate = estimate_tokens(request)
+        self._limiter.acquire({f"{model}:requests": (1, rpm), f"{model}:tokens": (estimate, tpm)})
+        response = self._completions.create(**request)
+        usage = getattr(response, "usage", None)
+        if usage:
+            self._limiter.refund(f"{model}:tokens", min(estimate, tpm) - usage.total_tokens)
+        return response
+
+
+class RateLimitedImages:
+    """Drop-in replacement for client.images that waits for the image model's rate limit."""
+
+    def __init__(self, images, limiter):
+        self._images = images
+        self._limiter = limiter
+
+    def generate(self, **request):
+        if RATE_LIMIT_ENABLED:
+            model = request.get("model", "dall-e-2")
+            rpm = model_limits.get(model, (RATE_LIMIT_IMAGE_RPM, None))[0]
+            self._limiter.acquire({f"{model}:images": (request.get("n", 1), rpm)})
+        return self._images.generate(**request)
+
+    def __getattr__(self, name):
+        return getattr(self._images, name)
+
+
+class RateLimitedOpenAI:
+    """Wrap an OpenAI client so chat completions and image generations respect the shared rate limits."""
+
+    def __init__(self, client, limiter=rate_limiter):
+        self._client = client
+        self.chat = SimpleNamespace(completions=RateLimitedChatCompletions(client.chat.completions, limiter))
+        self.images = RateLimitedImages(client.images, limiter)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
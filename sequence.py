@@ -1,8 +1,8 @@
-import os
 import logging
 from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from openai import OpenAI
+from structured_output import stream_batched, StructuredOutputError, markdown_section, numbered_items
+from quiz_registry import register_quiz_type
 
 # Load environment variables
 load_dotenv()
@@ -11,58 +11,52 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Get OpenAI API key from environment variables
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    logger.error("OPENAI_API_KEY environment variable not set")
-    exit()
-
-# Initialize OpenAI client with API key
-client = OpenAI(api_key=openai_api_key)
-
 app = Flask(__name__)
 
-def generate_sequence_question(subject: str, tone: str):
-    """Generate a sequence arrangement question."""
-    description_prompt = [
+# Structured answer for one question: five steps in random order and their correct order
+SEQUENCE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "question": {"type": "string", "minLength": 1},
+        "options": {"type": "array", "items": {"type": "string", "minLength": 1}, "minItems": 5, "maxItems": 5},
+        "answers": {
+            "type": "array",
+            "description": "Option numbers, counting from 1, in the correct order",
+            "items": {"type": "integer", "minimum": 1, "maximum": 5},
+            "minItems": 5,
+            "maxItems": 5,
+            "uniqueItems": True
+        },
+        "sequence": {
+            "type": "array",
+            "description": "The steps in the correct order",
+            "items": {"type": "string", "minLength": 1},
+            "minItems": 1
+        }
+    },
+    "required": ["question", "options", "answers", "sequence"],
+    "additionalProperties": False
+}
+
+def parse_sequence_markdown(content):
+    """Parse the **Question:**/**Options:**/**Correct Sequence:**/**Correct Order:** format."""
+    return {
+        "question": markdown_section(content, "Question", "Options"),
+        "options": numbered_items(markdown_section(content, "Options", "Correct Sequence")),
+        "answers": [int(num.strip()) for num in markdown_section(content, "Correct Sequence", "Correct Order").split(',')],
+        "sequence": [step.strip() for step in markdown_section(content, "Correct Order").split('\n')]
+    }
+
+def sequence_question_prompt(subject: str, tone: str):
+    """Build the prompt for a sequence arrangement question."""
+    return [
         {"role": "system", "content": "You are an expert in generating educational content."},
         {"role": "user", "content": f"Generate a sequence arrangement question based on the subject '{subject}'. Provide a list of steps in random order and the correct sequence as a list of numbers. Use the following format:\n\n**Question:** [Question asking to arrange the steps in the correct order]\n\n**Options:**\n1. [Option 1]\n2. [Option 2]\n3. [Option 3]\n4. [Option 4]\n5. [Option 5]\n\n**Correct Sequence:** [Correct order by numbers]\n\n**Correct Order:** [Correct order as a list of steps]\n\nEnsure that all steps are related to the subject and are necessary for the process described."}
     ]
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=description_prompt,
-            max_tokens=1000,
-            temperature=0.5
-        )
-        content = response.choices[0].message.content
-
-        question_section = content.split("**Question:**")[1].split("**Options:**")[0].strip()
-        options_section = content.split("**Options:**")[1].split("**Correct Sequence:**")[0].strip()
-        correct_sequence_section = content.split("**Correct Sequence:**")[1].split("**Correct Order:**")[0].strip()
-        correct_order_section = content.split("**Correct Order:**")[1].strip()
-
-        options_list = options_section.split('\n')
-        if len(options_list) != 5:
-            raise ValueError("Expected exactly 5 options, but found a different number.")
-
-        options_dict = {
-            f"option{i+1}": option.split('. ', 1)[-1].strip()  # Remove leading "1. ", "2. ", etc.
-            for i, option in enumerate(options_list)
-        }
-        correct_sequence_list = [int(num.strip()) for num in correct_sequence_section.split(',')]
-        correct_order_list = [step.strip() for step in correct_order_section.split('\n')]
-
-        return {
-            "question": question_section,
-            "options": list(options_dict.values()),  # Convert options_dict to a list
-            "answers": correct_sequence_list,
-            "sequence": correct_order_list
-        }
-    except Exception as e:
-        logger.error(f"Error generating sequence question: {e}")
-        return {"error": "Failed to generate sequence question"}
+def stream_sequence_quiz(number, subject, tone):
+    """Yield the sequence questions one at a time, as soon as the batch each one arrived in has been validated."""
+    return stream_batched(sequence_question_prompt(subject, tone), SEQUENCE_SCHEMA, parse_sequence_markdown, number)
 
 def generate_sequence_quiz(number, subject, tone):
     """Generate custom content based on user-provided parameters."""
@@ -70,18 +64,24 @@ def generate_sequence_quiz(number, subject, tone):
         if number < 1 or number > 10:  # Ensure number is within allowed range
             return {"error": "Number of questions must be between 1 and 10"}, 400
 
-        questions = []
-        for _ in range(number):
-            question = generate_sequence_question(subject, tone)
-            if "error" in question:
-                return {"error": "Failed to generate sequence question"}, 500
-            questions.append(question)
-
-        return questions
+        try:
+            return list(stream_sequence_quiz(number, subject, tone))
+        except StructuredOutputError as e:
+            logger.error(f"Error generating sequence questions: {e}")
+            return {"error": "Failed to generate sequence question"}, 500
     except Exception as e:
         logger.error(f"Error generating custom content: {e}")
         return {"error": "Internal server error"}, 500
 
+register_quiz_type(
+    400,
+    "Match the Sequence with drag and drop feature",
+    generate_sequence_quiz,
+    max_questions=10,
+    schema=SEQUENCE_SCHEMA,
+    stream=stream_sequence_quiz
+)
+
 @app.route('/custom', methods=['POST'])
 def custom_content():
     """Endpoint to generate custom content based on user-provided parameters."""
@@ -1,8 +1,8 @@
-import os
 import logging
 from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from openai import OpenAI
+from structured_output import stream_batched, StructuredOutputError, choice_schema, parse_choice_markdown
+from quiz_registry import register_quiz_type
 
 # Load environment variables
 load_dotenv()
@@ -11,56 +11,30 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Get OpenAI API key from environment variables
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    logger.error("OPENAI_API_KEY environment variable not set")
-    exit()
-
-# Initialize OpenAI client with API key
-client = OpenAI(api_key=openai_api_key)
-
 app = Flask(__name__)
 
-def generate_mcq(subject: str, tone: str):
-    """Generate a multiple-choice question (MCQ) with four text options."""
-    description_prompt = [
+# Structured answer for one question: four options and exactly one correct option number
+MCQ_SCHEMA = choice_schema(4)
+
+def mcq_prompt(subject: str, tone: str):
+    """Build the prompt for a multiple-choice question (MCQ) with four text options."""
+    return [
         {"role": "system", "content": "You are an expert in generating educational content."},
         {"role": "user", "content": f"Generate a clear and understandable question with exactly four options based on the subject '{subject}'. The question should have exactly one correct answer. Each option should be related to the concept in the subject and in a '{tone}' tone. Use the following format:\n\n**Question:** [Question based on the subject]\n\n**Options:**\n1. [Option 1]\n2. [Option 2]\n3. [Option 3]\n4. [Option 4]\n\n**Correct Answer:** [Correct Option by number]\n\nEnsure that all four options are provided and exactly one correct answer."}
     ]
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=description_prompt,
-            max_tokens=1000,
-            temperature=0.5
-        )
-        content = response.choices[0].message.content
-
-        question_section = content.split("**Question:**")[1].split("**Options:**")[0].strip()
-        options_section = content.split("**Options:**")[1].split("**Correct Answer:**")[0].strip()
-        correct_answer_section = content.split("**Correct Answer:**")[1].strip()
-
-        options_list = options_section.split('\n')
-        options_dict = {
-            f"option{i+1}": option.split('. ', 1)[-1].strip()  # Remove leading "1. ", "2. ", etc.
-            for i, option in enumerate(options_list)
-        }
-
-        # Extract the correct answer number, assuming it's formatted like "2. ..."
-        correct_answer_number = correct_answer_section.split('.')[0].strip()
-        correct_answer_index = int(correct_answer_number)
-        correct_answer_mapped = [f"option{correct_answer_index}"]
-
-        return {
-            "question": question_section,
-            "options": options_dict,
-            "correct_answers": correct_answer_mapped
-        }
-    except Exception as e:
-        logger.error(f"Error generating MCQ: {e}")
-        return {"error": "Failed to generate MCQ"}
+def format_mcq(mcq):
+    """Return a structured MCQ in the response format."""
+    return {
+        "question": mcq["question"],
+        "options": {f"option{i+1}": option for i, option in enumerate(mcq["options"])},
+        "correct_answers": [f"option{number}" for number in mcq["correct_answers"]]
+    }
+
+def stream_quiz(number, subject, tone):
+    """Yield the MCQs one at a time, as soon as the batch each one arrived in has been validated."""
+    for mcq in stream_batched(mcq_prompt(subject, tone), MCQ_SCHEMA, parse_choice_markdown, number):
+        yield format_mcq(mcq)
 
 def generate_quiz(number, subject, tone):
     """Generate custom content based on user-provided parameters."""
@@ -68,18 +42,17 @@ def generate_quiz(number, subject, tone):
         if number < 1 or number > 10:  # Ensure number is within allowed range
             return {"error": "Number of questions must be between 1 and 10"}, 400
 
-        mcqs = []
-        for _ in range(number):
-            mcq = generate_mcq(subject, tone)
-            if "error" in mcq:
-                return {"error": "Failed to generate MCQ"}, 500
-            mcqs.append(mcq)
-
-        return mcqs
+        try:
+            return list(stream_quiz(number, subject, tone))
+        except StructuredOutputError as e:
+            logger.error(f"Error generating MCQ: {e}")
+            return {"error": "Failed to generate MCQ"}, 500
     except Exception as e:
         logger.error(f"Error generating custom content: {e}")
         return {"error": "Internal server error"}, 500
 
+register_quiz_type(100, "Simple Radio Button", generate_quiz, max_questions=10, schema=MCQ_SCHEMA, stream=stream_quiz)
+
 @app.route('/custom', methods=['POST'])
 def custom_content():
     """Endpoint to generate custom content based on user-provided parameters."""
@@ -0,0 +1,92 @@
+import json
+import logging
+from concurrent.futures import as_completed
+from dotenv import load_dotenv
+from concurrency import stream_executor
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STREAM_MIMETYPES = {
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream"
+}
+
+
+def stream_format(stream, accept=""):
+    """Map the stream query parameter (and Accept header) to "ndjson", "sse" or None."""
+    if not stream or stream in ("0", "false"):
+        return None
+    if stream == "sse" or (stream != "ndjson" and "text/event-stream" in accept):
+        return "sse"
+    return "ndjson"
+
+
+def _encode(event, record, fmt):
+    data = json.dumps(record)
+    if fmt == "sse":
+        return f"event: {event}\ndata: {data}\n\n"
+    return data + "\n"
+
+
+def _error_message(response):
+    """Pull the error message out of a generator's {"error": ...} or ({"error": ...}, status) result."""
+    if isinstance(response, tuple):
+        response = response[0]
+    if isinstance(response, dict):
+        return response.get("error", "Failed to generate question")
+    return "Failed to generate question"
+
+
+def stream_questions(generate_one, number, fmt):
+    """Run generate_one() number times concurrently and yield each question as soon as it is ready.
+
+    generate_one() must return the same shape as a generator called with number=1:
+    a one-element list on success or an error dict/tuple. Records carry the index of
+    the question they belong to, since they arrive in completion order.
+    """
+    futures = {stream_executor.submit(generate_one): index for index in range(number)}
+    generated = 0
+    failed = 0
+
+    for future in as_completed(futures):
+        index = futures[future]
+        try:
+            response = future.result()
+        except Exception as e:
+            logger.error(f"Error generating streamed question {index}: {e}")
+            response = {"error": str(e)}
+
+        if isinstance(response, list) and response:
+            generated += 1
+            yield _encode("question", {"index": index, "question": response[0]}, fmt)
+        else:
+            failed += 1
+            yield _encode("error", {"index": index, "error": _error_message(response)}, fmt)
+
+    yield _encode("done", {"done": True, "generated": generated, "failed": failed}, fmt)
+
+
+def stream_generated(questions, number, fmt):
+    """Yield a record for each question from the iterator questions as it arrives.
+
+    Used for quiz types that generate their questions in batches. If the iterator
+    fails before producing number questions, an error record is sent for each
+    missing index.
+    """
+    generated = 0
+    try:
+        for question in questions:
+            yield _encode("question", {"index": generated, "question": question}, fmt)
+            generated += 1
+    except Exception as e:
+        logger.error(f"Error generating streamed questions: {e}")
+
+    for index in range(generated, number):
+        yield _encode("error", {"index": index, "error": "Failed to generate question"}, fmt)
+
+    yield _encode("done", {"done": True, "generated": generated, "failed": number - generated}, fmt)
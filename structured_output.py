@@ -0,0 +1,339 @@
+import os
+import re
+import json
+import logging
+from concurrent.futures import as_completed
+from dotenv import load_dotenv
+from llm_cache import discard_last_response
+from openai_client import client, OPENAI_CHAT_MODEL
+from concurrency import question_executor
+from progress import report
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Ask the model for JSON matching the quiz type's schema before falling back to the markdown format
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "1") == "1"
+
+# Send response_format=json_object with structured requests: "1", "0" or "auto" (only for models that accept it)
+LLM_JSON_MODE = os.getenv("LLM_JSON_MODE", "auto")
+
+# Questions requested per call by the batched generators; 1 requests every question separately
+LLM_BATCH_SIZE = int(os.getenv("LLM_BATCH_SIZE", "5"))
+
+# Output token limit for one batched call (the model's completion limit)
+LLM_BATCH_MAX_TOKENS = int(os.getenv("LLM_BATCH_MAX_TOKENS", "4096"))
+
+# Batched rounds used to re-request questions that failed validation before asking for them one at a time
+BATCH_ROUNDS = 2
+
+# Chat models that reject response_format={"type": "json_object"}
+LEGACY_CHAT_MODELS = {
+    "gpt-4", "gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0314", "gpt-4-32k-0613",
+    "gpt-3.5-turbo-0301", "gpt-3.5-turbo-0613", "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613"
+}
+
+# Python types accepted for each JSON Schema type
+JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "boolean": bool
+}
+
+
+class StructuredOutputError(ValueError):
+    """Raised when a model response cannot be turned into an object matching its schema."""
+
+
+def json_mode(model=OPENAI_CHAT_MODEL):
+    """Return whether requests for model should set the JSON response format."""
+    if LLM_JSON_MODE == "auto":
+        return model not in LEGACY_CHAT_MODELS
+    return LLM_JSON_MODE == "1"
+
+
+def validate(instance, schema, path="$", errors=None):
+    """Check instance against the JSON Schema subset the quiz schemas use, returning every error in one pass."""
+    errors = [] if errors is None else errors
+    expected = schema.get("type")
+    # bool is an int subclass, but true is never a valid option number
+    if expected and (not isinstance(instance, JSON_TYPES[expected]) or (expected == "integer" and isinstance(instance, bool))):
+        errors.append(f"{path}: expected {expected}")
+        return errors
+    if "enum" in schema and instance not in schema["enum"]:
+        errors.append(f"{path}: must be one of {schema['enum']}")
+    if isinstance(instance, str) and len(instance.strip()) < schema.get("minLength", 0):
+        errors.append(f"{path}: too short")
+    if isinstance(instance, int):
+        if instance < schema.get("minimum", instance) or instance > schema.get("maximum", instance):
+            errors.append(f"{path}: out of range")
+    if isinstance(instance, list):
+        if not schema.get("minItems", 0) <= len(instance) <= schema.get("maxItems", len(instance)):
+            errors.append(f"{path}: has {len(instance)} items")
+        if schema.get("uniqueItems") and len(set(map(json.dumps, instance))) != len(instance):
+            errors.append(f"{path}: items are not unique")
+        for index, item in enumerate(instance):
+            validate(item, schema.get("items", {}), f"{path}[{index}]", errors)
+    if isinstance(instance, dict):
+        properties = schema.get("properties", {})
+        for name in schema.get("required", []):
+            if name not in instance:
+                errors.append(f"{path}: missing {name}")
+        for name, value in instance.items():
+            if name in properties:
+                validate(value, properties[name], f"{path}.{name}", errors)
+            elif schema.get("additionalProperties") is False:
+                errors.append(f"{path}: unexpected {name}")
+    return errors
+
+
+def check(instance, schema):
+    """Return instance if it matches schema, otherwise raise StructuredOutputError listing the problems."""
+    errors = validate(instance, schema)
+    if errors:
+        raise StructuredOutputError("; ".join(errors))
+    return instance
+
+
+def choice_schema(option_count, min_correct=1, max_correct=1):
+    """Schema for a question with option_count text options and numbered correct answers."""
+    return {
+        "type": "object",
+        "properties": {
+            "question": {"type": "string", "minLength": 1},
+            "options": {
+                "type": "array",
+                "items": {"type": "string", "minLength": 1},
+                "minItems": option_count,
+                "maxItems": option_count,
+                "uniqueItems": True
+            },
+            "correct_answers": {
+                "type": "array",
+                "description": "Numbers of the correct options, counting from 1",
+                "items": {"type": "integer", "minimum": 1, "maximum": option_count},
+                "minItems": min_correct,
+                "maxItems": max_correct,
+                "uniqueItems": True
+            }
+        },
+        "required": ["question", "options", "correct_answers"],
+        "additionalProperties": False
+    }
+
+
+def complete(messages, max_tokens=1000, temperature=0.5, **kwargs):
+    """Return the text of a chat completion for messages."""
+    response = client.chat.completions.create(
+        model=OPENAI_CHAT_MODEL,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        **kwargs
+    )
+    return response.choices[0].message.content
+
+
+def json_messages(messages, schema):
+    """Append the instruction to answer with JSON matching schema instead of the markdown format."""
+    return messages + [{
+        "role": "system",
+        "content": (
+            "Ignore any markdown format requested above. Respond with a single JSON object, and nothing else, "
+            f"that matches this JSON Schema:\n{json.dumps(schema)}"
+        )
+    }]
+
+
+def parse_json(content):
+    """Decode the JSON object in content, tolerating a code fence or text around it."""
+    start, end = content.find("{"), content.rfind("}")
+    if start == -1 or end < start:
+        raise StructuredOutputError("response contains no JSON object")
+    try:
+        return json.loads(content[start:end + 1])
+    except json.JSONDecodeError as e:
+        raise StructuredOutputError(f"invalid JSON: {e}") from e
+
+
+def generate_structured(messages, schema, parse_markdown, max_tokens=1000, temperature=0.5):
+    """Generate one object matching schema, asking for JSON first and falling back to the markdown prompt.
+
+    parse_markdown turns the markdown response into the same object. Raises
+    StructuredOutputError when neither response matches the schema.
+    """
+    if LLM_STRUCTURED_OUTPUT:
+        kwargs = {"response_format": {"type": "json_object"}} if json_mode() else {}
+        content = complete(json_messages(messages, schema), max_tokens, temperature, **kwargs)
+        try:
+            return check(parse_json(content or ""), schema)
+        except StructuredOutputError as e:
+            logger.warning(f"Structured response rejected, falling back to markdown: {e}")
+            discard_last_response()
+
+    content = complete(messages, max_tokens, temperature)
+    try:
+        parsed = parse_markdown(content)
+    except Exception as e:
+        discard_last_response()
+        raise StructuredOutputError(f"unparseable markdown response: {e}") from e
+    try:
+        return check(parsed, schema)
+    except StructuredOutputError:
+        discard_last_response()
+        raise
+
+
+def batch_messages(messages, schema, count):
+    """Append the instruction to answer with count questions, each matching schema, in one JSON object."""
+    return messages + [{
+        "role": "system",
+        "content": (
+            f"Generate {count} different questions following the instructions above. Ignore any markdown format "
+            'requested above. Respond with a single JSON object, and nothing else, of the form {"questions": [...]}, '
+            f"where the list holds exactly {count} objects that each match this JSON Schema:\n{json.dumps(schema)}"
+        )
+    }]
+
+
+def request_batch(messages, schema, count, max_tokens=1000, temperature=0.5):
+    """Ask for count questions in one call and return the ones that match schema (possibly none)."""
+    kwargs = {"response_format": {"type": "json_object"}} if json_mode() else {}
+    try:
+        content = complete(
+            batch_messages(messages, schema, count), min(max_tokens * count, LLM_BATCH_MAX_TOKENS), temperature, **kwargs
+        )
+    except Exception as e:
+        logger.error(f"Error requesting a batch of {count} questions: {e}")
+        return []
+    try:
+        questions = parse_json(content or "").get("questions")
+        if not isinstance(questions, list):
+            raise StructuredOutputError("response has no questions list")
+    except (StructuredOutputError, AttributeError) as e:
+        logger.warning(f"Batched response rejected: {e}")
+        discard_last_response()
+        return []
+
+    valid = []
+    for index, question in enumerate(questions[:count]):
+        errors = validate(question, schema)
+        if errors:
+            logger.warning(f"Question {index + 1} of a batch of {count} rejected: {'; '.join(errors)}")
+        else:
+            valid.append(question)
+    if len(valid) < count:
+        # Never replay a response that will fail the same way again
+        discard_last_response()
+    return valid
+
+
+def stream_batched(messages, schema, parse_markdown, number, batch_size=LLM_BATCH_SIZE, max_tokens=1000,
+                   temperature=0.5):
+    """Yield number objects matching schema as soon as the batch each one arrived in has been validated.
+
+    Up to batch_size questions are requested per call. Each question of a batch is
+    validated on its own and only the missing ones are requested again; whatever
+    is still missing after BATCH_ROUNDS is generated one at a time with
+    generate_structured. Raises StructuredOutputError, after yielding the questions
+    it did get, if some questions could not be generated.
+    """
+    report(questions_total=number)
+    produced = 0
+    seen = set()
+
+    def fresh(batch):
+        nonlocal produced
+        kept = []
+        for question in batch:
+            # Separate batches can repeat each other's questions
+            key = json.dumps(question, sort_keys=True)
+            if key not in seen and produced < number:
+                seen.add(key)
+                produced += 1
+                kept.append(question)
+                report(questions_done=1)
+        return kept
+
+    if LLM_STRUCTURED_OUTPUT and batch_size > 1 and number > 1:
+        for _ in range(BATCH_ROUNDS):
+            missing = number - produced
+            if missing <= 0:
+                break
+            sizes = [min(batch_size, missing - start) for start in range(0, missing, batch_size)]
+            logger.info(f"Requesting {missing} questions in {len(sizes)} batched call(s)")
+            futures = [
+                question_executor.submit(request_batch, messages, schema, size, max_tokens, temperature)
+                for size in sizes
+            ]
+            for future in as_completed(futures):
+                yield from fresh(future.result())
+
+    def generate_one():
+        try:
+            return generate_structured(messages, schema, parse_markdown, max_tokens, temperature)
+        except Exception as e:
+            logger.error(f"Error generating question: {e}")
+            return None
+
+    missing = number - produced
+    if missing > 0:
+        futures = [question_executor.submit(generate_one) for _ in range(missing)]
+        for future in as_completed(futures):
+            question = future.result()
+            if question is not None:
+                produced += 1
+                report(questions_done=1)
+                yield question
+        if produced < number:
+            raise StructuredOutputError(f"generated {produced} of {number} questions")
+
+
+def markdown_section(content, heading, next_heading=None):
+    """Return the stripped text between **heading:** and **next_heading:** (or the end of content)."""
+    section = content.split(f"**{heading}:**")[1]
+    if next_heading:
+        section = section.split(f"**{next_heading}:**")[0]
+    return section.strip()
+
+
+def numbered_items(section):
+    """Return the text of each "1. item" line in section."""
+    return [line.split('. ', 1)[-1].strip() for line in section.split('\n') if line.strip()]
+
+
+def answer_number(answer, options):
+    """Return the 1-based number of an answer given either as an option's text or as its number."""
+    answer = answer.strip()
+    if answer in options:
+        return options.index(answer) + 1
+    match = re.match(r"(?:option\s*)?(\d+)", answer, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Correct answer is not one of the options: {answer}")
+    return int(match.group(1))
+
+
+def parse_choice_markdown(content, answers_heading="Correct Answer"):
+    """Parse the numbered **Question:**/**Options:**/**Correct Answer:** format used by the choice prompts.
+
+    Under a plural **Correct Answers:** heading the answers are comma-separated.
+    """
+    options = numbered_items(markdown_section(content, "Options", answers_heading))
+    answers_section = markdown_section(content, answers_heading).split('\n')[0]
+    answers = answers_section.split(',') if answers_heading.endswith("s") else [answers_section]
+    return {
+        "question": markdown_section(content, "Question", "Options"),
+        "options": options,
+        "correct_answers": [answer_number(answer, options) for answer in answers if answer.strip()]
+    }
+
+
+def parse_checkbox_markdown(content):
+    """Parse the choice format with comma-separated **Correct Answers:**."""
+    return parse_choice_markdown(content, "Correct Answers")
@@ -1,12 +1,17 @@
-import os
 import logging
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from PIL import Image
-import requests
-from io import BytesIO
-from openai import OpenAI
+from image_store import ImageStore
+from image_serving import send_image
+from image_utils import IMAGE_RESPONSE_FORMAT, fetch_image, image_source, render_image
+from llm_cache import discard_last_response
+from openai_client import client
+from rate_limit import RateLimitExceeded
+from structured_output import generate_structured, choice_schema, parse_checkbox_markdown
+from circuit_breaker import CircuitOpenError
+from concurrency import generate_concurrently, generate_images_concurrently, submit_image
 import random
+from quiz_registry import register_quiz_type, QUESTION_IMAGE_SIZE, OPTION_IMAGE_SIZE
 
 # Load environment variables
 load_dotenv()
@@ -15,39 +20,23 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Get OpenAI API key from environment variables
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    logger.error("OPENAI_API_KEY environment variable not set")
-    exit()
-
-# Initialize OpenAI client with API key
-client = OpenAI(api_key=openai_api_key)
-
 app = Flask(__name__)
 
-# In-memory storage for images
-image_store_sub1 = {}
+# Disk-backed image storage shared by all workers
+image_store_sub1 = ImageStore("image_store_sub1")
 
-def download_and_resize_image(image_url, target_size, retries=3):
-    """Download an image from the given URL, resize it, and store it in-memory with retry logic."""
+# Structured answer for one sub-question: four options and up to four correct option numbers
+CHECKBOX_SCHEMA = choice_schema(4, max_correct=4)
+
+def download_and_resize_image(source, target_size, retries=3):
+    """Fetch a generated image, resize it, and store it in the image store with retry logic."""
     try:
-        logger.info(f"Downloading image from URL: {image_url}")
-        response = requests.get(image_url)
-        response.raise_for_status()
-        image = Image.open(BytesIO(response.content))
-        resized_image = image.resize(target_size, Image.LANCZOS)
-        output = BytesIO()
-        resized_image.save(output, format='PNG')
-        output.seek(0)
-        image_key = f"image_{len(image_store_sub1) + 1}.png"
-        image_store_sub1[image_key] = output
-        return image_key
+        return image_store_sub1.add(*render_image(fetch_image(source), target_size))
     except Exception as e:
         logger.error(f"Error resizing image: {e}")
         if retries > 0:
             logger.info(f"Retrying download and resize, {retries} retries left.")
-            return download_and_resize_image(image_url, target_size, retries - 1)
+            return download_and_resize_image(source, target_size, retries - 1)
         return None
 
 def generate_image(prompt: str, retries: int = 3):
@@ -59,9 +48,17 @@ def generate_image(prompt: str, retries: int = 3):
             model="dall-e-3",
             prompt=safe_prompt,
             n=1,
-            size="1024x1024"
+            size="1024x1024",
+            response_format=IMAGE_RESPONSE_FORMAT
         )
-        return response.data[0].url if response.data else None
+        return image_source(response.data[0]) if response.data else None
+    except RateLimitExceeded:
+        # Fail the whole request with 429 instead of serving placeholder images
+        raise
+    except CircuitOpenError as e:
+        # Rewording the prompt will not help while the image API is down
+        logger.error(f"Error generating image: {e}")
+        return None
     except Exception as e:
         logger.error(f"Error generating image: {e}")
         if retries > 0:
@@ -70,14 +67,6 @@ def generate_image(prompt: str, retries: int = 3):
             return generate_image(modified_prompt, retries - 1)
         return None
 
-def parse_correct_answers(correct_answers_section):
-    """Parse the correct answers section to extract indices."""
-    try:
-        return [int(index.strip()) - 1 for index in correct_answers_section.split(',')]
-    except ValueError as e:
-        logger.error(f"Error parsing correct answers: {e}")
-        return []
-
 def generate_mcq(subject: str, tone: str):
     """Generate a multiple-choice question based on the subject."""
     description_prompt = [
@@ -86,34 +75,18 @@ def generate_mcq(subject: str, tone: str):
     ]
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=description_prompt,
-            max_tokens=1000,
-            temperature=0.5
-        )
-        content = response.choices[0].message.content
-
-        question_section = content.split("**Question:**")[1].split("**Options:**")[0].strip()
-        options_section = content.split("**Options:**")[1].split("**Correct Answers:**")[0].strip()
-        correct_answers_section = content.split("**Correct Answers:**")[1].strip()
-
-        options = options_section.split('\n')
-        if len(options) != 4:
-            raise ValueError("Generated options do not contain exactly 4 items")
-
-        option_prompts = [option.split('. ', 1)[1].strip() for option in options]
+        mcq = generate_structured(description_prompt, CHECKBOX_SCHEMA, parse_checkbox_markdown)
+        question_section = mcq["question"]
+        option_prompts = mcq["options"]
 
         # Extracting correct answer indices
-        correct_answer_indices = parse_correct_answers(correct_answers_section)
-        
-        # Ensure the number of correct answers is between 2 and 4
+        correct_answer_indices = [number - 1 for number in mcq["correct_answers"]]
+
+        # Ensure the number of correct answers is at least 2
         if len(correct_answer_indices) < 2:
             additional_indices = list(set(range(4)) - set(correct_answer_indices))
             correct_answer_indices += random.sample(additional_indices, 2 - len(correct_answer_indices))
-        elif len(correct_answer_indices) > 4:
-            correct_answer_indices = random.sample(correct_answer_indices, 4)
-        
+
         correct_answers = [f"Option {i + 1}" for i in correct_answer_indices]
 
         return {
@@ -123,6 +96,7 @@ def generate_mcq(subject: str, tone: str):
         }
     except Exception as e:
         logger.error(f"Error generating MCQ: {e}")
+        discard_last_response()
         return {"error": "Failed to generate MCQ"}
 
 def generate_custom_content_sub1(number, subject, tone):
@@ -132,28 +106,30 @@ def generate_custom_content_sub1(number, subject, tone):
             return {"error": "Number of questions must be between 1 and 10"}, 400
 
         main_prompt = f"Generate a main question with context for the following subject: {subject}"
+        # The main image only depends on the subject, so generate it alongside the questions
+        main_image = submit_image(subject, QUESTION_IMAGE_SIZE, generate_image, download_and_resize_image)
+
         main_question_response = generate_mcq(subject, tone)
         if "error" in main_question_response:
             return {"error": "Failed to generate main question"}, 500
-        
-        main_image_url = generate_image(subject)
-        main_image_key = download_and_resize_image(main_image_url, (750, 319)) if main_image_url else "placeholder_image_url"
+
+        # Each question has exactly 3 sub-questions
+        all_sub_questions = generate_concurrently(generate_mcq, number * 3, subject, tone)
+
+        main_image_key = main_image.result() or "placeholder_image_url"
         if main_image_key == "placeholder_image_url":
             return {"error": "Failed to generate main image"}, 500
 
-        questions = []
-        for _ in range(number):
-            sub_questions = []
-            for sub_idx in range(3):  # Each question has exactly 3 sub-questions
-                sub_question = generate_mcq(subject, tone)
-                if not sub_question:
-                    return {"error": f"Failed to generate sub-question {sub_idx + 1}"}, 500
-                sub_questions.append(sub_question)
+        for idx, sub_question in enumerate(all_sub_questions):
+            if not sub_question:
+                return {"error": f"Failed to generate sub-question {idx % 3 + 1}"}, 500
 
+        questions = []
+        for idx in range(number):
             questions.append({
                 "main_question": main_question_response["question"],
                 "image": f"/image/{main_image_key}",
-                "sub_questions": sub_questions
+                "sub_questions": all_sub_questions[idx * 3:(idx + 1) * 3]
             })
 
         return format_questions_as_sections(questions)
@@ -161,13 +137,36 @@ def generate_custom_content_sub1(number, subject, tone):
         logger.error(f"Error generating custom content: {e}")
         return {"error": "Internal server error"}, 500
 
+register_quiz_type(
+    800,
+    "Simple Radio Button and Text/Image Sub Question",
+    generate_custom_content_sub1,
+    max_questions=10,
+    image_store=image_store_sub1,
+    image_sizes={"question": QUESTION_IMAGE_SIZE, "option": OPTION_IMAGE_SIZE},
+    schema=CHECKBOX_SCHEMA
+)
+
 def format_questions_as_sections(questions):
     """Format questions in the specified structure."""
+    # Pick every content type up front so all sub-question images can be generated at once
+    content_types = [
+        [random.choice(['text', 'image', 'text_with_image']) for _ in question["sub_questions"]]
+        for question in questions
+    ]
+    image_prompts = [
+        sub_question.get("question", "")
+        for question, question_content_types in zip(questions, content_types)
+        for sub_question, content_type in zip(question["sub_questions"], question_content_types)
+        if content_type != 'text'
+    ]
+    image_keys = iter(generate_images_concurrently(image_prompts, OPTION_IMAGE_SIZE, generate_image, download_and_resize_image))
+
     formatted_questions = []
     for idx, question in enumerate(questions):
         sub_question_formatted = []
         for sub_idx, sub_question in enumerate(question["sub_questions"]):
-            content_type = random.choice(['text', 'image', 'text_with_image'])
+            content_type = content_types[idx][sub_idx]
             if content_type == 'text':
                 sub_question_formatted.append({
                     f"Sub Question No. {sub_idx + 1}": {
@@ -177,9 +176,7 @@ def format_questions_as_sections(questions):
                     }
                 })
             elif content_type == 'image':
-                image_prompt = sub_question.get("question", "")
-                image_url = generate_image(image_prompt)
-                image_key = download_and_resize_image(image_url, (270, 140)) if image_url else "placeholder_image_url"  # Option image size: 270x140 px
+                image_key = next(image_keys) or "placeholder_image_url"
                 sub_question_formatted.append({
                     f"Sub Question No. {sub_idx + 1}": {
                         "image": f"/image/{image_key}",
@@ -188,9 +185,7 @@ def format_questions_as_sections(questions):
                     }
                 })
             else:  # text_with_image
-                image_prompt = sub_question.get("question", "")
-                image_url = generate_image(image_prompt)
-                image_key = download_and_resize_image(image_url, (270, 140)) if image_url else "placeholder_image_url"  # Option image size: 270x140 px
+                image_key = next(image_keys) or "placeholder_image_url"
                 sub_question_formatted.append({
                     f"Sub Question No. {sub_idx + 1}": {
                         "question": sub_question.get("question", ""),
@@ -253,10 +248,9 @@ def generate_content():
 def get_image(image_key):
     """Endpoint to retrieve an image by its key."""
     try:
-        image = image_store_sub1.get(image_key)
-        if not image:
+        if image_key not in image_store_sub1:
             return jsonify({"error": "Image not found"}), 404
-        return send_file(image, mimetype='image/png')
+        return send_image(image_store_sub1, image_key)
     except Exception as e:
         logger.error(f"Error retrieving image: {e}")
         return jsonify({"error": "Internal server error"}), 500
@@ -1,12 +1,17 @@
-import os
 import logging
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from PIL import Image
-import requests
-from io import BytesIO
-from openai import OpenAI
+from image_store import ImageStore
+from image_serving import send_image
+from image_utils import IMAGE_RESPONSE_FORMAT, fetch_image, image_source, render_image
+from llm_cache import discard_last_response
+from openai_client import client
+from rate_limit import RateLimitExceeded
+from structured_output import generate_structured, choice_schema, parse_checkbox_markdown
+from circuit_breaker import CircuitOpenError
+from concurrency import generate_concurrently, generate_images_concurrently, image_executor
 import random
+from quiz_registry import register_quiz_type, QUESTION_IMAGE_SIZE, OPTION_IMAGE_SIZE
 
 # Load environment variables
 load_dotenv()
@@ -15,40 +20,24 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Get OpenAI API key from environment variables
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    logger.error("OPENAI_API_KEY environment variable not set")
-    exit()
-
-# Initialize OpenAI client with API key
-client = OpenAI(api_key=openai_api_key)
-
 app = Flask(__name__)
 
-# In-memory storage for images
-image_store_sub4 = {}
+# Disk-backed image storage shared by all workers
+image_store_sub4 = ImageStore("image_store_sub4")
 
-def download_and_resize_image(image_url, target_size, retries=3):
-    """Download an image from the given URL, resize it, and store it in-memory with retry logic."""
+# Structured answer for one question: four option descriptions and up to four correct option numbers
+CHECKBOX_SCHEMA = choice_schema(4, max_correct=4)
+
+def download_and_resize_image(source, target_size, retries=3):
+    """Fetch a generated image, resize it, and store it in the image store with retry logic."""
     try:
-        logger.info(f"Downloading image from URL: {image_url}")
-        response = requests.get(image_url)
-        response.raise_for_status()
-        image = Image.open(BytesIO(response.content))
-        resized_image = image.resize(target_size, Image.LANCZOS)
-        output = BytesIO()
-        resized_image.save(output, format='PNG')
-        output.seek(0)
-        image_key = f"image_{len(image_store_sub4) + 1}.png"
-        image_store_sub4[image_key] = output
-        return image_key
+        return image_store_sub4.add(*render_image(fetch_image(source), target_size))
     except Exception as e:
         logger.error(f"Error resizing image: {e}")
         if retries > 0:
             logger.info(f"Retrying download and resize, {retries} retries left.")
-            return download_and_resize_image(image_url, target_size, retries - 1)
-        return "placeholder_image_url"
+            return download_and_resize_image(source, target_size, retries - 1)
+        return "placeholder_source"
 
 def generate_image(prompt: str, retries: int = 3):
     """Generate an image using the DALL-E model from OpenAI, with retry logic."""
@@ -59,9 +48,17 @@ def generate_image(prompt: str, retries: int = 3):
             model="dall-e-3",
             prompt=safe_prompt,
             n=1,
-            size="1024x1024"
+            size="1024x1024",
+            response_format=IMAGE_RESPONSE_FORMAT
         )
-        return response.data[0].url if response.data else None
+        return image_source(response.data[0]) if response.data else None
+    except RateLimitExceeded:
+        # Fail the whole request with 429 instead of serving placeholder images
+        raise
+    except CircuitOpenError as e:
+        # Rewording the prompt will not help while the image API is down
+        logger.error(f"Error generating image: {e}")
+        return None
     except Exception as e:
         logger.error(f"Error generating image: {e}")
         if retries > 0:
@@ -70,6 +67,25 @@ def generate_image(prompt: str, retries: int = 3):
             return generate_image(modified_prompt, retries - 1)
         return None
 
+def generate_images_with_retry(prompts, target_size):
+    """Generate and store images concurrently, retrying every placeholder result once."""
+    image_keys = [
+        image_key or "placeholder_image_url"
+        for image_key in generate_images_concurrently(prompts, target_size, generate_image, download_and_resize_image)
+    ]
+
+    # Retry if a placeholder image was returned
+    failed_indices = [idx for idx, image_key in enumerate(image_keys) if image_key == "placeholder_image_url"]
+    if failed_indices:
+        logger.info(f"Retrying image generation for {len(failed_indices)} image(s) due to placeholder.")
+        retried_keys = generate_images_concurrently(
+            [prompts[idx] for idx in failed_indices], target_size, generate_image, download_and_resize_image
+        )
+        for idx, image_key in zip(failed_indices, retried_keys):
+            image_keys[idx] = image_key or "placeholder_image_url"
+
+    return image_keys
+
 def generate_mcq(subject: str, tone: str):
     """Generate a checkbox question with multiple correct answers and image options based on the subject."""
     description_prompt = [
@@ -78,66 +94,25 @@ def generate_mcq(subject: str, tone: str):
     ]
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=description_prompt,
-            max_tokens=1000,
-            temperature=0.5
-        )
-        content = response.choices[0].message.content
-
-        # Parsing the response
-        question_section = content.split("**Question:**")[1].split("**Options:**")[0].strip()
-        options_section = content.split("**Options:**")[1].split("**Correct Answers:**")[0].strip()
-        correct_answers_section = content.split("**Correct Answers:**")[1].strip()
+        mcq = generate_structured(description_prompt, CHECKBOX_SCHEMA, parse_checkbox_markdown)
+        question_section = mcq["question"]
+        option_prompts = mcq["options"]
+        correct_answers = [f"Option {number}" for number in mcq["correct_answers"]]
 
-        # Extracting options
-        options = options_section.split('\n')
-        if len(options) != 4:
-            raise ValueError("Generated options do not contain exactly 4 items")
-
-        option_prompts = [option.split('. ', 1)[1].strip() for option in options]
-
-        # Extracting the correct answer indices and ensuring they are valid integers
-        try:
-            correct_answer_indices = [int(x.strip()) for x in correct_answers_section.split(',')]
-            if not all(1 <= idx <= 4 for idx in correct_answer_indices):
-                raise ValueError("One or more correct answer indices are out of range")
-        except ValueError:
-            logger.error(f"Correct answers section could not be parsed as integers: {correct_answers_section}")
-            return {"error": "Failed to parse correct answers"}
-
-        correct_answers = [f"Option {idx}" for idx in correct_answer_indices]
-
-        # Generate the main question image (750x319 px)
-        main_image_url = generate_image(question_section)
-        main_image_key = download_and_resize_image(main_image_url, (750, 319)) if main_image_url else "placeholder_image_url"
-        
-        # Retry if a placeholder image was returned
-        if main_image_key == "placeholder_image_url":
-            logger.info("Retrying main image generation due to placeholder.")
-            main_image_url = generate_image(question_section)
-            main_image_key = download_and_resize_image(main_image_url, (750, 319)) if main_image_url else "placeholder_image_url"
+        # Generate the main question image and the option images concurrently
+        main_image = image_executor.submit(generate_images_with_retry, [question_section], QUESTION_IMAGE_SIZE)
+        option_image_keys = generate_images_with_retry(option_prompts, OPTION_IMAGE_SIZE)
+        main_image_key = main_image.result()[0]
 
         if main_image_key == "placeholder_image_url":
             return {"error": "Failed to generate main image after retries"}, 500
 
-        # Generate images for each option (270x140 px)
         option_images = {}
-        for idx, prompt in enumerate(option_prompts, start=1):
-            image_url = generate_image(prompt)
-            image_key = download_and_resize_image(image_url, (270, 140)) if image_url else "placeholder_image_url"
-            
-            # Retry if a placeholder image was returned
-            if image_key == "placeholder_image_url":
-                logger.info(f"Retrying image generation for option {idx} due to placeholder.")
-                image_url = generate_image(prompt)
-                image_key = download_and_resize_image(image_url, (270, 140)) if image_url else "placeholder_image_url"
-
+        for idx, image_key in enumerate(option_image_keys, start=1):
             if image_key == "placeholder_image_url":
                 logger.error(f"Failed to store image for option {idx} after retries.")
                 return {"error": f"Failed to store image for option {idx} after retries"}, 500
-            
+
             option_images[f"Option {idx}"] = f"/image/{image_key}"
 
         return {
@@ -148,6 +123,7 @@ def generate_mcq(subject: str, tone: str):
         }
     except Exception as e:
         logger.error(f"Error generating MCQ: {e}")
+        discard_last_response()
         return {"error": "Failed to generate MCQ"}
 
 @app.route('/custom', methods=['GET', 'POST'])
@@ -178,10 +154,9 @@ def custom_content():
 def get_image(image_key):
     """Endpoint to retrieve an image by its key."""
     try:
-        image = image_store_sub4.get(image_key)
-        if not image:
+        if image_key not in image_store_sub4:
             return jsonify({"error": "Image not found"}), 404
-        return send_file(image, mimetype='image/png')
+        return send_image(image_store_sub4, image_key)
     except Exception as e:
         logger.error(f"Error retrieving image: {e}")
         return jsonify({"error": "Internal server error"}), 500
@@ -192,15 +167,16 @@ def generate_custom_content_sub4(number, subject, tone):
         if number < 1 or number > 100:  # Ensure number is within allowed range
             return {"error": "Number of questions must be between 1 and 10"}, 400
 
-        main_question_response = generate_mcq(subject, tone)
+        # The main question and all sub-questions (exactly 2 per question) are independent
+        generated = generate_concurrently(generate_mcq, number * 2 + 1, subject, tone)
+        main_question_response, all_sub_questions = generated[0], generated[1:]
         if "error" in main_question_response:
             return {"error": "Failed to generate main question"}, 500
-        
+
         questions = []
-        for _ in range(number):
+        for idx in range(number):
             sub_questions = []
-            for sub_idx in range(2):  # Updated to generate exactly 2 sub-questions
-                sub_question = generate_mcq(subject, tone)
+            for sub_idx, sub_question in enumerate(all_sub_questions[idx * 2:(idx + 1) * 2]):
                 # Ensure that sub-questions always include the "question" key
                 if not sub_question.get("question"):
                     sub_question["question"] = main_question_response["question"]
@@ -219,13 +195,36 @@ def generate_custom_content_sub4(number, subject, tone):
         logger.error(f"Error generating custom content: {e}")
         return {"error": "Internal server error"}, 500
 
+register_quiz_type(
+    803,
+    "Image Checkbox and Text/Image Sub Question",
+    generate_custom_content_sub4,
+    max_questions=100,
+    image_store=image_store_sub4,
+    image_sizes={"question": QUESTION_IMAGE_SIZE, "option": OPTION_IMAGE_SIZE},
+    schema=CHECKBOX_SCHEMA
+)
+
 def format_questions_as_sections(questions):
     """Format questions in the specified structure."""
+    # Pick every content type up front so all sub-question images can be generated at once
+    content_types = [
+        [random.choice(['text', 'image', 'text_with_image']) for _ in question["sub_questions"]]
+        for question in questions
+    ]
+    image_prompts = [
+        sub_question.get("question", "")
+        for question, question_content_types in zip(questions, content_types)
+        for sub_question, content_type in zip(question["sub_questions"], question_content_types)
+        if content_type != 'text'
+    ]
+    image_keys = iter(generate_images_with_retry(image_prompts, OPTION_IMAGE_SIZE))
+
     formatted_questions = []
     for idx, question in enumerate(questions):
         sub_question_formatted = []
         for sub_idx, sub_question in enumerate(question["sub_questions"]):
-            content_type = random.choice(['text', 'image', 'text_with_image'])
+            content_type = content_types[idx][sub_idx]
             if content_type == 'text':
                 sub_question_formatted.append({
                     f"Sub Question No. {sub_idx + 1}": {
@@ -235,14 +234,7 @@ def format_questions_as_sections(questions):
                     }
                 })
             elif content_type == 'image':
-                image_prompt = sub_question.get("question", "")
-                image_url = generate_image(image_prompt)
-                image_key = download_and_resize_image(image_url, (270, 140)) if image_url else "placeholder_image_url"  # Option image size: 270x140 px
-                if image_key == "placeholder_image_url":
-                    logger.info(f"Retrying image generation for sub-question {sub_idx + 1} due to placeholder.")
-                    image_url = generate_image(image_prompt)
-                    image_key = download_and_resize_image(image_url, (270, 140)) if image_url else "placeholder_image_url"
-
+                image_key = next(image_keys)
                 sub_question_formatted.append({
                     f"Sub Question No. {sub_idx + 1}": {
                         "image": f"/image/{image_key}",
@@ -251,14 +243,7 @@ def format_questions_as_sections(questions):
                     }
                 })
             else:  # text_with_image
-                image_prompt = sub_question.get("question", "")
-                image_url = generate_image(image_prompt)
-                image_key = download_and_resize_image(image_url, (270, 140)) if image_url else "placeholder_image_url"  # Option image size: 270x140 px
-                if image_key == "placeholder_image_url":
-                    logger.info(f"Retrying image generation for sub-question {sub_idx + 1} due to placeholder.")
-                    image_url = generate_image(image_prompt)
-                    image_key = download_and_resize_image(image_url, (270, 140)) if image_url else "placeholder_image_url"
-
+                image_key = next(image_keys)
                 sub_question_formatted.append({
                     f"Sub Question No. {sub_idx + 1}": {
                         "question": sub_question.get("question", ""),
@@ -273,5 +258,3 @@ def format_questions_as_sections(questions):
             "sub_questions": sub_question_formatted
         })
     return formatted_questions
-
-